@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# INVOCATION: dli-bench.py [--sizes 20 200] [--results dli-bench.jsonl]
+"""
+dli-bench.py measures dli.py against a local stand-in for a DLI server, so that a change to the download or pdf code can be compared with the previous version without touching the real mirrors.
+
+The fake server answers allmetainfo.cgi with pages in the layout of the real ones and serves synthetic PTIFF/%08d.tif pages, with configurable latency, bandwidth, error rate and a share of malformed multi-page tiffs (a second directory that points past the end of the file, like the ones tiffcrop -N1 is used for).
+
+Every scenario (lookup, each --download-tool, each --pdf-tool and --resize-pdf, for each book size) runs dli.py as a separate process and records the wall time, pages/s, MB/s, peak RSS and the high-water mark of the disk space used. The startup scenario measures the fixed cost of an invocation that does no work. The results are appended to a JSON lines file and compared with the previous run of the same scenario.
+
+        ./dli-bench.py --sizes 20 200 --latency 0.05 --bandwidth 500000
+        ./dli-bench.py --serve 8080       (only run the fake server)
+"""
+import sys
+
+# Require python version 2.[7+]
+major = sys.version_info[0]
+minor = sys.version_info[1]
+if (major != 2 or minor < 7):
+	print("This script requires python version 2.7 or higher (2.x)")
+	sys.exit()
+
+try:
+	import argparse
+	import BaseHTTPServer
+	import json
+	import logging
+	import os
+	import random
+	import re
+	import shutil
+	import SocketServer
+	import struct
+	import subprocess
+	import tempfile
+	import threading
+	import time
+except ImportError as exception:
+	print("Unable to import a required module: {}".format(exception))
+	sys.exit(-1)
+
+
+# the barcode of every benchmark book, its number of pages is in the path
+barcode = 5990010000000
+
+# allmetainfo.cgi in the layout of the DLI servers, see getbookproperties() in dli.py
+metainforow = '''  <tr>
+    <td bgcolor="#DDDDDD"><div align="center"><strong><font face="Arial size="2", Helvetica, sans-serif">{0}</font></strong></div></td>
+    <td bgcolor="#E8EEF7"><div align="center"><font face="Arial  size="2", Helvetica, sans-serif">{1}</font></div></td>
+  </tr>
+'''
+
+metainfopage = '''<html>
+<head><title>Digital Library Of India</title></head>
+<body>
+<table width="100%" border="0">
+{rows}</table>
+<p><a href="/cgi-bin/DBscripts/allmetainfo.cgi?barcode={barcode}">Bibliographic data</a></p>
+<p><strong>Read Online</strong></p>
+<p><a href="/scripts/FullindexDefault.htm?path1=/data/upload/{pages}/{barcode}&first=1&last={pages}&barcode={barcode}">Read Online</a></p>
+</body>
+</html>
+'''
+
+
+def metainfo(barcode, pages):
+	properties = [
+		('Title', 'Benchmark Book Of {} Pages'.format(pages)),
+		('Author1', 'Dli Bench'),
+		('Subject', 'Benchmarks'),
+		('Language', 'English'),
+		('Year', '1950'),
+		('TotalPages', str(pages)),
+		('Barcode', str(barcode)),
+	]
+	rows = ''.join([metainforow.format(key, value) for key, value in properties])
+	return metainfopage.format(rows=rows, barcode=barcode, pages=pages)
+
+
+def tiffentry(tag, fieldtype, count, value):
+	# one little endian directory entry with the value (or offset) inline
+	if (fieldtype == 3 and count == 1):
+		return struct.pack('<HHIHH', tag, fieldtype, count, value, 0)
+	return struct.pack('<HHII', tag, fieldtype, count, value)
+
+
+def tiffpage(width, height, page, malformed):
+	# An uncompressed bilevel page: text-like stripes with the page number
+	# in the first row, so that every page is different.
+	# A malformed page has a second directory whose strip lies beyond the
+	# end of the file.
+	rowbytes = (width + 7) // 8
+	stripe = ('\x00' * rowbytes) * 12 + ('\x5a\xa5' * rowbytes)[0:rowbytes] * 4
+	pixels = (stripe * (height // 16 + 1))[0:rowbytes * height]
+	stamp = struct.pack('<I', page)
+	pixels = stamp + pixels[len(stamp):]
+
+	entries = 11
+	directory = 8 + len(pixels)
+	resolution = directory + 2 + entries * 12 + 4
+	nextdirectory = 0
+	if (malformed == True):
+		nextdirectory = resolution + 16
+
+	data = 'II*\x00' + struct.pack('<I', directory) + pixels
+	data += struct.pack('<H', entries)
+	data += tiffentry(256, 3, 1, width)
+	data += tiffentry(257, 3, 1, height)
+	data += tiffentry(258, 3, 1, 1)
+	data += tiffentry(259, 3, 1, 1)
+	data += tiffentry(262, 3, 1, 0)
+	data += tiffentry(273, 4, 1, 8)
+	data += tiffentry(277, 3, 1, 1)
+	data += tiffentry(278, 3, 1, height)
+	data += tiffentry(279, 4, 1, len(pixels))
+	data += tiffentry(282, 5, 1, resolution)
+	data += tiffentry(283, 5, 1, resolution + 8)
+	data += struct.pack('<I', nextdirectory)
+	data += struct.pack('<II', 150, 1) * 2
+
+	if (malformed == True):
+		data += struct.pack('<H', 5)
+		data += tiffentry(256, 3, 1, width // 4)
+		data += tiffentry(257, 3, 1, height // 4)
+		data += tiffentry(259, 3, 1, 1)
+		data += tiffentry(273, 4, 1, len(data) + 1048576)
+		data += tiffentry(279, 4, 1, rowbytes * height // 16)
+		data += struct.pack('<I', 0)
+
+	return data
+
+
+class FakeDLIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *arguments):
+		logging.debug("fake server: " + format % arguments)
+
+	def do_HEAD(self):
+		self.respond(False)
+
+	def do_GET(self):
+		self.respond(True)
+
+	def respond(self, body):
+		server = self.server
+		time.sleep(server.options.latency)
+
+		match = re.search('allmetainfo\.cgi\?barcode=(\d+)', self.path)
+		if (match != None):
+			# the page count of the book is the last digits of its barcode
+			pages = int(match.group(1)) % 100000
+			self.senddata(200, metainfo(match.group(1), pages), 'text/html', body)
+			return
+
+		match = re.search('/data/upload/(\d+)/\d+/PTIFF/(\d{8})\.tif$', self.path)
+		if (match == None):
+			self.senddata(404, '', 'text/html', body)
+			return
+
+		pages = int(match.group(1))
+		page = int(match.group(2))
+		if (page < 1 or page > pages):
+			self.senddata(404, '', 'text/html', body)
+			return
+
+		if (server.decide(self.path, server.options.error_rate)):
+			self.senddata(503, '', 'text/html', body)
+			return
+
+		data = server.page(page)
+		status = 200
+		headers = {}
+		match = re.match('bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+		if (match != None and int(match.group(1)) < len(data)):
+			first = int(match.group(1))
+			last = len(data) - 1
+			if (match.group(2) != ''):
+				last = min(last, int(match.group(2)))
+			headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(data))
+			data = data[first:last + 1]
+			status = 206
+
+		self.senddata(status, data, 'image/tiff', body, headers)
+
+	def senddata(self, status, data, contenttype, body, headers={}):
+		self.send_response(status)
+		self.send_header('Content-Type', contenttype)
+		self.send_header('Content-Length', str(len(data)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		if (body == False):
+			return
+
+		# --bandwidth is per connection
+		bandwidth = self.server.options.bandwidth
+		chunksize = 16384
+		for offset in range(0, len(data), chunksize):
+			chunk = data[offset:offset + chunksize]
+			self.wfile.write(chunk)
+			if (bandwidth > 0):
+				time.sleep(float(len(chunk)) / bandwidth)
+
+
+class FakeDLIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	# Serves every benchmark book on one port. The pages are generated once
+	# and reused; which requests fail or get a malformed page depends only
+	# on --seed, the path and how often it was requested, so runs repeat.
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, port, options):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeDLIHandler)
+		self.options = options
+		self.lock = threading.Lock()
+		self.requests = {}
+		self.pages = {}
+
+	def decide(self, path, probability):
+		with self.lock:
+			count = self.requests.get(path, 0)
+			self.requests[path] = count + 1
+		if (probability <= 0):
+			return False
+		return random.Random('{}:{}:{}'.format(self.options.seed, path, count)).random() < probability
+
+	def page(self, page):
+		malformed = random.Random('{}:malformed:{}'.format(self.options.seed, page)).random() < self.options.malformed
+		with self.lock:
+			if (not malformed in self.pages):
+				width, height = self.options.page_size
+				self.pages[malformed] = tiffpage(width, height, 0, malformed)
+			template = self.pages[malformed]
+		return template[0:8] + struct.pack('<I', page) + template[12:]
+
+
+def startservers(options):
+	servers = []
+	for i in range(options.mirrors):
+		server = FakeDLIServer(options.port + i, options)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		servers.append(server)
+	return servers
+
+
+def which(program):
+	for i, directory in enumerate(os.environ.get('PATH', '').split(os.pathsep)):
+		filename = os.path.join(directory, program)
+		if (os.path.isfile(filename) and os.access(filename, os.X_OK)):
+			return filename
+	return None
+
+
+# programs each tool needs, a scenario is skipped when one is missing
+downloadtools = {
+	'native': [],
+	'archive': [],
+	'wget': ['wget'],
+	'curl': ['curl'],
+	'aria': ['aria2c'],
+}
+
+pdftools = {
+	'native': [],
+	'tiff2pdf': ['tiffcrop', 'tiffcp', 'tiff2pdf'],
+	'gs': ['gs', 'mogrify'],
+	'sips': ['sips'],
+}
+
+
+# runs of each startup scenario, its result is the median
+startupruns = 10
+
+
+def directorysize(directory):
+	total = 0
+	for root, directories, files in os.walk(directory):
+		for i, name in enumerate(files):
+			try:
+				total += os.path.getsize(os.path.join(root, name))
+			except OSError:
+				pass
+	return total
+
+
+def runmeasured(command, directory):
+	# Run command in directory. Returns the wall time, exit status, peak
+	# RSS in kilobytes (the largest of the process and the children it
+	# waited for) and the most disk space used in directory.
+	highwater = [directorysize(directory)]
+	done = threading.Event()
+
+	def sample():
+		while (not done.wait(0.02)):
+			highwater[0] = max(highwater[0], directorysize(directory))
+
+	sampler = threading.Thread(target=sample)
+	sampler.daemon = True
+	sampler.start()
+
+	logging.debug("running {}".format(' '.join(command)))
+	start = time.time()
+	with open(os.path.join(directory, 'bench-output.log'), 'ab') as output:
+		process = subprocess.Popen(command, cwd=directory, stdout=output, stderr=subprocess.STDOUT)
+		pid, status, usage = os.wait4(process.pid, 0)
+	seconds = time.time() - start
+
+	done.set()
+	sampler.join()
+	highwater[0] = max(highwater[0], directorysize(directory))
+
+	return (seconds, os.WEXITSTATUS(status), usage.ru_maxrss, highwater[0])
+
+
+def lastmediabox(filename):
+	# the MediaBox written last into a pdf, which is the one of a page
+	# rewritten by an incremental update; None if there is none in plain
+	# text (a missing file, or page objects in compressed object streams)
+	try:
+		with open(filename, 'rb') as filestream:
+			data = filestream.read()
+	except (IOError, OSError):
+		return None
+	boxes = re.findall('/MediaBox\\s*\\[([^\\]]*)\\]', data)
+	if (len(boxes) == 0):
+		return None
+	return tuple([round(float(value), 1) for value in boxes[-1].split()])
+
+
+def revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'wb')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+class Bench(object):
+	# Runs the scenarios in a temporary directory and collects one result
+	# per run
+
+	def __init__(self, options):
+		self.options = options
+		self.dli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dli.py')
+		self.workdirectory = tempfile.mkdtemp(prefix='dli-bench-')
+		self.cachedirectory = os.path.join(self.workdirectory, 'cache')
+		self.servers = ['127.0.0.1:{}'.format(options.port + i) for i in range(options.mirrors)]
+		self.revision = revision()
+		self.results = []
+
+	def dlicommand(self, pages, arguments):
+		# every run starts without cached lookups or server statistics.
+		# The log file is relative: the shell download tools run in the
+		# book directory and write to ../[LOG FILE]
+		if (os.path.exists(self.cachedirectory)):
+			shutil.rmtree(self.cachedirectory)
+		command = [self.options.python, self.dli, str(barcode + pages), '--no-cache', '--no-server-ranking',
+			'--cache-dir', self.cachedirectory, '--log-file', 'dli.py.log']
+		return command + arguments
+
+	def rundirectory(self):
+		directory = os.path.join(self.workdirectory, 'run')
+		if (os.path.exists(directory)):
+			shutil.rmtree(directory)
+		os.makedirs(directory)
+		return directory
+
+	def record(self, scenario, tool, pages, repeat, measurement, volume):
+		seconds, status, peakrss, highwater = measurement
+		result = {
+			'time': time.time(),
+			'revision': self.revision,
+			'scenario': scenario,
+			'tool': tool,
+			'pages': pages,
+			'repeat': repeat,
+			'status': status,
+			'seconds': round(seconds, 4),
+			'pagespersecond': round(pages / max(seconds, 0.0001), 2),
+			'mbpersecond': round(volume / 1048576.0 / max(seconds, 0.0001), 3),
+			'peakrss': peakrss,
+			'diskhighwater': highwater,
+			'latency': self.options.latency,
+			'bandwidth': self.options.bandwidth,
+			'errorrate': self.options.error_rate,
+			'malformed': self.options.malformed,
+			'pagesize': '{}x{}'.format(*self.options.page_size),
+		}
+		if (status != 0):
+			logging.warning("    {} {} with {} pages exited with status {}".format(scenario, tool, pages, status))
+		self.results.append(result)
+		return result
+
+	def lookup(self, pages, repeat):
+		for i, (tool, arguments) in enumerate([('sequential', []), ('parallel', ['--lookup-parallel'])]):
+			directory = self.rundirectory()
+			command = self.dlicommand(pages, ['--lookup', '--server'] + self.servers + arguments)
+			self.record('lookup', tool, pages, repeat, runmeasured(command, directory), 0)
+
+	def download(self, pages, repeat, tool):
+		# archive: native, into a --page-archive instead of a file per page
+		directory = self.rundirectory()
+		arguments = ['--download-tool', tool]
+		if (tool == 'archive'):
+			arguments = ['--download-tool', 'native', '--page-archive']
+		command = self.dlicommand(pages, ['--lookup', '--download', '--directory', 'book', '--server', self.servers[0]] + arguments)
+		measurement = runmeasured(command, directory)
+		volume = directorysize(os.path.join(directory, 'book'))
+		if (os.path.exists(os.path.join(directory, 'book.tar'))):
+			volume += os.path.getsize(os.path.join(directory, 'book.tar'))
+		self.record('download', tool, pages, repeat, measurement, volume)
+
+	def pagesof(self, pages):
+		# the pages of a book, downloaded once natively and copied for each pdf run
+		directory = os.path.join(self.workdirectory, 'pages-{}'.format(pages))
+		if (not os.path.exists(directory)):
+			os.makedirs(directory)
+			command = self.dlicommand(pages, ['--lookup', '--download', '--download-tool', 'native', '--directory', 'book', '--server', self.servers[0]])
+			runmeasured(command, directory)
+		return os.path.join(directory, 'book')
+
+	def pdf(self, pages, repeat, tool):
+		directory = self.rundirectory()
+		shutil.copytree(self.pagesof(pages), os.path.join(directory, 'book'))
+		volume = directorysize(os.path.join(directory, 'book'))
+		command = self.dlicommand(pages, ['--create-pdf', '--pdf-tool', tool, '--directory', 'book', '--pdf-name', 'book.pdf'])
+		self.record('pdf', tool, pages, repeat, runmeasured(command, directory), volume)
+
+		# keep a pdf for the resize scenario
+		if (os.path.exists(os.path.join(directory, 'book.pdf'))):
+			shutil.copyfile(os.path.join(directory, 'book.pdf'), os.path.join(self.workdirectory, 'book-{}.pdf'.format(pages)))
+
+	def resize(self, pages, repeat, tool):
+		# incremental: letter, which dli.py sets by rewriting the page
+		# dictionaries (the fake pages are a4 already, which it would skip)
+		# gs: b5, which it can only get by rewriting the pdf with gs
+		original = os.path.join(self.workdirectory, 'book-{}.pdf'.format(pages))
+		if (not os.path.exists(original)):
+			self.pdf(pages, repeat, 'native')
+		directory = self.rundirectory()
+		resized = os.path.join(directory, 'book.pdf')
+		shutil.copyfile(original, resized)
+		volume = os.path.getsize(original)
+		size = {'incremental': 'letter', 'gs': 'b5'}[tool]
+		command = self.dlicommand(pages, ['--resize-pdf', '--pdf-name', 'book.pdf', '--pdf-size', size])
+		result = self.record('resize', tool, pages, repeat, runmeasured(command, directory), volume)
+
+		# a run that left the pages as they were measured nothing
+		before = lastmediabox(original)
+		after = lastmediabox(resized)
+		result['resized'] = (before != None and after != None and before != after)
+		if (result['resized'] == False):
+			logging.warning("    resize {} with {} pages did not change the page size ({} -> {})".format(tool, pages, before, after))
+
+	def startup(self, repeat):
+		# the fixed cost of every invocation, which adds up when books are
+		# run one process each (xargs -n1 ./dli.py): --list-servers, and the
+		# same with the tool check of an installed shell download tool.
+		# The first run of each fills the tool cache and is not recorded.
+		variants = [('list', ['--list-servers'])]
+		installed = [tool for tool in ['wget', 'curl', 'aria'] if available(downloadtools[tool])]
+		if (len(installed) > 0):
+			variants.append(('toolcheck', ['--list-servers', '--download', '--download-tool', installed[0]]))
+
+		for i, (tool, arguments) in enumerate(variants):
+			directory = self.rundirectory()
+			command = self.dlicommand(0, arguments)
+			runmeasured(command, directory)
+			for run in range(startupruns):
+				self.record('startup', tool, 0, repeat * startupruns + run, runmeasured(command, directory), 0)
+
+	def run(self):
+		options = self.options
+		try:
+			if ('startup' in options.scenarios):
+				for repeat in range(options.repeat):
+					logging.info("startup")
+					self.startup(repeat)
+
+			for i, pages in enumerate(options.sizes):
+				for repeat in range(options.repeat):
+					if ('lookup' in options.scenarios):
+						logging.info("lookup, {} pages".format(pages))
+						self.lookup(pages, repeat)
+
+					if ('download' in options.scenarios):
+						for j, tool in enumerate(options.download_tools):
+							if (not available(downloadtools.get(tool))):
+								logging.info("download with {}: skipped, not installed".format(tool))
+								continue
+							logging.info("download with {}, {} pages".format(tool, pages))
+							self.download(pages, repeat, tool)
+
+					if ('pdf' in options.scenarios):
+						for j, tool in enumerate(options.pdf_tools):
+							if (not available(pdftools.get(tool))):
+								logging.info("pdf with {}: skipped, not installed".format(tool))
+								continue
+							logging.info("pdf with {}, {} pages".format(tool, pages))
+							self.pdf(pages, repeat, tool)
+
+					if ('resize' in options.scenarios):
+						for j, tool in enumerate(['incremental', 'gs']):
+							if (tool == 'gs' and not available(['gs'])):
+								logging.info("resize with gs: skipped, not installed")
+								continue
+							logging.info("resize with {}, {} pages".format(tool, pages))
+							self.resize(pages, repeat, tool)
+		finally:
+			if (options.keep == False):
+				shutil.rmtree(self.workdirectory, ignore_errors=True)
+			else:
+				logging.info("Benchmark files kept in {}".format(self.workdirectory))
+
+
+def available(programs):
+	if (programs == None):
+		return False
+	return all([which(program) != None for program in programs])
+
+
+def resultkey(result):
+	return (result['scenario'], result['tool'], result['pages'], result['latency'], result['bandwidth'], result['errorrate'], result['malformed'], result.get('pagesize'))
+
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+
+def report(results, previous):
+	# one line per scenario with the median of the repeats, and the change
+	# from the latest earlier run of the same scenario in the results file
+	groups = {}
+	for i, result in enumerate(results):
+		groups.setdefault(resultkey(result), []).append(result)
+
+	earlier = {}
+	for i, result in enumerate(previous):
+		earlier.setdefault(resultkey(result), []).append(result)
+
+	logging.info("")
+	logging.info("{:<10} {:<11} {:>6} {:>9} {:>9} {:>8} {:>10} {:>12} {:>9}".format('scenario', 'tool', 'pages', 'seconds', 'pages/s', 'MB/s', 'rss (KB)', 'disk (KB)', 'change'))
+	for key in sorted(groups.keys()):
+		runs = groups[key]
+		seconds = median([run['seconds'] for run in runs])
+		change = ''
+		if (key in earlier):
+			last = earlier[key][-1]['time']
+			before = [run['seconds'] for run in earlier[key] if run['time'] == last or abs(run['time'] - last) < 3600]
+			if (len(before) > 0 and median(before) > 0):
+				change = "{:+.1f}%".format((seconds - median(before)) / median(before) * 100)
+		status = '' if all([run['status'] == 0 for run in runs]) else ' (failed)'
+		logging.info("{:<10} {:<11} {:>6} {:>9.3f} {:>9.2f} {:>8.3f} {:>10} {:>12} {:>9}{}".format(key[0], key[1], key[2], seconds,
+			median([run['pagespersecond'] for run in runs]), median([run['mbpersecond'] for run in runs]),
+			max([run['peakrss'] for run in runs]), max([run['diskhighwater'] for run in runs]) // 1024, change, status))
+
+
+def readresults(filename):
+	results = []
+	if (not os.path.exists(filename)):
+		return results
+	with open(filename, 'rb') as filestream:
+		for i, line in enumerate(filestream):
+			try:
+				results.append(json.loads(line))
+			except ValueError:
+				pass
+	return results
+
+
+def parsearguments():
+	parser = argparse.ArgumentParser(description='Benchmark dli.py against a local fake DLI server')
+
+	parser.add_argument('--sizes', nargs='+', type=int, default=[20, 200], help='number of pages of the benchmark books (default: 20 200)')
+	parser.add_argument('--scenarios', nargs='+', default=['startup', 'lookup', 'download', 'pdf', 'resize'], help='startup|lookup|download|pdf|resize (default: all)')
+	parser.add_argument('--download-tools', nargs='+', default=['native', 'archive', 'wget', 'curl', 'aria'], help='--download-tool values to measure, archive is native with --page-archive (default: native archive wget curl aria)')
+	parser.add_argument('--pdf-tools', nargs='+', default=['native', 'tiff2pdf', 'gs', 'sips'], help='--pdf-tool values to measure (default: native tiff2pdf gs sips)')
+	parser.add_argument('--repeat', default='1', type=int, help='runs of every scenario (default: 1)')
+	parser.add_argument('--results', default='dli-bench.jsonl', help='file the results are appended to (default: dli-bench.jsonl)')
+	parser.add_argument('--latency', default='0.02', type=float, help='seconds the fake server waits before every response (default: 0.02)')
+	parser.add_argument('--bandwidth', default='0', type=int, help='bytes per second of every fake server connection, 0 for unlimited (default: 0)')
+	parser.add_argument('--error-rate', default='0', type=float, help='fraction of page requests answered with 503 (default: 0)')
+	parser.add_argument('--malformed', default='0.05', type=float, help='fraction of pages with a broken second tiff directory (default: 0.05)')
+	parser.add_argument('--page-size', default='1240x1754', help='WIDTHxHEIGHT of the 1-bit pages (default: 1240x1754)')
+	parser.add_argument('--mirrors', default='3', type=int, help='fake servers, on consecutive ports (default: 3)')
+	parser.add_argument('--port', default='18080', type=int, help='port of the first fake server (default: 18080)')
+	parser.add_argument('--seed', default='1', help='seed of the error and malformed page choices (default: 1)')
+	parser.add_argument('--python', default=sys.executable, help='python 2 used to run dli.py (default: this one)')
+	parser.add_argument('--keep', action='store_true', help='keep the temporary benchmark directory')
+	parser.add_argument('--serve', nargs='?', type=int, const=18080, metavar='PORT', help='only run the fake servers, on PORT and the following ports')
+	parser.add_argument('--debug', action='store_true', help='log the requests of the fake server')
+
+	options = parser.parse_args()
+
+	match = re.match('^(\d+)x(\d+)$', options.page_size)
+	if (match == None):
+		parser.error("--page-size must be WIDTHxHEIGHT")
+	options.page_size = (int(match.group(1)), int(match.group(2)))
+
+	if (max(options.sizes) >= 100000 or min(options.sizes) < 1):
+		parser.error("--sizes must be between 1 and 99999")
+
+	return options
+
+
+def main():
+	options = parsearguments()
+
+	logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO, format='%(message)s')
+
+	if (options.serve != None):
+		options.port = options.serve
+		startservers(options)
+		logging.info("Fake DLI servers on ports {} to {}, book {} has {} pages".format(options.port, options.port + options.mirrors - 1, barcode + 20, 20))
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			return
+
+	startservers(options)
+
+	previous = readresults(options.results)
+	bench = Bench(options)
+	try:
+		bench.run()
+	finally:
+		with open(options.results, 'ab') as filestream:
+			for i, result in enumerate(bench.results):
+				filestream.write(json.dumps(result, sort_keys=True) + '\n')
+
+	report(bench.results, previous)
+	logging.info("")
+	logging.info("{} results appended to {}".format(len(bench.results), options.results))
+
+
+if __name__ == '__main__':
+	main()
@@ -9,6 +9,16 @@ I use the following one liner to download multiple books
 
         cat barcodes.txt | xargs -n1 ./dli.py
 
+or, to overlap the lookups, downloads and pdf creation of several books in one process
+
+        ./dli.py --batch barcodes.txt --download-tool native
+
+or, to keep a queue of books that survives crashes and restarts, run it as a service and submit books to it
+
+        ./dli.py --serve 127.0.0.1:8765 --download-tool native
+        curl -d '{"barcodes": [2020050012345]}' http://127.0.0.1:8765/jobs
+        curl http://127.0.0.1:8765/status
+
 And I watch detailed progress by tailing the log file
 
         tail -f dli.py.log
@@ -23,38 +33,58 @@ if (major != 2 or minor < 7):
 	sys.exit()
 
 # Put import in a try block to get a simple error message
-# if the import isn't found
+# if the import isn't found.
+# Modules that only some commands need are imported where they are used,
+# to keep the startup of every invocation short: sqlite3 (catalog, page
+# store, jobs), HTMLParser and lxml (lookups), multiprocessing (pdf
+# conversion), BaseHTTPServer and SocketServer (--serve)
 try:
 	import argparse
+	import collections
+	import contextlib
+	import copy
+	import errno
 	import glob
+	import hashlib
+	import httplib
+	import json
 	import linecache
 	import logging
+	import mmap
 	import os
 	import pipes
 	import re
 	import shutil
+	import signal
+	import socket
+	import struct
 	import subprocess
+	import threading
 	import time
+	import Queue
 	import urllib2
 	from urlparse import urlparse, parse_qs
 except ImportError as exception:
 	print "Unable to find python module: {}".format(exception)
 	sys.exit()
 
-lxmlpresent = False
-
-try:
-	from lxml import html
-	lxmlpresent = True
-except:
-	pass
+# None until havelxml() has tried to import it
+lxmlpresent = None
 
 
 # global parameters
 # parser is global to call print_help from anywhere
 args = None
 parser = None
-FNULL = open(os.devnull, 'w')
+
+# persistent per-server statistics, see ServerScoreboard
+scoreboard = None
+
+# per-server connection caps shared by all books, see ServerLimits
+serverlimits = None
+
+# per-page and per-stage measurements of this run, see Metrics
+metrics = None
 
 # prioritized list of known DLI servers
 servers = [
@@ -84,6 +114,12 @@ def main(argv):
 
 	validatearguments()
 
+	# order (and skip) servers by their recorded latency and availability
+	global scoreboard
+	scoreboard = ServerScoreboard(os.path.join(args.cache_dir, 'servers.json'))
+	if (args.no_server_ranking == False):
+		args.server = scoreboard.rank(args.server)
+
 	# note: since it doesn't make sense to combine --list-servers/--lookup
 	# with --download/--createpdf, exit after those operations are complete
 
@@ -96,30 +132,57 @@ def main(argv):
 		listservers()
 		sys.exit()
 
-	# --lookup
-	# reset args.servers based on the lookup call
-	if (args.lookup == True):
-		goodserver = lookup()
+	global serverlimits
+	serverlimits = ServerLimits(args.server_connections)
 
-	# --download
-	if (args.download == True):
-		if (args.lookup == False):
-			goodserver = lookuponserver(args.server[0])
+	# --search
+	if (args.search != None):
+		searchcatalog(args.search)
+		sys.exit()
 
-		if (goodserver == None):
-			logging.info("Cannot download since no server was found")
-			sys.exit(-1)
+	# --harvest
+	if (args.harvest != None):
+		harvest(args.harvest)
+		scoreboard.save()
+		sys.exit()
 
-		server, url, pages, firstpagedownloaded = goodserver
-		downloadbook(server, url, pages)
+	global metrics
+	metrics = Metrics()
 
-	# --create-pdf
-	if (args.create_pdf == True):
-		createpdf()
-		logging.info ("PDF Creation complete")
+	try:
+		# --serve
+		if (args.serve != None):
+			serve(args.serve)
+			sys.exit()
 
-	if (args.resize_pdf == True):
-		resizepdf()
+		# --batch
+		if (args.batch != None):
+			books = readbatch(args.batch)
+			if (args.shard != None):
+				books = books[args.shard[0] - 1::args.shard[1]]
+				logging.info("Shard {}/{}: {} books".format(args.shard[0], args.shard[1], len(books)))
+			scheduler = BatchScheduler(books)
+			if (scheduler.run() == False):
+				sys.exit(-1)
+			sys.exit()
+
+		# the command line describes a single book
+		book = args
+		initbook(book)
+
+		# --lookup
+		# --download
+		lookupstage(book)
+		if (args.download == True):
+			downloadstage(book)
+
+		# --create-pdf
+		# --resize-pdf
+		pdfstage(book)
+	finally:
+		# --metrics-file
+		# --metrics-prom
+		metrics.finish()
 
 	# After pdf operations, open the pdf if requested
 	if (args.create_pdf == True or args.resize_pdf == True):
@@ -132,6 +195,92 @@ def main(argv):
 		elif (platform == 'win32'):
 			os.startfile(args.pdf_name)
 
+def initbook(book):
+	# per-book state filled in by the lookup
+	book.goodserver = None
+	book.properties = None
+
+	# every server that passed the first page check during --lookup,
+	# as (server, url, pages, firstpagedownloaded) in --server order
+	book.goodsources = []
+
+	# set once a --lookup-parallel lookup has found a good server and the
+	# remaining lookups are no longer needed
+	book.lookupcancelled = threading.Event()
+
+	# --stream-pdf builds the pdf while the pages download, see PageStreamer
+	book.streamer = None
+
+	# the --page-archive that the download stage appends to, see PageArchive
+	book.archive = None
+
+	# the page shards of the book in its directory, see shardrange() and
+	# mergeshards(); each one keeps its own manifest there
+	book.shardcount = None
+	book.manifestname = manifestname
+	if (book.pageshard != None):
+		book.manifestname = shardmanifestname(book.pageshard)
+
+
+def lookupstage(book):
+	# runs without --lookup or --download (--create-pdf, --resize-pdf,
+	# --merge) record no lookup stage
+	if (book.lookup == False and book.download == False):
+		return
+
+	with metrics.stage(book, 'lookup'):
+		# --lookup
+		# reset book.goodserver based on the lookup call
+		if (book.lookup == True):
+			book.goodserver = cachedlookup(book)
+			scoreboard.save()
+
+		# --download without --lookup uses the first server
+		if (book.download == True and book.lookup == False):
+			book.goodserver = cachedlookup(book, book.server[0])
+
+
+def downloadstage(book):
+	if (book.goodserver == None):
+		logging.info("Cannot download since no server was found")
+		sys.exit(-1)
+
+	server, url, pages, firstpagedownloaded = book.goodserver
+	sources = None
+	if (book.multi_source == True and len(book.goodsources) > 0):
+		sources = [(s[0], s[1]) for s in book.goodsources]
+	with metrics.stage(book, 'download'):
+		downloadbook(book, server, url, pages, sources)
+	scoreboard.save()
+
+	if (book.pageshard != None):
+		logging.info ("Shard {}/{} downloaded, create the pdf with --merge once every shard is done".format(*book.pageshard))
+
+
+def pdfstage(book):
+	# --create-pdf
+	# with --stream-pdf most of the pdf was built during the download
+	if (book.create_pdf == True and book.streamer != None):
+		with metrics.stage(book, 'pdf'):
+			book.streamer.finish()
+		logging.info ("PDF Creation complete")
+	elif (book.create_pdf == True):
+		with metrics.stage(book, 'pdf'):
+			# --merge
+			if (book.merge == True):
+				mergeshards(book)
+			createpdf(book)
+		logging.info ("PDF Creation complete")
+
+	# --resize-pdf
+	# the native writer has already laid the pages out on the paper
+	if (book.resize_pdf == True and book.create_pdf == True and book.pdf_tool == 'native' and book.pdf_size in papersizes):
+		logging.info("Pages were fitted to {} while creating the pdf".format(book.pdf_size))
+	elif (book.resize_pdf == True):
+		with metrics.stage(book, 'resize'):
+			resizepdf(book)
+
+
 def parsearguments():
 	global args
 	global parser
@@ -144,23 +293,53 @@ def parsearguments():
 	parser.add_argument('--download', action='store_true', help='download the book with the specified [BARCODE] from the first [SERVER]')
 	parser.add_argument('--create-pdf', action='store_true', help='create a pdf from the downloaded files')
 	parser.add_argument('--resize-pdf', action='store_true', help='set pdf page size to the value specified in --pdf-size')
+	parser.add_argument('--harvest', nargs='+', metavar='BARCODES', help='store the metadata of books in the --catalog: barcodes, FIRST-LAST ranges or files listing them (- for stdin)')
+	parser.add_argument('--search', help='full text search of title, author, subject and language in the --catalog')
+
+	parser.add_argument('--serve', nargs='?', const='127.0.0.1:8765', metavar='ADDRESS', help='run as a service that takes books over an http api on HOST:PORT or a unix socket path (default: 127.0.0.1:8765)')
+	parser.add_argument('--jobs-db', help='sqlite database of the --serve jobs (default: [CACHE DIR]/jobs.db)')
 
 	parser.add_argument('barcode', type=int, nargs='?', help='specify the barcode for the book')
+	parser.add_argument('--batch', nargs='?', help='file with one "BARCODE [PDF NAME]" per line to process in one run, - for stdin')
+	parser.add_argument('--batch-parallel', default='2', type=int, help='number of --batch books processed at the same time (default: 2)')
+	parser.add_argument('--shard', help='I/N: with --batch, process only every Nth book of the list, starting with the Ith; with a single book, --download only the Ith of N page ranges into the (shared) --directory')
+	parser.add_argument('--merge', action='store_true', help='check that every --shard of the book has been downloaded and create the pdf from them')
+	parser.add_argument('--server-connections', default='8', type=int, help='maximum connections to each server across all books (default: 8)')
 	parser.add_argument('--barcode', type=int, nargs='?', dest='barcode2', help='specify the barcode for the book (for backwards compatibility)')
 
 	parser.add_argument('--server', default=servers, nargs='*', help='see --list for known servers (default: 202.41.82.144)')
 	parser.add_argument('--first', default='1', type=int, help='first page to --download')
 	parser.add_argument('--last', nargs='?', type=int, help='last page to --download')
 	parser.add_argument('--timeout', default='120', type=int, help='seconds to wait for DLI servers to respond during --download (default: 120)')
+	parser.add_argument('--lookup-parallel', action='store_true', help='query all [SERVER] concurrently during --lookup')
 	parser.add_argument('--lookup-timeout', default='10', type=int, help='seconds to wait for DLI servers to respond during --lookup (default: 10)')
-	parser.add_argument('--download-parallel', dest='threads', default='5', type=int, help='number of parallel operations during --download (default: 5)')
+	parser.add_argument('--download-parallel', dest='threads', default='5', type=int, help='number of parallel operations during --download, the most for each server with --download-tool native (default: 5)')
+	parser.add_argument('--cache-dir', default=os.path.join('~', '.dli'), help='directory for cached lookups, server statistics and tool locations (default: ~/.dli)')
+	parser.add_argument('--cache-ttl', default='168', type=float, help='hours before a cached lookup expires (default: 168)')
+	parser.add_argument('--cache-size', default='1000', type=int, help='maximum number of books in the lookup cache (default: 1000)')
+	parser.add_argument('--server-cooldown', default='30', type=float, help='minutes to skip a server after it fails (default: 30)')
+	parser.add_argument('--no-server-ranking', action='store_true', help='use [SERVER] in the order given instead of ranking them by recorded performance')
+	parser.add_argument('--refresh', action='store_true', help='ignore cached lookups and query the servers again')
+	parser.add_argument('--no-cache', action='store_true', help='do not read or write the lookup cache')
+	parser.add_argument('--page-store', nargs='?', const='', help='keep downloaded pages in DIR and reuse them instead of downloading them again (default DIR: [CACHE DIR]/pages)')
+	parser.add_argument('--page-store-size', default='4096', type=int, help='megabytes kept in the --page-store before the least recently used pages are removed (default: 4096)')
+	parser.add_argument('--catalog', help='sqlite database used by --harvest and --search (default: [CACHE DIR]/catalog.db)')
+	parser.add_argument('--harvest-parallel', default='2', type=int, help='number of parallel --harvest requests to each server (default: 2)')
+	parser.add_argument('--harvest-max-age', default='720', type=float, help='hours before a --harvest record is fetched again (default: 720)')
 	parser.add_argument('--pdf-name', nargs='?', help='specify the output pdf file name (default [BARCODE].pdf)')
 	parser.add_argument('--directory', nargs='?', help='the directory in which downloaded files are stored (default [BARCODE])')
 	parser.add_argument('--overwrite', action='store_true', help='overwrite existing local files')
-	parser.add_argument('--download-tool', default='wget', help='tool used to download files: aria|wget|curl (default: wget)')
-	parser.add_argument('--pdf-tool', default='tiff2pdf', help='tool chain used to generate pdf file: gs|sips|tiff2pdf (default: tiff2pdf)')
-	parser.add_argument('--pdf-size', default='letter', help='pdf paper size: a4|letter (default: letter)')
+	parser.add_argument('--page-archive', action='store_true', help='keep the downloaded pages in one indexed tar file, [DIRECTORY].tar, instead of a file per page; it is kept after pdf creation')
+	parser.add_argument('--hedge-percentile', default='95', type=float, help='with --download-tool native, request a page again when it takes longer than this percentile of the pages so far, preferably from another server that hosts the book, 0 to disable (default: 95)')
+	parser.add_argument('--multi-source', action='store_true', help='spread --download over every server found by --lookup (requires --download-tool native)')
+	parser.add_argument('--download-tool', default='wget', help='tool used to download files: aria|wget|curl|native (default: wget)')
+	parser.add_argument('--pdf-tool', default='tiff2pdf', help='tool chain used to generate pdf file: gs|sips|tiff2pdf|native (default: tiff2pdf)')
+	parser.add_argument('--pdf-parallel', type=int, help='number of pages converted at the same time during --create-pdf (default: number of cpus)')
+	parser.add_argument('--stream-pdf', action='store_true', help='build the pdf while the pages download (requires --download-tool native)')
+	parser.add_argument('--pdf-size', default='letter', help='pdf paper size: a4|letter, or any other gs paper size (default: letter)')
 	parser.add_argument('--pdf-open', action='store_true', help='open pdf after creation (osx only)')
+	parser.add_argument('--metrics-file', help='append the page and stage measurements of this run to FILE as json lines')
+	parser.add_argument('--metrics-prom', help='write a summary of this run to FILE in the prometheus textfile format')
 	parser.add_argument('--log-file', default='dli.py.log', help='log file location: filename|NUL|/dev/null (default: dli.py.log)')
 	parser.add_argument('--no-check-tools', action='store_true', help='check to see if tools are installed properly')
 	parser.add_argument('--no-title-in-pdf-name', action='store_true', help='do not default to the title for the pdf name')
@@ -183,21 +362,69 @@ def validatearguments():
 	# If no action is specified, show help
 	# Special case: If the barcode is specified, automatically infer --lookup --download --create-pdf for ease of user
 	if(args.list_servers == False
+		and args.harvest == None
+		and args.search == None
 		and args.lookup == False
 		and args.download == False
 		and args.create_pdf == False
 		and args.resize_pdf == False
+		and args.merge == False
 	):
-		if (args.barcode != None):
+		if (args.barcode != None or args.batch != None or args.serve != None):
 			args.lookup = True
 			args.download = True
-			args.create_pdf = True
+			# the page shards of a book are put together by --merge
+			args.create_pdf = (args.shard == None or args.batch != None)
 		else:
 			parser.print_help()
 			sys.exit()
 
+	# --serve takes the barcodes and pdf names over its api
+	if (args.serve != None):
+		if (args.barcode != None or args.batch != None or args.directory != None or args.pdf_name != None):
+			logging.error("Error: [barcode], --batch, --directory and --pdf-name cannot be combined with --serve")
+			sys.exit()
+
+	# --batch takes the barcodes, pdf names and directories from the file
+	if (args.batch != None or args.serve != None):
+		if (args.barcode != None or args.directory != None or args.pdf_name != None):
+			logging.error("Error: [barcode], --directory and --pdf-name cannot be combined with --batch")
+			sys.exit()
+		if (args.batch_parallel < 1):
+			logging.error("Error: --batch-parallel must be at least 1")
+			sys.exit()
+
+	# --shard I/N, see shardrange()
+	if (args.shard != None):
+		match = re.match('^(\\d+)/(\\d+)$', args.shard)
+		if (match == None or int(match.group(1)) < 1 or int(match.group(1)) > int(match.group(2))):
+			logging.error("Error: --shard must be I/N with I from 1 to N")
+			sys.exit()
+		args.shard = (int(match.group(1)), int(match.group(2)))
+		if (args.serve != None):
+			logging.error("Error: --shard cannot be combined with --serve")
+			sys.exit()
+
+	# a shard of a single book only downloads its pages, --merge makes the pdf
+	args.pageshard = None
+	if (args.shard != None and args.batch == None):
+		args.pageshard = args.shard
+		if (args.create_pdf == True or args.resize_pdf == True or args.stream_pdf == True):
+			logging.error("Error: --create-pdf, --resize-pdf and --stream-pdf cannot be combined with --shard of a single book, create the pdf with --merge")
+			sys.exit()
+
+	# --merge creates the pdf of a book from its page shards
+	if (args.merge == True):
+		if (args.batch != None or args.serve != None or args.shard != None or args.download == True):
+			logging.error("Error: --merge cannot be combined with --batch, --serve, --shard or --download")
+			sys.exit()
+		if (args.barcode == None):
+			logging.error("Error: A barcode must be specified")
+			sys.exit()
+		args.create_pdf = True
+
 	# Ensure barcode is specified when required
-	if(args.lookup == True or args.download == True):
+	if(args.batch == None and args.serve == None and (args.lookup == True or args.download == True)):
 		if (args.barcode == None):
 			logging.error("Error: A barcode must be specified")
 			sys.exit()
@@ -225,20 +452,58 @@ def validatearguments():
 		sys.exit()
 
 	# validate --download-tool
-	if (not args.download_tool in ['wget', 'curl', 'aria']):
+	if (not args.download_tool in ['wget', 'curl', 'aria', 'native']):
 		logging.error("Error: unknown value specified for --download-tool")
 		sys.exit()
 
+	# --multi-source needs per-page control over the server
+	if (args.multi_source == True and args.download_tool != 'native'):
+		logging.error("Error: --multi-source requires --download-tool native")
+		sys.exit()
+
 	# validate --pdf-tool
-	if (not args.pdf_tool in ['gs', 'sips', 'tiff2pdf']):
+	if (not args.pdf_tool in ['gs', 'sips', 'tiff2pdf', 'native']):
 		logging.error("Error: unknown value specified for --pdf-tool")
 		sys.exit()
 
+	# without --pdf-parallel, convertpages() uses the number of cpus
+	if (args.pdf_parallel != None and args.pdf_parallel < 1):
+		logging.error("Error: --pdf-parallel must be at least 1")
+		sys.exit()
+
+	# --stream-pdf needs to know when each page arrives
+	if (args.stream_pdf == True):
+		if (args.download_tool != 'native' or args.download == False or args.create_pdf == False):
+			logging.error("Error: --stream-pdf requires --download, --create-pdf and --download-tool native")
+			sys.exit()
+		if (not args.pdf_tool in streamingpdftools):
+			logging.error("Error: --stream-pdf is supported with --pdf-tool {}".format('|'.join(streamingpdftools)))
+			sys.exit()
+
 	# --pdf-tool sips is only supported on osx
 	if (args.pdf_tool == 'sips' and sys.platform != 'darwin'):
 		logging.error("Error: --pdf-tool sips is only supported on mac osx")
 		sys.exit()
 
+	args.cache_dir = os.path.expanduser(args.cache_dir)
+	if (args.catalog == None):
+		args.catalog = os.path.join(args.cache_dir, 'catalog.db')
+	if (args.jobs_db == None):
+		args.jobs_db = os.path.join(args.cache_dir, 'jobs.db')
+
+	if (args.page_store == ''):
+		args.page_store = os.path.join(args.cache_dir, 'pages')
+	elif (args.page_store != None):
+		args.page_store = os.path.expanduser(args.page_store)
+
+	if (args.hedge_percentile < 0 or args.hedge_percentile > 100):
+		logging.error("Error: --hedge-percentile must be between 0 and 100")
+		sys.exit()
+
+	if (args.harvest_parallel < 1):
+		logging.error("Error: --harvest-parallel must be at least 1")
+		sys.exit()
+
 	if (args.resize_pdf == True and args.pdf_name == ''):
 		logging.error("Cannot --resize-pdf when no --pdf-name is specified")
 		sys.exit()
@@ -252,6 +517,7 @@ def checktools():
 
 	tools = []
 
+	# note: the native download tool has no dependencies
 	if (args.download == True):
 		if(args.download_tool == 'aria'):
 			tools.append('aria2c')
@@ -263,7 +529,7 @@ def checktools():
 			tools.append('xargs')
 
 	if (args.create_pdf == True):
-		# note: sips has no dependencies
+		# note: sips and native have no dependencies
 		if (args.pdf_tool == 'tiff2pdf'):
 			tools.append('tiffcp')
 			tools.append('tiff2pdf')
@@ -271,7 +537,8 @@ def checktools():
 			tools.append('mogrify')
 			tools.append('gs')
 
-	if (args.resize_pdf == True):
+	# note: resizing to one of the papersizes has no dependencies
+	if (args.resize_pdf == True and not args.pdf_size in papersizes):
 		tools.append('gs')
 
 	# only need to check for each tool once
@@ -281,22 +548,10 @@ def checktools():
 	logging.debug("Checking for the following required tools: {0}".format(list(toolset)))
 
 	toolsnotfound = []
-	for i, tool in enumerate(toolset):
-		toolpresent = False
-		logging.debug("Checking to see if {0} is present".format(tool))
-		try:
-			subprocess.call([tool, "-h"], stdout=FNULL, stderr=FNULL)
-			toolpresent = True
-		except OSError as exception:
-			if exception.errno == os.errno.ENOENT:
-				logging.debug("OSError")
-				printexception(exception)
-		except Exception as exception:
-			logging.debug("Non-OSError Exception")
-			printexception(exception)
-
-		logging.debug("Is {0} present: {1}".format(tool, toolpresent))
-		if (toolpresent == False):
+	locations = ToolCache(os.path.join(args.cache_dir, toolcachename)).locate(sorted(toolset))
+	for tool, location in sorted(locations.items()):
+		logging.debug("Is {0} present: {1}".format(tool, location))
+		if (location['filename'] == None):
 			toolsnotfound.append(tool)
 
 	if (len(toolsnotfound) > 0):
@@ -304,32 +559,309 @@ def checktools():
 		logging.error("Please install/configure them and try again")
 		sys.exit(-1)
 
-	if (lxmlpresent == False):
-		logging.warning("Warning: The lxml python module is not present. Run 'pip install lxml' to install it")
+
+# file in --cache-dir that remembers where the tools are, see ToolCache
+toolcachename = 'tools.json'
+
+
+def findtool(tool, path):
+	# the file the shell runs for tool: the first executable of that name
+	# in the PATH directories (with a PATHEXT extension on windows)
+	extensions = ['']
+	if (sys.platform == 'win32'):
+		extensions = os.environ.get('PATHEXT', '.EXE').lower().split(os.pathsep) + ['']
+	for directory in path.split(os.pathsep):
+		for extension in extensions:
+			filename = os.path.join(directory or '.', tool + extension)
+			if (os.path.isfile(filename) and os.access(filename, os.X_OK)):
+				return filename
+	return None
+
+
+def toolversion(filename):
+	# the first line with a version number in the output of --version or -h
+	for option in ['--version', '-h']:
+		try:
+			with open(os.devnull, 'rb') as devnull:
+				process = subprocess.Popen([filename, option], stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+				output = process.communicate()[0]
+		except OSError:
+			return None
+		for line in output.splitlines():
+			if (re.search('\\d+\\.\\d+', line)):
+				return line.strip()
+	return None
+
+
+class ToolCache(object):
+	# Where each external tool is and its version, found by searching PATH
+	# instead of starting every tool, and kept in --cache-dir/tools.json.
+	# An entry is used while PATH is unchanged, no PATH directory has been
+	# modified (a tool installed or removed changes its directory) and the
+	# tool's file has the same size and mtime; otherwise the tool is looked
+	# up again and its version probed once.
+
+	def __init__(self, filename):
+		self.filename = filename
+
+	def pathstate(self, path):
+		# mtime of every PATH directory, None for the missing ones
+		directories = {}
+		for directory in path.split(os.pathsep):
+			try:
+				directories[directory] = os.stat(directory or '.').st_mtime
+			except OSError:
+				directories[directory] = None
+		return directories
+
+	def fileinfo(self, filename):
+		try:
+			status = os.stat(filename)
+			return (status.st_size, status.st_mtime)
+		except (OSError, TypeError):
+			return None
+
+	def locate(self, tools):
+		# {tool: {'filename': ..., 'version': ...}}, filename None when missing
+		path = os.environ.get('PATH', os.defpath)
+		directories = self.pathstate(path)
+
+		cache = readjson(self.filename, {})
+		if (not isinstance(cache, dict) or cache.get('path') != path or cache.get('directories') != directories):
+			logging.debug("PATH has changed, looking up every tool again")
+			cache = {'path': path, 'directories': directories, 'tools': {}}
+
+		changed = False
+		locations = {}
+		for i, tool in enumerate(tools):
+			entry = cache['tools'].get(tool)
+			if (entry != None and entry.get('filename') != None and self.fileinfo(entry['filename']) != tuple(entry.get('file') or ())):
+				logging.debug("{} has changed since it was last found".format(entry['filename']))
+				entry = None
+			if (entry == None):
+				filename = findtool(tool, path)
+				entry = {'filename': filename, 'file': self.fileinfo(filename), 'version': None}
+				if (filename != None):
+					entry['version'] = toolversion(filename)
+				logging.debug("Found {}: {}".format(tool, entry))
+				cache['tools'][tool] = entry
+				changed = True
+			locations[tool] = {'filename': entry['filename'], 'version': entry['version']}
+
+		if (changed == True):
+			try:
+				if (not os.path.exists(os.path.dirname(self.filename))):
+					os.makedirs(os.path.dirname(self.filename))
+				writejson(self.filename, cache)
+			except (IOError, OSError) as exception:
+				logging.warning("Unable to write the tool cache {}".format(self.filename))
+				printexception(exception)
+		return locations
 
 
 def listservers():
 	logging.info ("Servers:")
 	logging.info ("-------")
-	for i, al in enumerate(servers):
-		logging.info (servers[i])
+	for i, server in enumerate(args.server):
+		logging.info ("{:<24} {}".format(server, scoreboard.describe(server)))
+
+	for i, server in enumerate(scoreboard.skipped):
+		logging.info ("{:<24} {} (skipped after a recent failure)".format(server, scoreboard.describe(server)))
+
+
+class ServerLimits(object):
+	# Caps the number of simultaneous connections to each server across
+	# every book and thread in this process (--server-connections)
 
+	def __init__(self, limit):
+		self.limit = limit
+		self.lock = threading.Lock()
+		self.semaphores = {}
 
-def lookup():
+	@contextlib.contextmanager
+	def hold(self, server):
+		with self.lock:
+			semaphore = self.semaphores.get(server)
+			if (semaphore == None):
+				semaphore = threading.BoundedSemaphore(self.limit)
+				self.semaphores[server] = semaphore
+		semaphore.acquire()
+		try:
+			yield
+		finally:
+			semaphore.release()
+
+
+class ServerScoreboard(object):
+	# Persistent per-server statistics in --cache-dir/servers.json: lookup and
+	# first page latency, download throughput (exponentially weighted), attempt
+	# and error counts, and the time of the last success and failure.
+	# rank() orders servers by them instead of the static priority list, and
+	# skips servers that failed within the last --server-cooldown minutes.
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.stats = readjson(filename, {})
+		self.touched = set()
+		self.skipped = []
+
+	def entry(self, server):
+		# caller holds self.lock
+		self.touched.add(server)
+		return self.stats.setdefault(server, {
+			'attempts': 0,
+			'errors': 0,
+			'lookuplatency': None,
+			'firstpagelatency': None,
+			'throughput': None,
+			'pages': 0,
+			'pageerrors': 0,
+			'lastsuccess': None,
+			'lastfailure': None,
+		})
+
+	def average(self, value, sample):
+		if (value == None):
+			return sample
+		return 0.7 * value + 0.3 * sample
+
+	def recordlookup(self, server, seconds):
+		with self.lock:
+			entry = self.entry(server)
+			entry['attempts'] += 1
+			entry['lookuplatency'] = self.average(entry['lookuplatency'], seconds)
+			entry['lastsuccess'] = time.time()
+
+	def recordfirstpage(self, server, seconds):
+		with self.lock:
+			entry = self.entry(server)
+			entry['firstpagelatency'] = self.average(entry['firstpagelatency'], seconds)
+			entry['lastsuccess'] = time.time()
+
+	def recorddownload(self, server, pages, errors, throughput):
+		with self.lock:
+			entry = self.entry(server)
+			entry['pages'] += pages
+			entry['pageerrors'] += errors
+			if (throughput != None):
+				entry['throughput'] = self.average(entry['throughput'], throughput)
+			if (pages > 0):
+				entry['lastsuccess'] = time.time()
+			if (errors > 0 and pages == 0):
+				entry['lastfailure'] = time.time()
+
+	def recordfailure(self, server, stage):
+		logging.debug("server [{}]: recording {} failure".format(server, stage))
+		with self.lock:
+			entry = self.entry(server)
+			if (stage == 'lookup'):
+				entry['attempts'] += 1
+			entry['errors'] += 1
+			entry['lastfailure'] = time.time()
+
+	def iscoolingdown(self, server):
+		entry = self.stats.get(server)
+		if (entry == None or entry['lastfailure'] == None):
+			return False
+		if (entry['lastsuccess'] != None and entry['lastsuccess'] > entry['lastfailure']):
+			return False
+		return (time.time() - entry['lastfailure'] < args.server_cooldown * 60)
+
+	def cost(self, server):
+		# rough seconds to look up a book and start downloading it
+		entry = self.stats.get(server)
+		if (entry == None):
+			entry = {'attempts': 0, 'errors': 0, 'lookuplatency': None, 'firstpagelatency': None, 'throughput': None}
+
+		lookuplatency = entry['lookuplatency']
+		if (lookuplatency == None):
+			lookuplatency = args.lookup_timeout / 2.0
+		firstpagelatency = entry['firstpagelatency']
+		if (firstpagelatency == None):
+			firstpagelatency = args.lookup_timeout / 2.0
+
+		# every failed attempt costs a timeout
+		availability = (entry['attempts'] - entry['errors'] + 1.0) / (entry['attempts'] + 2.0)
+		cost = lookuplatency + firstpagelatency + (1 - max(availability, 0)) * args.lookup_timeout
+
+		# time to fetch a megabyte of pages
+		if (entry['throughput'] != None and entry['throughput'] > 0):
+			cost += 1000000.0 / entry['throughput']
+
+		return cost
+
+	def rank(self, serverlist):
+		available = [server for server in serverlist if not self.iscoolingdown(server)]
+		skipped = [server for server in serverlist if not server in available]
+		if (len(available) == 0):
+			# everything failed recently, try them all anyway
+			available = serverlist
+			skipped = []
+
+		# sorted() is stable, so servers without history keep their given order
+		ranked = sorted(available, key=self.cost)
+		self.skipped = skipped
+		logging.debug("Ranked servers: {}".format([(server, round(self.cost(server), 2)) for server in ranked]))
+		if (len(skipped) > 0):
+			logging.info ("Skipping servers that failed in the last {} minutes: {}".format(args.server_cooldown, skipped))
+		return ranked
+
+	def describe(self, server):
+		entry = self.stats.get(server)
+		if (entry == None):
+			return "(no history)"
+
+		def seconds(value):
+			if (value == None):
+				return "-"
+			return "{:.2f}s".format(value)
+
+		throughput = "-"
+		if (entry['throughput'] != None):
+			throughput = "{:.0f}KB/s".format(entry['throughput'] / 1000)
+
+		return "lookup {} first page {} throughput {} errors {}/{} pages {} ({} failed)".format(
+			seconds(entry['lookuplatency']), seconds(entry['firstpagelatency']), throughput,
+			entry['errors'], entry['attempts'], entry['pages'], entry['pageerrors'])
+
+	def save(self):
+		with self.lock:
+			if (len(self.touched) == 0):
+				return
+
+			# reload before saving to keep statistics written by other dli.py processes
+			stats = readjson(self.filename, {})
+			for server in self.touched:
+				stats[server] = self.stats[server]
+
+			try:
+				if (not os.path.exists(os.path.dirname(self.filename))):
+					os.makedirs(os.path.dirname(self.filename))
+				writejson(self.filename, stats)
+				self.touched = set()
+			except (IOError, OSError) as exception:
+				logging.warning("Unable to write server statistics {}".format(self.filename))
+				printexception(exception)
+
+
+def lookup(book):
 	logging.debug("Enter lookup()")
 
 	goodserver = None
 	allgoodservers = []
+	book.goodsources = []
 
-	for i, server in enumerate(args.server):
+	for i, server in enumerate(book.server):
 		logging.debug("Lookup up {0}".format(server))
 		try:
-			ret = lookuponserver(server)
+			ret = lookuponserver(book, server)
 			server, url, pages, firstpagedownloaded = ret
 			logging.debug("Result of lookup: {}".format(ret))
 
 			if (firstpagedownloaded == True):
 				allgoodservers.append(server)
+				book.goodsources.append(ret)
 
 			if (firstpagedownloaded == True and goodserver == None):
 				goodserver = ret
@@ -339,137 +871,592 @@ def lookup():
 			# If we have found a "good" server, and this command is chained
 			# with --download, we are simply going to use the first good server,
 			# so there is no point interrogating the remainder of the servers
-			if (args.download == True):
+			# (unless --multi-source will download from all of them). With
+			# hedged requests the others are looked up in the background.
+			if (book.download == True and book.multi_source == False and goodserver != None):
 				logging.debug("Found one good server and --download was specified. Bailing out of lookup() early.")
+				if (hedgedlookup(book) == True):
+					thread = threading.Thread(target=lookupremaining, args=(book, book.server[i+1:]))
+					thread.daemon = True
+					thread.start()
 				break
 		except Exception as exception:
 			printexception(exception)
 			pass
 
-	if (args.download != True):
+	if (book.download != True):
 		logging.info ("Servers that host this book are: {}".format(allgoodservers))
 
 	return goodserver
 
-def getbookproperty(tree, key):
-	logging.debug("Looking up book property {0}".format(key))
-	value = None
+# guards the handover of --lookup-parallel results to the background
+lookuplock = threading.Lock()
 
-	#  <tr>
-	#    <td bgcolor="#DDDDDD"><div align="center"><strong><font face="Arial size="2", Helvetica, sans-serif">Author1</font></strong></div></td>
-	#    <td bgcolor="#E8EEF7"><div align="center"><font face="Arial  size="2", Helvetica, sans-serif">111</font></div></td>
-	#  </tr>
-	#
-	# The properties are in snippets like the one above
-	# Look for the key in text wrapped by font, and walk up 4 levels to tr (strong, div, td, tr)
-	# Then walk down from tr to td/div/font, and return the value in that node
+def hedgedlookup(book):
+	# --download from one server still wants the other servers that host
+	# the book when --hedge-percentile may send requests to them
+	return (book.download == True and book.multi_source == False and book.download_tool == 'native' and book.hedge_percentile > 0)
+
+def lookupremaining(book, servers):
+	# look up the servers after the one --download uses, adding those that
+	# pass to book.goodsources while the download runs (see hedgedlookup())
+	for i, server in enumerate(servers):
+		try:
+			ret = lookuponserver(book, server, True)
+		except Exception as exception:
+			printexception(exception)
+			continue
+		if (ret != None and ret[3] == True):
+			logging.debug("server [{}] takes hedged requests".format(server))
+			book.goodsources.append(ret)
+
+def lookupparallel(book):
+	logging.debug("Enter lookupparallel()")
+
+	# Query every server on its own thread. With --download, the first server
+	# that passes the first page check wins and the remaining lookups are
+	# cancelled, or with hedged requests left to add the servers that pass
+	# to book.goodsources while the download runs. Otherwise (or with
+	# --multi-source) wait for all of them to collect every hosting server.
+	book.lookupcancelled.clear()
+	results = Queue.Queue()
+	background = []
+
+	def lookupworker(server):
+		ret = None
+		try:
+			ret = lookuponserver(book, server)
+		except Exception as exception:
+			printexception(exception)
+		with lookuplock:
+			if (len(background) == 0):
+				results.put((server, ret))
+			elif (ret != None and ret[3] == True):
+				logging.debug("server [{}] takes hedged requests".format(server))
+				book.goodsources.append(ret)
+
+	for i, server in enumerate(book.server):
+		logging.debug("Starting lookup thread for {0}".format(server))
+		thread = threading.Thread(target=lookupworker, args=(server,))
+		thread.daemon = True
+		thread.start()
+
+	goodserver = None
+	goodresults = {}
+
+	pending = len(book.server)
+	while (pending > 0):
+		# get() with a timeout so that Ctrl-C is not blocked
+		try:
+			server, ret = results.get(True, 1)
+		except Queue.Empty:
+			continue
+		pending -= 1
+
+		logging.debug("Result of lookup: {}".format(ret))
+		if (ret == None):
+			continue
+
+		server, url, pages, firstpagedownloaded = ret
+		if (firstpagedownloaded == True):
+			goodresults[server] = ret
+			if (goodserver == None):
+				goodserver = ret
 
+			if (book.download == True and book.multi_source == False):
+				if (hedgedlookup(book) == True):
+					logging.debug("Found one good server and --download was specified. Leaving {} outstanding lookups to the background.".format(pending))
+					with lookuplock:
+						background.append(True)
+					break
+				logging.debug("Found one good server and --download was specified. Cancelling {} outstanding lookups.".format(pending))
+				book.lookupcancelled.set()
+				break
+
+	# report the hosting servers in the order in which they were specified;
+	# results that arrived before the lookups were left to the background
+	with lookuplock:
+		while (not results.empty()):
+			server, ret = results.get()
+			if (ret != None and ret[3] == True):
+				goodresults[server] = ret
+		allgoodservers = [server for server in book.server if server in goodresults]
+		book.goodsources = [goodresults[server] for server in allgoodservers]
+	logging.debug("Allgoodservers: {}".format(allgoodservers))
+
+	if (book.download != True):
+		logging.info ("Servers that host this book are: {}".format(allgoodservers))
+
+	return goodserver
+
+def applybookproperties(book, properties):
+	propertiesdict = dict(properties)
+	if (book.no_title_in_pdf_name != True and "Title" in propertiesdict):
+		title = propertiesdict["Title"]
+		if (isinstance(title, unicode)):
+			title = title.encode('utf-8')
+		book.pdf_name = "{0}_{1}.pdf".format(title.replace(' ', '_'), book.barcode)
+		logging.debug("Setting --pdf-name to {0}".format(book.pdf_name))
+
+	if "Title" in propertiesdict:
+		logging.info('    Title: {0}'.format(propertiesdict["Title"]))
+	if "Author1" in propertiesdict:
+		logging.info('    Author: {0}'.format(propertiesdict["Author1"]))
+
+
+def writejson(filename, data):
+	# write to a temporary file and rename it over filename,
+	# so that readers never see a partially written file
+	tempname = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.current_thread().ident)
+	with open(tempname, 'wb') as filestream:
+		json.dump(data, filestream, sort_keys=True)
+	if (sys.platform == 'win32' and os.path.exists(filename)):
+		os.remove(filename)
+	os.rename(tempname, filename)
+
+
+def readjson(filename, default):
+	if (not os.path.exists(filename)):
+		return default
 	try:
-		format = "//*/font[text()='{}']/../../../../td/div/font[text()]".format(key)
-		node = tree.xpath(format)
-		value = node[0].text
-	except:
-		logging.debug("Error obtain value of key {0}".format(key))
+		with open(filename, 'rb') as filestream:
+			return json.load(filestream)
+	except ValueError as exception:
+		logging.warning("Ignoring unreadable file {}".format(filename))
+		printexception(exception)
+		return default
+
+
+class LookupCache(object):
+	# On-disk cache of lookup results in --cache-dir/lookup.json, keyed by barcode.
+	# Each entry holds the (server, url, pages) of every server that passed the
+	# first page check, the servers that were queried and the book properties.
+	# Entries expire after --cache-ttl hours, and the least recently used ones
+	# are evicted beyond --cache-size entries.
+
+	# serializes the read-modify-write of the cache file between --batch threads
+	lock = threading.Lock()
+
+	def __init__(self):
+		self.filename = os.path.join(args.cache_dir, 'lookup.json')
+
+	def load(self):
+		entries = readjson(self.filename, {})
+		if (not isinstance(entries, dict)):
+			entries = {}
+		return entries
+
+	def get(self, barcode):
+		with LookupCache.lock:
+			return self.getlocked(barcode)
+
+	def getlocked(self, barcode):
+		entries = self.load()
+		entry = entries.get(str(barcode))
+		if (entry == None):
+			return None
+
+		if (time.time() - entry['created'] > args.cache_ttl * 3600):
+			logging.debug("Cached lookup of {} has expired".format(barcode))
+			return None
+
+		entry['accessed'] = time.time()
+		self.save(entries)
+		return entry
+
+	def put(self, barcode, entry):
+		with LookupCache.lock:
+			self.putlocked(barcode, entry)
+
+	def putlocked(self, barcode, entry):
+		# reload before saving to keep entries written by other dli.py processes
+		entries = self.load()
+		now = time.time()
+		entry['created'] = now
+		entry['accessed'] = now
+		entries[str(barcode)] = entry
+		self.save(entries)
+
+	def save(self, entries):
+		now = time.time()
+		for barcode, entry in entries.items():
+			if (now - entry['created'] > args.cache_ttl * 3600):
+				del entries[barcode]
+
+		if (len(entries) > args.cache_size):
+			byaccess = sorted(entries.keys(), key=lambda barcode: entries[barcode]['accessed'])
+			for i, barcode in enumerate(byaccess[:len(entries) - args.cache_size]):
+				del entries[barcode]
 
-	logging.debug("Value of property {0} is {1}".format(key, value))
+		try:
+			if (not os.path.exists(args.cache_dir)):
+				os.makedirs(args.cache_dir)
+			writejson(self.filename, entries)
+		except (IOError, OSError) as exception:
+			logging.warning("Unable to write lookup cache {}".format(self.filename))
+			printexception(exception)
 
-	key = key.strip()
-	if (value != None):
-		value = value.strip()
 
-	if (value == ''):
-		value = None
+def cachedlookup(book, singleserver=None):
+	# Answer --lookup (or the lookup of singleserver for a plain --download)
+	# from the lookup cache, and query the servers on a miss or --refresh
+
+	# with --download (and without --multi-source) one good server is enough
+	firstonly = (singleserver != None or (book.download == True and book.multi_source == False))
+	queryservers = book.server
+	if (singleserver != None):
+		queryservers = [singleserver]
+
+	cache = None
+	if (book.no_cache == False):
+		cache = LookupCache()
+
+	entry = None
+	if (cache != None and book.refresh == False):
+		entry = cache.get(book.barcode)
+
+	if (entry != None):
+		sources = [(str(server), str(url), str(pages), True) for server, url, pages in entry['sources'] if server in queryservers]
+		sources.sort(key=lambda source: queryservers.index(source[0]))
+		queried = set(entry['queried'])
+		if ((firstonly and len(sources) > 0) or set(queryservers) <= queried):
+			logging.info ("Using cached lookup of book {} (--refresh to look it up again)".format(book.barcode))
+			book.goodsources = sources
+			book.properties = entry['properties']
+			if (book.properties != None):
+				applybookproperties(book, book.properties)
+			for i, source in enumerate(sources):
+				logging.info ('server [{}] shows {} pages at {}'.format(source[0], source[2], source[1]))
+			if (singleserver == None and book.download != True):
+				logging.info ("Servers that host this book are: {}".format([source[0] for source in sources]))
+			if (len(sources) == 0):
+				return None
+			return sources[0]
+
+	book.properties = None
+	if (singleserver != None):
+		goodserver = lookuponserver(book, singleserver)
+		book.goodsources = []
+		if (goodserver != None):
+			book.goodsources = [goodserver]
+	elif (book.lookup_parallel == True):
+		goodserver = lookupparallel(book)
+	else:
+		goodserver = lookup(book)
+
+	# failed lookups are not cached, the servers may be back on the next run
+	if (cache != None and len(book.goodsources) > 0):
+		# a lookup that stopped at the first good server only tells us about that one
+		queried = list(queryservers)
+		if (firstonly == True):
+			queried = [source[0] for source in book.goodsources]
+		entry = {
+			'sources': [list(source[0:3]) for source in book.goodsources],
+			'queried': queried,
+			'properties': book.properties,
+		}
+		cache.put(book.barcode, entry)
 
-	return (key, value)
+	return goodserver
 
 
-def getbookproperties(htmlstring):
-	logging.debug("getbookproperties::enter")
-	if (lxmlpresent == False):
-		return None
+#  <tr>
+#    <td bgcolor="#DDDDDD"><div align="center"><strong><font face="Arial size="2", Helvetica, sans-serif">Author1</font></strong></div></td>
+#    <td bgcolor="#E8EEF7"><div align="center"><font face="Arial  size="2", Helvetica, sans-serif">111</font></div></td>
+#  </tr>
+#
+# The properties are in snippets like the one above: the key is the text of
+# the font inside strong, the value is the text of the next font in the same row.
+# The link to the book follows 'Read Online'.
+# One scan over the page finds the properties, 'Read Online' and the links after it.
+metainfopattern = re.compile(
+	r'<strong>\s*<font[^>]*>(?P<key>[^<]*)</font>\s*</strong>(?:(?!</tr>).)*?<font[^>]*>(?P<value>[^<]*)</font>'
+	r'|(?P<readonline>Read Online)'
+	r'|<a\s[^>]*?href="(?P<href>[^"]*)"',
+	re.IGNORECASE | re.DOTALL)
+
+def havelxml():
+	# lxml is only imported once a page defeats metainfopattern
+	global lxmlpresent
+	global html
+	if (lxmlpresent == None):
+		try:
+			from lxml import html
+			lxmlpresent = True
+		except ImportError:
+			logging.debug("The lxml python module is not present")
+			lxmlpresent = False
+	return lxmlpresent
+
+
+def parsemetainfo(rawhtml):
+	# Returns the book properties as a list of (key, value) pairs and the
+	# 'Read Online' url (None if the page has none) of allmetainfo.cgi
+	from HTMLParser import HTMLParser
+	htmlparser = HTMLParser()
+	properties = []
+	readonline = False
+	links = []
+
+	for match in metainfopattern.finditer(rawhtml):
+		if (match.group('key') != None):
+			key = htmlparser.unescape(match.group('key').decode('utf-8', 'replace')).strip()
+			value = htmlparser.unescape(match.group('value').decode('utf-8', 'replace')).strip()
+			if (key != '' and value != ''):
+				properties.append((key, value))
+		elif (match.group('readonline') != None):
+			readonline = True
+		elif (readonline == True):
+			links.append(match.group('href').replace('&amp;', '&'))
+
+	# lxml copes with markup the pattern does not expect
+	if (len(properties) == 0 and havelxml() == True):
+		properties = getbookpropertiestree(rawhtml)
+
+	# the reader link carries the path of the book, otherwise use the last link
+	readurl = None
+	for i, link in enumerate(links):
+		if ('path1=' in link):
+			readurl = link
+			break
+	if (readurl == None and len(links) > 0):
+		readurl = links[-1]
+
+	# py2 strings keep the rest of the code simple when they are plain ascii
+	for i, (key, value) in enumerate(properties):
+		try:
+			properties[i] = (str(key), str(value))
+		except UnicodeError:
+			pass
 
-	logging.debug("getting book properties")
+	return (properties, readurl)
+
+
+def getbookpropertiestree(htmlstring):
+	# one walk over the table rows with lxml
 	tree = html.fromstring(htmlstring)
 
 	properties = []
-	try:
-		node = tree.xpath("//*/tr/td/div/strong/font")
+	for row in tree.iter('tr'):
+		keys = row.xpath('./td/div/strong/font')
+		values = row.xpath('./td/div/font[text()]')
+		if (len(keys) == 0 or len(values) == 0 or keys[0].text == None):
+			continue
+		key = keys[0].text.strip()
+		value = values[0].text.strip()
+		if (key != '' and value != ''):
+			properties.append((key, value))
 
-		for i, n in enumerate(node):
-			properties.append(n.text)
-	except:
-		logging.debug("Error enumerating keys")
+	return properties
 
-	# properties = ["Title", "Author1", "Subject", "Language", "Barcode", "Year", "Year "]
-	values = []
-	for i, key in enumerate(properties):
-		value = getbookproperty(tree, key)
-		k, v = value
-		if (v != None):
-			values.append(value)
 
-	return values
+def getbookproperties(htmlstring):
+	properties, readurl = parsemetainfo(htmlstring)
+	return properties
 
 
-def lookuponserver(server):
- 	logging.info ("Looking up book {} on {}".format(args.barcode, server))
+def metainfourl(server, barcode):
+	return 'http://' + server + '/cgi-bin/DBscripts/allmetainfo.cgi?barcode=' + str(barcode)
 
-	try:
-		infourl = 'http://' + server + '/cgi-bin/DBscripts/allmetainfo.cgi?barcode=' + str(args.barcode)
 
-		logging.debug("downloading {} with a timeout of {} seconds".format(infourl, args.lookup_timeout))
+def bookurl(server, readurl):
+	# the url of the page images and the page count ('?' if unknown)
+	# from the 'Read Online' link on server
+	parsedurl = urlparse(readurl)
+	parsedquery = parse_qs(parsedurl.query)
 
-		start = time.time()
-		htmlresponse = urllib2.urlopen(infourl, timeout=args.lookup_timeout)
-		rawhtml = htmlresponse.read()
-		end = time.time()
+	# If URL is relative, it's relative to the server we queried
+	netloc = parsedurl.netloc
+	if netloc == '':
+		netloc = server
 
-		html = re.sub('\n', '', rawhtml)
+	# If path is not specified as a query parameter, it's the entire URL
+	if 'path1' in parsedquery:
+		path = parsedquery['path1'][0]
+	else:
+		path = readurl
 
-		# The raw html is too verbose even for --debug. Uncomment when necessary
-		# logging.info (rawhtml)
+	url = 'http://' + netloc + path;
 
-		properties = getbookproperties(rawhtml)
+	pages = '?'
+	if 'last' in parsedquery:
+		pages = parsedquery['last'][0]
 
-		# Find first link after 'Read Online'
-		match = re.search('Read Online.*<a href="([^"]*)', html)
-		readurl = match.group(1)
+	return (url, pages)
+
+
+# bytes of page one requested to check that a server hosts the images
+probesize = 1024
+
+
+def probefirstpage(book, pageurl):
+	# Check that pageurl is a tiff image with a small Range request instead
+	# of downloading the whole page. A server that ignores the Range header
+	# sends the full page, of which only the first bytes are read.
+	request = urllib2.Request(pageurl, headers={'Range': 'bytes=0-{}'.format(probesize - 1)})
+	with serverlimits.hold(urlparse(pageurl).netloc):
+		response = urllib2.urlopen(request, timeout=book.timeout)
+		try:
+			data = response.read(probesize)
+		finally:
+			response.close()
+	return (data[0:4] in ['II*\x00', 'MM\x00*'])
+
+
+def keepfirstpage(book):
+	# page one is downloaded in full during the lookup only when it is
+	# certain to be used: --download from the first server that passes
+	# (not --lookup-parallel, where several servers race for it)
+	if (book.download == False or book.lookup_parallel == True or book.overwrite == True or book.pageshard != None):
+		return False
+	if (book.first > 1 or (book.last != None and book.last < 1)):
+		return False
+	manifest = BookManifest(book.directory, book.manifestname) if os.path.exists(book.directory) else None
+	filename = os.path.join(book.directory, "{0:08d}.tif".format(1))
+	if (manifest != None and manifest.iscomplete(1, filename)):
+		return False
+	if (book.page_store != None and PageStore.contains(book.page_store, book.barcode, 1)):
+		return False
+	if (book.page_archive == True and PageArchive(archivename(book)).contains(1)):
+		return False
+	return True
+
+
+def downloadfirstpage(book, pageurl):
+	# Download page one into the book directory and record it in the
+	# manifest, so that the download stage skips it
+	if (not os.path.exists(book.directory)):
+		logging.debug("Creating directory {}".format(book.directory))
+		os.makedirs(book.directory)
+
+	filename = os.path.join(book.directory, "{0:08d}.tif".format(1))
+	manifest = BookManifest(book.directory, book.manifestname)
+	pool = ConnectionPool(book.timeout)
+
+	def progress(expected, received):
+		manifest.update(1, expected=expected, received=received, status='partial')
+
+	try:
+		with serverlimits.hold(urlparse(pageurl).netloc):
+			fetchpage(pool, pageurl, filename, progress)
+		manifest.update(1, status='complete')
+	finally:
+		manifest.save()
+		pool.closeall()
 
-		logging.debug('url is {}'.format(readurl))
 
-		parsedurl = urlparse(readurl)
-		parsedquery = parse_qs(parsedurl.query)
+# largest page number tried while searching for the last page of a book
+maxpages = 100000
 
-		# If URL is relative, it's relative to the server we queried
-		netloc = parsedurl.netloc
-		if netloc == '':
-			netloc = server
 
-		# If path is not specified as a query parameter, it's the entire URL
-		if 'path1' in parsedquery:
-			path = parsedquery['path1'][0]
+def pageexists(book, url, page):
+	# HEAD request for one page of the book at url. Only 404 means the page
+	# is missing, any other error is raised
+	pageurl = "{0}/PTIFF/{1:08d}.tif".format(url, page)
+	request = urllib2.Request(pageurl)
+	request.get_method = lambda: 'HEAD'
+	try:
+		with serverlimits.hold(urlparse(pageurl).netloc):
+			urllib2.urlopen(request, timeout=book.timeout).close()
+		return True
+	except urllib2.HTTPError, e:
+		if (e.code == 404):
+			return False
+		raise
+
+
+def findlastpage(book, url):
+	# Double the page number until a page is missing, then bisect between
+	# the last page found and the missing one: about 2 * log2(pages)
+	# requests. Page one is known to exist. Returns None above maxpages.
+	present = 1
+	missing = 2
+	while (pageexists(book, url, missing)):
+		present = missing
+		missing = missing * 2
+		if (missing > maxpages):
+			return None
+
+	while (missing - present > 1):
+		middle = (present + missing) // 2
+		if (pageexists(book, url, middle)):
+			present = middle
 		else:
-			path = readurl
+			missing = middle
 
-		url = 'http://' + netloc + path;
+	return present
 
-		pages = '?'
-		if 'last' in parsedquery:
-			pages = parsedquery['last'][0]
+
+def checkpages(book, url, pages):
+	# The page count from allmetainfo.cgi is sometimes unknown ('?') and
+	# often one more than the pages on the server, which then fails the
+	# download of the last page. Check the last page with a HEAD request,
+	# and search for the real last page when it is missing or unknown.
+	# Page one, which exists, is checked first, so that a server that
+	# rejects HEAD requests does not cut the book short.
+	try:
+		if (pageexists(book, url, 1) == False):
+			logging.warning("    page 1 is missing to HEAD requests, keeping {} pages".format(pages))
+			return pages
+
+		if (pages.isdigit() and int(pages) > 0):
+			last = int(pages)
+			if (pageexists(book, url, last)):
+				return pages
+			if (last > 1 and pageexists(book, url, last - 1)):
+				logging.info ("    page {} does not exist, the book has {} pages".format(last, last - 1))
+				return str(last - 1)
+
+		start = time.time()
+		last = findlastpage(book, url)
+		if (last == None):
+			logging.warning("    Unable to find the last page, the book has more than {} pages".format(maxpages))
+			return pages
+		logging.info ("    found the last page ({}) in {} seconds".format(last, time.time()-start))
+		return str(last)
+	except (urllib2.URLError, httplib.HTTPException, socket.error) as exception:
+		logging.warning("    Unable to check the number of pages: {}".format(exception))
+		return pages
+
+
+def lookuponserver(book, server, background=False):
+	# background: a lookup that only adds a server for hedged requests
+	# while --download runs, it never downloads page one into the book
+ 	logging.info ("Looking up book {} on {}".format(book.barcode, server))
+
+	stage = 'lookup'
+	try:
+		infourl = metainfourl(server, book.barcode)
+
+		logging.debug("downloading {} with a timeout of {} seconds".format(infourl, book.lookup_timeout))
+
+		with serverlimits.hold(server):
+			start = time.time()
+			htmlresponse = urllib2.urlopen(infourl, timeout=book.lookup_timeout)
+			rawhtml = htmlresponse.read()
+			end = time.time()
+		scoreboard.recordlookup(server, end-start)
+
+		# The raw html is too verbose even for --debug. Uncomment when necessary
+		# logging.info (rawhtml)
+
+		properties, readurl = parsemetainfo(rawhtml)
+		if (readurl == None):
+			logging.warning ("server [{}]: no 'Read Online' link for book {}".format(server, book.barcode))
+			return None
+
+		logging.debug('url is {}'.format(readurl))
+
+		url, pages = bookurl(server, readurl)
 
 		logging.info ('server [%s] shows %s pages at %s in %f seconds' % (server, pages, url, end-start))
 
 		if (properties != None and len(properties) > 0):
+			book.properties = properties
+			applybookproperties(book, properties)
 			propertiesdict = dict(properties)
-			if (args.no_title_in_pdf_name != True):
-				args.pdf_name = "{0}_{1}.pdf".format(propertiesdict["Title"].replace(' ', '_'), args.barcode)
-				logging.debug("Setting --pdf-name to {0}".format(args.pdf_name))
-			pages = propertiesdict["TotalPages"]
-
-			if "Title" in propertiesdict:
-				logging.info('    Title: {0}'.format(propertiesdict["Title"]))
-			if "Author1" in propertiesdict:
-				logging.info('    Author: {0}'.format(propertiesdict["Author1"]))
+			if "TotalPages" in propertiesdict:
+				pages = propertiesdict["TotalPages"]
 
 
 		logging.debug ('book properties: {}'.format(properties))
@@ -477,24 +1464,54 @@ def lookuponserver(server):
 		firstpageurl = "{0}/PTIFF/{1:08d}.tif".format(url, 1)
 		firstpagedownloaded = False
 
+		# another --lookup-parallel thread already found a good server
+		if (book.lookupcancelled.is_set()):
+			logging.debug("server [{}]: lookup cancelled before downloading first page".format(server))
+			return None
+
+		stage = 'firstpage'
 		try:
 			start = time.time()
-			htmlresponse = urllib2.urlopen(firstpageurl, timeout=args.timeout)
-			rawhtml = htmlresponse.read()
-			end = time.time()
+			if (background == False and keepfirstpage(book)):
+				# --download will use this server, so fetch page one into
+				# the book directory instead of downloading it twice
+				downloadfirstpage(book, firstpageurl)
+				end = time.time()
+				scoreboard.recordfirstpage(server, end-start)
+				logging.info ("    page one downloaded successfully in {} seconds".format(end-start))
+			else:
+				if (not probefirstpage(book, firstpageurl)):
+					logging.warning("    First page {} is not a tiff image".format(firstpageurl))
+					return None
+				end = time.time()
+				logging.info ("    page one is available ({} seconds)".format(end-start))
 			firstpagedownloaded = True
-			logging.info ("    page one downloaded successfully in {} seconds".format(end-start))
+
+			# an explicit --last makes the page count irrelevant
+			if (book.last == None):
+				pages = checkpages(book, url, pages)
 			return (server, url, pages, firstpagedownloaded)
 		except urllib2.HTTPError, e:
 			logging.warning("    Error {} downloading first page {}".format(e.code, firstpageurl))
+			if (e.code >= 500):
+				scoreboard.recordfailure(server, stage)
+		except TiffError as exception:
+			logging.warning("    First page {} is not a tiff image ({})".format(firstpageurl, exception))
 		finally:
 			pass
 
 
 	except urllib2.HTTPError, e:
 		logging.warning ("server [{}]: HTTPError ({}) performing lookup".format(server, e.code))
+		if (e.code >= 500):
+			scoreboard.recordfailure(server, stage)
 	except urllib2.URLError, e:
 		logging.warning ("server [{}]: URLError ({}) performing lookup".format(server, e.reason))
+		scoreboard.recordfailure(server, stage)
+	except (httplib.HTTPException, socket.error) as exception:
+		logging.warning ("server [{}]: Error performing lookup: {}" .format(server, exception.__class__.__name__))
+		printexception(exception)
+		scoreboard.recordfailure(server, stage)
 	except Exception as exception:
 		logging.warning ("server [{}]: Error performing lookup: {}" .format(server, exception.__class__.__name__))
 		logging.debug(exception)
@@ -504,143 +1521,3635 @@ def lookuponserver(server):
 
 
 
-def downloadbook(server, url, pages):
+def downloadbook(book, server, url, pages, sources=None):
 
-	logging.debug("downloading {} pages of book {} from {}".format(pages, args.barcode, url))
+	logging.debug("downloading {} pages of book {} from {}".format(pages, book.barcode, url))
 
-	if (args.last == None):
-		args.last = pages
+	if (book.last == None):
+		book.last = pages
 
-	logging.debug("downloading pages {} to {} with {} threads and a timeout of {} seconds to {}".format(args.first, args.last, args.threads, args.timeout, args.directory))
+	logging.debug("downloading pages {} to {} with {} threads and a timeout of {} seconds to {}".format(book.first, book.last, book.threads, book.timeout, book.directory))
 
-	if (args.last == '?'):
+	if (book.last == '?'):
 		logging.error("Error: Unable to determine the number of pages. Specify the --last argument explicitly")
 		sys.exit()
 
-	if (not os.path.exists(args.directory)):
-		logging.debug("Creating directory {}".format(args.directory))
-		os.makedirs(args.directory)
+	if (not os.path.exists(book.directory)):
+		logging.debug("Creating directory {}".format(book.directory))
+		os.makedirs(book.directory)
+	else:
+		logging.debug("Directory {} already exists. Skipping creation.".format(book.directory))
+
+	# --shard of a single book
+	if (book.pageshard != None):
+		shardpages(book)
+
+	if (book.page_archive == True):
+		book.archive = PageArchive(archivename(book, book.pageshard))
+	try:
+		downloadpages(book, server, url, sources)
+	finally:
+		if (book.archive != None):
+			book.archive.close()
+			book.archive = None
+
+
+def downloadpages(book, server, url, sources):
+	# the download of downloadbook(), with book.archive open for --page-archive
+	restorepages(book, book.first, int(book.last))
+
+	pages = range(book.first, int(book.last) + 1)
+	if (book.download_tool == 'native'):
+		if (sources == None):
+			sources = [(server, url)]
+		if (book.stream_pdf == True):
+			book.streamer = PageStreamer(book, book.first, int(book.last))
+		downloadnative(book, sources, pages)
 	else:
-		logging.debug("Directory {} already exists. Skipping creation.".format(args.directory))
+		removeincompletepages(book, book.first, int(book.last))
+		downloadshell(book, url, pages)
+
+	# broken pages get one more download before the pdf is made
+	# (the native download has already retried the ones it fetched)
+	broken = checkpagefiles(book, pages)
+	if (len(broken) > 0):
+		logging.info ("Downloading {} broken pages again".format(len(broken)))
+		if (book.download_tool == 'native'):
+			downloadnative(book, sources, broken)
+		else:
+			downloadshell(book, url, broken)
+		broken = checkpagefiles(book, broken)
+		if (len(broken) > 0):
+			logging.error("{} pages are still broken and are left out: {}".format(len(broken), broken))
+
+	if (book.archive != None):
+		archivepages(book, pages)
+
+	storepages(book, book.first, int(book.last))
+
 
+def downloadshell(book, url, pages):
+	# download the missing pages with the --download-tool shell pipeline
 	logging.debug("Creating list of urls")
 
+	# only the missing pages: curl would otherwise rewrite pages in place,
+	# and with them the --page-store copies they are linked to
 	allurls = ''
-	for i in range(args.first, int(args.last) + 1):
+	requested = set()
+	for i in pages:
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(i))
+		if (os.path.exists(filename)):
+			if (book.overwrite == False):
+				continue
+			os.remove(filename)
+		elif (book.archive != None and book.overwrite == False and book.archive.contains(i)):
+			continue
 		pageurl = "{0}/PTIFF/{1:08d}.tif".format(url, i)
 		allurls = allurls + pageurl + '\n'
+		requested.add(i)
 
-	urlfilename = "{0}/urls.txt".format(args.directory)
+	urlfilename = "{0}/urls.txt".format(book.directory)
 
 	with open(urlfilename, "wb") as filestream:
 		filestream.write(allurls)
 
-	logging.info ("Downloading files with {}".format(args.download_tool))
+	logging.info ("Downloading files with {}".format(book.download_tool))
 
-	if(args.download_tool == 'aria'):
-		cmd = "aria2c -i urls.txt -x {0} --auto-file-renaming=false -l {1} >> ../{1} 2>> ../{1}".format(args.threads, args.log_file)
-	elif (args.download_tool == 'wget'):
+	if(book.download_tool == 'aria'):
+		cmd = "aria2c -i urls.txt -x {0} --auto-file-renaming=false -l {1} >> ../{1} 2>> ../{1}".format(book.threads, book.log_file)
+	elif (book.download_tool == 'wget'):
 		if (sys.platform == 'win32'):
 			# xargs -P doesn't seem to work on windows, so
-			cmd = "wget -T {0} -i urls.txt -nc -nd --no-verbose >> ../{1} 2>> ../{1}".format(args.timeout, args.log_file)
+			cmd = "wget -T {0} -i urls.txt -nc -nd --no-verbose >> ../{1} 2>> ../{1}".format(book.timeout, book.log_file)
 		else:
-			cmd = "cat urls.txt | xargs -n 1 -P {0} wget -T {1} -nc -nd --no-verbose >> ../{2} 2>> ../{2}".format(args.threads, args.timeout, args.log_file, args.log_file)
-	elif (args.download_tool == 'curl'):
-		cmd = "cat urls.txt | xargs -I % -n 1 -P {0} sh -c 'curl -sS -O % >> ../{1} 2>> ../{1}'".format(args.threads, args.log_file)
+			cmd = "cat urls.txt | xargs -n 1 -P {0} wget -T {1} -nc -nd --no-verbose >> ../{2} 2>> ../{2}".format(book.threads, book.timeout, book.log_file, book.log_file)
+	elif (book.download_tool == 'curl'):
+		cmd = "cat urls.txt | xargs -I % -n 1 -P {0} sh -c 'curl -sS -O % >> ../{1} 2>> ../{1}'".format(book.threads, book.log_file)
 
 	logging.debug("cmd: {}".format(cmd))
-	subprocess.call(cmd, shell=True, cwd=args.directory)
+	subprocess.call(cmd, shell=True, cwd=book.directory)
+
+	tifCount = len(glob.glob1(book.directory, "*.tif"))
+	logging.info ("Download script completed ... {} pages present in directory '{}'".format(tifCount, book.directory))
+
+	# the shell tools report no timings, only what ended up on disk
+	for i in pages:
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(i))
+		size = 0
+		if (os.path.exists(filename)):
+			size = os.path.getsize(filename)
+		elif (book.archive != None and book.archive.contains(i)):
+			size = book.archive.size(i)
+		if (not i in requested):
+			metrics.recordpage(book.barcode, i, None, size, None, 0, 'present')
+		elif (size > 0):
+			metrics.recordpage(book.barcode, i, urlparse(url).netloc, size, None, None, 'downloaded')
+		else:
+			metrics.recordpage(book.barcode, i, urlparse(url).netloc, 0, None, None, 'failed')
+
+
+# outcome of downloading a single page with --download-tool native
+PageResult = collections.namedtuple('PageResult', 'page ok size seconds error server')
+
+# number of attempts for each page with --download-tool native
+pageattempts = 3
+
+
+class ConnectionPool(object):
+	# Idle keep-alive HTTP connections, pooled per host, so that consecutive
+	# pages fetched from the same server reuse the TCP connection
+
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.idle = {}
+
+	def get(self, host):
+		with self.lock:
+			connections = self.idle.get(host)
+			if (connections):
+				return connections.pop()
+		return httplib.HTTPConnection(host, timeout=self.timeout)
+
+	def put(self, host, connection):
+		with self.lock:
+			self.idle.setdefault(host, []).append(connection)
+
+	def closeall(self):
+		with self.lock:
+			for host, connections in self.idle.items():
+				for connection in connections:
+					connection.close()
+			self.idle = {}
+
+
+class PageTransfer(object):
+	# A fetchpage() in progress, which another thread can cancel: shutting
+	# down the socket wakes up the blocked read, and fetchpage() then raises
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.connection = None
+		self.cancelled = False
+
+	def attach(self, connection):
+		with self.lock:
+			if (self.cancelled == True):
+				raise httplib.HTTPException("transfer cancelled")
+			self.connection = connection
+
+	def detach(self):
+		with self.lock:
+			self.connection = None
+			return self.cancelled
+
+	def cancel(self):
+		with self.lock:
+			self.cancelled = True
+			if (self.connection != None and self.connection.sock != None):
+				try:
+					self.connection.sock.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					pass
+
+
+def fetchpage(pool, pageurl, filename, progress, transfer=None):
+	# Download pageurl into filename over a pooled connection.
+	# The page is written to filename.part and renamed once complete, so an
+	# interrupted download never leaves a truncated page behind. A .part file
+	# left over from an earlier attempt is continued with an HTTP Range request.
+	# progress(expected, received) is called once the length of the page is
+	# known and again when the transfer ends, successfully or not.
+	# transfer (a PageTransfer) allows another thread to cancel the download.
+	# Returns the number of bytes received, raises on failure, and raises
+	# TiffError when what was received is not a usable tiff (see checktiff).
+
+	parsedurl = urlparse(pageurl)
+	host = parsedurl.netloc
+	partname = filename + '.part'
+
+	offset = 0
+	if (os.path.exists(partname)):
+		offset = os.path.getsize(partname)
+
+	headers = {}
+	if (offset > 0):
+		headers['Range'] = 'bytes={}-'.format(offset)
+
+	connection = pool.get(host)
+
+	try:
+		if (transfer != None):
+			transfer.attach(connection)
+		connection.request('GET', parsedurl.path, headers=headers)
+		response = connection.getresponse()
+
+		length = response.getheader('content-length')
+		if (response.status == 206 and offset > 0):
+			mode = 'ab'
+			# Content-Range: bytes 1000-4999/5000
+			expected = None
+			contentrange = response.getheader('content-range', '')
+			match = re.match('bytes\s+(\d+)-\d+/(\d+)', contentrange)
+			if (match != None and int(match.group(1)) == offset):
+				expected = int(match.group(2))
+			elif (length != None):
+				expected = offset + int(length)
+			if (match != None and int(match.group(1)) != offset):
+				response.read()
+				os.remove(partname)
+				raise httplib.HTTPException("unexpected Content-Range '{}'".format(contentrange))
+			logging.debug("resuming {} at byte {} of {}".format(pageurl, offset, expected))
+		elif (response.status == 200):
+			# the server ignored the Range header, start over
+			mode = 'wb'
+			offset = 0
+			expected = None
+			if (length != None):
+				expected = int(length)
+		else:
+			response.read()
+			if (response.status == 416 and offset > 0):
+				# the leftover .part file is unusable, start over on the next attempt
+				os.remove(partname)
+			raise urllib2.HTTPError(pageurl, response.status, response.reason, response.msg, None)
+
+		progress(expected, offset)
+
+		received = offset
+		try:
+			with open(partname, mode) as filestream:
+				while True:
+					chunk = response.read(65536)
+					if (not chunk):
+						break
+					if (transfer != None and transfer.cancelled == True):
+						raise httplib.HTTPException("transfer cancelled")
+					filestream.write(chunk)
+					received += len(chunk)
+		finally:
+			progress(expected, received)
+
+		if (expected != None and received != expected):
+			raise httplib.IncompleteRead('', expected - received)
+
+		# an error page or a broken image never becomes the page
+		problem, directories = checktiff(partname)
+		if (problem != None):
+			os.remove(partname)
+			raise TiffError(problem)
+
+		if (os.path.exists(filename)):
+			os.remove(filename)
+		os.rename(partname, filename)
+	except:
+		if (transfer != None):
+			transfer.detach()
+		connection.close()
+		raise
+
+	# a connection that was shut down by cancel() cannot be reused
+	cancelled = False
+	if (transfer != None):
+		cancelled = transfer.detach()
+
+	if (response.will_close or cancelled):
+		connection.close()
+	else:
+		pool.put(host, connection)
+
+	return received - offset
+
+
+# name of the per-book manifest in the download directory
+manifestname = 'manifest.json'
+
+
+class BookManifest(object):
+	# Records each page's expected length, received bytes and status
+	# (complete|partial|failed) in the book directory, so that a rerun only
+	# fetches the pages that are missing or incomplete.
+	# Saves are atomic (write and rename) and throttled to one per second.
+
+	def __init__(self, directory, name=manifestname):
+		self.filename = os.path.join(directory, name)
+		self.lock = threading.Lock()
+		self.pages = {}
+		# the pages of a --shard: index, count, first, last
+		self.shard = None
+		self.dirty = False
+		self.saved = 0
+
+		if (os.path.exists(self.filename)):
+			try:
+				with open(self.filename, 'rb') as filestream:
+					manifest = json.load(filestream)
+				self.pages = manifest['pages']
+				self.shard = manifest.get('shard')
+				logging.debug("Loaded manifest {} ({} pages)".format(self.filename, len(self.pages)))
+			except (ValueError, KeyError, TypeError) as exception:
+				logging.warning("Ignoring unreadable manifest {}".format(self.filename))
+				printexception(exception)
+
+	def get(self, page):
+		with self.lock:
+			entry = self.pages.get(str(page))
+			if (entry != None):
+				entry = dict(entry)
+			return entry
+
+	def update(self, page, **fields):
+		with self.lock:
+			entry = self.pages.setdefault(str(page), {'expected': None, 'received': 0, 'status': 'missing'})
+			entry.update(fields)
+			self.dirty = True
+		self.save(force=False)
+
+	def iscomplete(self, page, filename):
+		entry = self.get(page)
+		if (entry == None or entry['status'] != 'complete' or not os.path.exists(filename)):
+			return False
+		return (entry['expected'] == None or os.path.getsize(filename) == entry['expected'])
+
+	def save(self, force=True):
+		with self.lock:
+			if (self.dirty == False):
+				return
+			if (force == False and time.time() - self.saved < 1):
+				return
+
+			manifest = {'pages': self.pages}
+			if (self.shard != None):
+				manifest['shard'] = self.shard
+			writejson(self.filename, manifest)
+
+			self.dirty = False
+			self.saved = time.time()
+
+
+def removeincompletepages(book, first, last):
+	# The shell download tools skip any page file that exists (wget -nc),
+	# so remove the pages that the manifest knows to be incomplete
+	manifest = BookManifest(book.directory, book.manifestname)
+	for page in range(first, last + 1):
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+		entry = manifest.get(page)
+		if (entry != None and os.path.exists(filename) and not manifest.iscomplete(page, filename)):
+			logging.debug("Removing incomplete page {}".format(filename))
+			os.remove(filename)
+
+
+def shardmanifestname(shard):
+	return "manifest-{}-of-{}.json".format(*shard)
+
+
+def shardrange(first, last, index, count):
+	# the index-th (from 1) of count contiguous, nearly equal ranges of the
+	# pages first to last; empty (last < first) when there are more shards
+	# than pages
+	pages = last - first + 1
+	return (first + (index - 1) * pages // count, first + index * pages // count - 1)
+
+
+def shardpages(book):
+	# narrow the download to the pages of the --shard, and record them in
+	# its manifest for mergeshards()
+	index, count = book.pageshard
+	first, last = shardrange(book.first, int(book.last), index, count)
+	manifest = BookManifest(book.directory, book.manifestname)
+	manifest.shard = {'index': index, 'count': count, 'first': first, 'last': last, 'bookfirst': book.first, 'booklast': int(book.last)}
+	manifest.dirty = True
+	manifest.save()
+
+	logging.info ("Shard {}/{}: pages {} to {} of {} to {}".format(index, count, first, last, book.first, book.last))
+	book.first = first
+	book.last = last
+
+
+def mergeshards(book):
+	# --merge: every shard of the book must have run, and every page of the
+	# book must be in its directory (and a usable tiff) or in a shard's
+	# --page-archive. Otherwise the shards that still miss pages are named
+	# and no pdf is made.
+	shards = {}
+	if (os.path.exists(book.directory)):
+		for i, name in enumerate(glob.glob1(book.directory, shardmanifestname(('*', '*')))):
+			shard = BookManifest(book.directory, name).shard
+			if (isinstance(shard, dict) and name == shardmanifestname((shard['index'], shard['count']))):
+				shards[(shard['index'], shard['count'])] = shard
+
+	counts = set([count for index, count in shards])
+	if (len(counts) != 1):
+		logging.error("Error: found {} shards of book {} in '{}'".format("no" if len(counts) == 0 else "differently numbered", book.barcode, book.directory))
+		sys.exit(-1)
+	count = counts.pop()
+	notstarted = [index for index in range(1, count + 1) if not (index, count) in shards]
+	if (len(notstarted) > 0):
+		logging.error("Error: {} of {} shards have not been run: {}".format(len(notstarted), count, ', '.join([str(index) for index in notstarted])))
+		sys.exit(-1)
+
+	book.shardcount = count
+	first = min([shard['bookfirst'] for shard in shards.values()])
+	last = max([shard['booklast'] for shard in shards.values()])
+	archives = []
+	if (book.page_archive == True):
+		archives = [PageArchive(name) for name in archivenames(book)]
+
+	missing = []
+	for page in range(first, last + 1):
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+		if (os.path.exists(filename)):
+			problem, directories = checktiff(filename)
+			if (problem == None):
+				continue
+			logging.warning("    page {} is not a usable tiff: {}".format(page, problem))
+		elif (True in [archive.contains(page) for archive in archives]):
+			continue
+		missing.append(page)
+	for i, archive in enumerate(archives):
+		archive.close()
+
+	if (len(missing) > 0):
+		rerun = sorted(set([shard['index'] for shard in shards.values() for page in missing if shard['first'] <= page <= shard['last']]))
+		logging.error("Error: {} pages of book {} are missing: {}".format(len(missing), book.barcode, missing))
+		if (len(rerun) > 0):
+			logging.error("Run shards {} of {} again before --merge".format(', '.join([str(index) for index in rerun]), count))
+		sys.exit(-1)
+
+	logging.info ("All {} shards of book {} are complete, pages {} to {}".format(count, book.barcode, first, last))
+
+
+def linkfile(source, target):
+	# hardlink where possible, copy across filesystems (and on windows)
+	try:
+		os.link(source, target)
+	except (OSError, AttributeError):
+		shutil.copyfile(source, target)
+
+
+class PageStore(object):
+	# Pages kept across runs and books with --page-store, so that rebuilding
+	# a pdf or retrying a book does not download them again.
+	# Each distinct page is stored once, as objects/<sha1>.tif, and an sqlite
+	# index maps (barcode, page) to its hash and records when each object was
+	# last used. Pages are hardlinked in and out of the book directories, so
+	# deleting the book directory after pdf creation leaves the store intact.
+	# Beyond --page-store-size, the least recently used objects are removed.
+
+	# serializes index updates between --batch threads, which share one
+	# store (and connection) per directory, see shared()
+	lock = threading.Lock()
+	stores = {}
+
+	@staticmethod
+	def shared(directory, maxsize):
+		with PageStore.lock:
+			if (not directory in PageStore.stores):
+				PageStore.stores[directory] = PageStore(directory, maxsize)
+			return PageStore.stores[directory]
+
+	def __init__(self, directory, maxsize):
+		self.directory = directory
+		self.maxsize = maxsize * 1024 * 1024
+		self.objects = os.path.join(directory, 'objects')
+		try:
+			os.makedirs(self.objects)
+		except OSError as exception:
+			# another process created it first
+			if (exception.errno != errno.EEXIST):
+				raise
+
+		import sqlite3
+		self.connection = sqlite3.connect(os.path.join(directory, 'pages.db'), timeout=60, check_same_thread=False)
+		self.connection.executescript('''
+			CREATE TABLE IF NOT EXISTS pages (
+				barcode INTEGER,
+				page INTEGER,
+				hash TEXT,
+				PRIMARY KEY (barcode, page)
+			);
+			CREATE TABLE IF NOT EXISTS objects (
+				hash TEXT PRIMARY KEY,
+				size INTEGER,
+				used REAL
+			);
+			CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash);
+			CREATE INDEX IF NOT EXISTS objects_used ON objects (used);
+		''')
+
+	@staticmethod
+	def contains(directory, barcode, page):
+		filename = os.path.join(directory, 'pages.db')
+		if (not os.path.exists(filename)):
+			return False
+		import sqlite3
+		try:
+			connection = sqlite3.connect(filename, timeout=60)
+			try:
+				row = connection.execute("SELECT hash FROM pages WHERE barcode = ? AND page = ?", (barcode, page)).fetchone()
+			finally:
+				connection.close()
+		except sqlite3.Error:
+			return False
+		return (row != None)
+
+	def objectname(self, digest):
+		return os.path.join(self.objects, digest + '.tif')
+
+	def restore(self, barcode, page, filename):
+		# link the stored page into filename, returns its size or None
+		with PageStore.lock:
+			row = self.connection.execute("SELECT p.hash, o.size FROM pages p JOIN objects o ON o.hash = p.hash WHERE p.barcode = ? AND p.page = ?", (barcode, page)).fetchone()
+			if (row == None):
+				return None
+
+			digest, size = row
+			objectname = self.objectname(digest)
+			if (not os.path.exists(objectname) or os.path.getsize(objectname) != size):
+				logging.debug("Page store object {} is missing, forgetting it".format(objectname))
+				self.forget(digest)
+				return None
+
+			linkfile(objectname, filename)
+			self.connection.execute("UPDATE objects SET used = ? WHERE hash = ?", (time.time(), digest))
+			self.connection.commit()
+			return size
+
+	def add(self, barcode, page, filename):
+		digest = hashlib.sha1()
+		with open(filename, 'rb') as filestream:
+			while True:
+				chunk = filestream.read(1048576)
+				if (not chunk):
+					break
+				digest.update(chunk)
+		digest = digest.hexdigest()
+		size = os.path.getsize(filename)
+
+		with PageStore.lock:
+			objectname = self.objectname(digest)
+			if (not os.path.exists(objectname)):
+				tempname = "{}.{}.tmp".format(objectname, os.getpid())
+				if (os.path.exists(tempname)):
+					os.remove(tempname)
+				linkfile(filename, tempname)
+				os.rename(tempname, objectname)
+
+			self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (barcode, page, digest))
+			self.connection.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (digest, size, time.time()))
+			# every page, so that the books and processes sharing the store
+			# do not wait for the write lock of the database
+			self.connection.commit()
+
+	def forget(self, digest):
+		self.connection.execute("DELETE FROM pages WHERE hash = ?", (digest,))
+		self.connection.execute("DELETE FROM objects WHERE hash = ?", (digest,))
+		self.connection.commit()
+
+	def evict(self):
+		with PageStore.lock:
+			self.connection.commit()
+			total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+			if (total <= self.maxsize):
+				return
+
+			removed = 0
+			for digest, size in self.connection.execute("SELECT hash, size FROM objects ORDER BY used").fetchall():
+				if (total <= self.maxsize):
+					break
+				objectname = self.objectname(digest)
+				if (os.path.exists(objectname)):
+					os.remove(objectname)
+				self.forget(digest)
+				total -= size
+				removed += 1
+			logging.debug("Removed {} pages from the page store, {} bytes remain".format(removed, total))
+
+
+def restorepages(book, first, last):
+	# link the pages of the book that are in the --page-store into the book
+	# directory and mark them complete, so that no download tool fetches them
+	if (book.page_store == None or book.overwrite == True):
+		return
+
+	import sqlite3
+	manifest = BookManifest(book.directory, book.manifestname)
+	restored = 0
+	try:
+		store = PageStore.shared(book.page_store, book.page_store_size)
+		for page in range(first, last + 1):
+			filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+			if (os.path.exists(filename) or (book.archive != None and book.archive.contains(page))):
+				continue
+			size = store.restore(book.barcode, page, filename)
+			if (size == None):
+				continue
+			if (os.path.exists(filename + '.part')):
+				os.remove(filename + '.part')
+			manifest.update(page, expected=size, received=size, status='complete')
+			restored += 1
+	except (IOError, OSError, sqlite3.Error) as exception:
+		logging.warning("Unable to read the page store {}".format(book.page_store))
+		printexception(exception)
+	finally:
+		manifest.save()
+
+	if (restored > 0):
+		logging.info ("{} pages restored from the page store {}".format(restored, book.page_store))
+
+
+def storepages(book, first, last):
+	# add the downloaded pages of the book to the --page-store; pages that do
+	# not parse as a tiff (truncated or error pages) are left out
+	if (book.page_store == None):
+		return
+
+	import sqlite3
+	manifest = BookManifest(book.directory, book.manifestname)
+	stored = 0
+	try:
+		store = PageStore.shared(book.page_store, book.page_store_size)
+		for page in range(first, last + 1):
+			filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+			if (book.archive != None and book.archive.contains(page)):
+				storearchivedpage(store, book, page, filename)
+				stored += 1
+				continue
+			if (not os.path.exists(filename)):
+				continue
+			entry = manifest.get(page)
+			if (entry != None and not manifest.iscomplete(page, filename)):
+				continue
+			try:
+				with open(filename, 'rb') as filestream:
+					TiffPage(filestream.read())
+			except TiffError as exception:
+				logging.debug("Not storing page {}: {}".format(filename, exception))
+				continue
+			store.add(book.barcode, page, filename)
+			stored += 1
+		store.evict()
+	except (IOError, OSError, sqlite3.Error) as exception:
+		logging.warning("Unable to update the page store {}".format(book.page_store))
+		printexception(exception)
+
+	logging.debug("{} pages in the page store {}".format(stored, book.page_store))
+
 
-	tifCount = len(glob.glob1(args.directory, "*.tif"))
-	logging.info ("Download script completed ... {} pages present in directory '{}'".format(tifCount, args.directory))
+def storearchivedpage(store, book, page, filename):
+	# the page store links files, so an archived page goes through a
+	# temporary copy (pages in the archive have already been checked)
+	tempname = filename + '.store'
+	book.archive.extract(page, tempname)
+	try:
+		store.add(book.barcode, page, tempname)
+	finally:
+		os.remove(tempname)
+
+
+def archivename(book, shard=None):
+	# --page-archive: next to the book directory, so that it outlives it.
+	# The page shards of a book append to archives of their own
+	name = os.path.normpath(book.directory)
+	if (shard != None):
+		name += "-{}-of-{}".format(*shard)
+	return name + '.tar'
+
+
+def archivenames(book):
+	# the archives that createpdf() reads
+	if (book.shardcount != None):
+		return [archivename(book, (index, book.shardcount)) for index in range(1, book.shardcount + 1)]
+	return [archivename(book, book.pageshard)]
+
+
+def tarblocks(size):
+	# bytes taken by size bytes of member data, padded to whole tar blocks
+	return (size + 511) // 512 * 512
+
+
+class PageArchive(object):
+	# --page-archive: the pages of a book in one tar file instead of one file
+	# per page. Pages are appended as they arrive, a later copy of a page
+	# replacing an earlier one, and found through an index of page ->
+	# (offset, size) saved next to the archive as [ARCHIVE].idx (atomically
+	# and at most once per second, like the BookManifest). Members written
+	# after the last save are found again by reading the tar headers that
+	# follow the indexed ones, and a member cut short by a crash is
+	# overwritten by the next append.
+	# The pdf stage reads pages as buffers over a memory map of the archive,
+	# so their strips are never copied in memory. Any tar extracts it, so it
+	# is also kept as a compact backup of the tiffs.
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.indexname = filename + '.idx'
+		self.lock = threading.Lock()
+		self.stream = None
+		self.map = None
+		self.pages = {}
+		# offset of the end of archive marker, where the next page goes
+		self.end = 0
+		self.dirty = False
+		self.saved = 0
+
+		if (not os.path.exists(filename)):
+			return
+		self.stream = open(filename, 'r+b')
+
+		index = readjson(self.indexname, None)
+		size = os.path.getsize(filename)
+		try:
+			if (isinstance(index, dict) and index['end'] <= size):
+				self.pages = dict([(int(page), tuple(entry)) for page, entry in index['pages'].items()])
+				self.end = index['end']
+		except (KeyError, TypeError, ValueError) as exception:
+			logging.warning("Ignoring unreadable archive index {}".format(self.indexname))
+			printexception(exception)
+			self.pages = {}
+			self.end = 0
+		with self.lock:
+			self.scan()
+		logging.debug("Opened page archive {} ({} pages)".format(filename, len(self.pages)))
+
+	def scan(self):
+		# index the members after self.end, called with the lock held
+		import tarfile
+		if (self.stream == None):
+			if (not os.path.exists(self.filename)):
+				return
+			self.stream = open(self.filename, 'r+b')
+
+		size = os.fstat(self.stream.fileno()).st_size
+		offset = self.end
+		while (offset + 512 <= size):
+			self.stream.seek(offset)
+			try:
+				info = tarfile.TarInfo.frombuf(self.stream.read(512))
+			except tarfile.HeaderError:
+				break
+			start = offset + 512
+			if (start + info.size > size):
+				break
+			match = re.match('^(\\d{8})\\.tif$', info.name)
+			if (match != None):
+				self.pages[int(match.group(1))] = (start, info.size)
+				self.dirty = True
+			offset = start + tarblocks(info.size)
+		self.end = offset
+
+	def contains(self, page):
+		with self.lock:
+			if (not page in self.pages):
+				self.scan()
+			return (page in self.pages)
+
+	def size(self, page):
+		with self.lock:
+			return self.pages[page][1]
+
+	def append(self, page, filename):
+		import tarfile
+		info = tarfile.TarInfo("{0:08d}.tif".format(page))
+		info.size = os.path.getsize(filename)
+		info.mtime = int(time.time())
+		info.mode = 0644
+
+		with self.lock:
+			if (self.stream == None):
+				self.stream = open(self.filename, 'w+b')
+			self.stream.seek(self.end)
+			self.stream.write(info.tobuf(tarfile.USTAR_FORMAT))
+			with open(filename, 'rb') as filestream:
+				shutil.copyfileobj(filestream, self.stream, 1048576)
+			self.stream.write('\0' * (tarblocks(info.size) - info.size))
+			# the end of archive marker, overwritten by the next page
+			self.stream.write('\0' * 1024)
+			self.stream.truncate()
+			self.stream.flush()
+
+			self.pages[page] = (self.end + 512, info.size)
+			self.end += 512 + tarblocks(info.size)
+			self.dirty = True
+		self.save(force=False)
+
+	def data(self, page):
+		# the page as a buffer over the memory map of the archive, which is
+		# mapped again when it has grown past the page
+		with self.lock:
+			if (not page in self.pages):
+				self.scan()
+			offset, size = self.pages[page]
+			if (self.map == None or len(self.map) < offset + size):
+				self.stream.flush()
+				self.map = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+			return buffer(self.map, offset, size)
+
+	def extract(self, page, filename):
+		data = self.data(page)
+		with open(filename + '.part', 'wb') as filestream:
+			filestream.write(data)
+		if (sys.platform == 'win32' and os.path.exists(filename)):
+			os.remove(filename)
+		os.rename(filename + '.part', filename)
+
+	def save(self, force=True):
+		with self.lock:
+			if (self.dirty == False):
+				return
+			if (force == False and time.time() - self.saved < 1):
+				return
+
+			writejson(self.indexname, {'end': self.end, 'pages': dict([(str(page), entry) for page, entry in self.pages.items()])})
+
+			self.dirty = False
+			self.saved = time.time()
+
+	def close(self):
+		self.save()
+		with self.lock:
+			# buffers returned by data() keep the last map open until they go
+			self.map = None
+			if (self.stream != None):
+				self.stream.close()
+				self.stream = None
+
+
+def archivepages(book, pages):
+	# move the pages left in the book directory by the shell download tools,
+	# the first page check and the page store into the --page-archive
+	moved = 0
+	for i, page in enumerate(pages):
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+		if (not os.path.exists(filename)):
+			continue
+		book.archive.append(page, filename)
+		os.remove(filename)
+		moved += 1
+	book.archive.save()
+	if (moved > 0):
+		logging.debug("Moved {} pages into the page archive {}".format(moved, book.archive.filename))
+
+
+def extractpages(book, archived):
+	# the shell pdf tools need a file per page; archived maps each page to
+	# the PageArchive that holds it
+	for i, page in enumerate(sorted(archived)):
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+		if (not os.path.exists(filename)):
+			archived[page].extract(page, filename)
+	logging.info("Extracted {} pages from the page archive for {}".format(len(archived), book.pdf_tool))
+
+
+# consecutive failures after which a --multi-source server is dropped
+sourcemaxfailures = 3
+
+
+# a response this many times slower than the fastest one from the same
+# server stops the increase of its concurrency
+slowresponsefactor = 4
+
+
+class PageSource(object):
+	# One server/url that hosts the book, with its measured throughput
+	# (bytes per second, exponentially weighted) and failure counts.
+	# PageDownloader uses these to weight page requests across servers.
+	#
+	# The requests in flight to the server are limited by an AIMD window
+	# (additive increase, multiplicative decrease) between 1 and ceiling
+	# (--download-parallel): it grows by one for every window of healthy
+	# responses and halves on a timeout, a reset connection or a 5xx.
+
+	def __init__(self, server, url, ceiling):
+		self.server = server
+		self.url = url
+		self.throughput = None
+		self.inflight = 0
+		self.pages = 0
+		self.bytes = 0
+		self.failures = 0
+		self.consecutivefailures = 0
+		self.disabled = False
+
+		self.ceiling = ceiling
+		self.limit = 1.0
+		self.peak = 1
+		self.fastest = None
+		self.decreased = 0
+		self.decreases = 0
+
+	def hascapacity(self, extra=0):
+		# extra: slots above the limit, PageDownloader.hedger() takes one
+		return (self.inflight < int(self.limit) + extra)
+
+	def increase(self, firstbyte):
+		# firstbyte: seconds until the response headers arrived
+		if (firstbyte != None):
+			if (self.fastest == None or firstbyte < self.fastest):
+				self.fastest = firstbyte
+			if (firstbyte > slowresponsefactor * max(self.fastest, 0.05)):
+				return
+
+		level = int(self.limit)
+		self.limit = min(float(self.ceiling), self.limit + 1.0 / level)
+		if (int(self.limit) > level):
+			self.peak = max(self.peak, int(self.limit))
+			logging.debug("server [{}]: concurrency {} -> {}".format(self.server, level, int(self.limit)))
+
+	def decrease(self, started, reason):
+		# requests that started before the last decrease saw the same
+		# congestion, they do not halve the window again
+		if (started < self.decreased):
+			return
+		self.decreased = time.time()
+
+		level = int(self.limit)
+		self.limit = max(1.0, self.limit / 2)
+		self.decreases += 1
+		logging.debug("server [{}]: {}, concurrency {} -> {}".format(self.server, reason, level, int(self.limit)))
+
+	def score(self):
+		# servers that have not been measured yet are tried first
+		if (self.throughput == None):
+			return float('inf')
+		return self.throughput / (self.inflight + 1)
+
+	def succeeded(self, size, seconds):
+		self.pages += 1
+		self.bytes += size
+		self.consecutivefailures = 0
+		sample = size / max(seconds, 0.001)
+		if (self.throughput == None):
+			self.throughput = sample
+		else:
+			self.throughput = 0.7 * self.throughput + 0.3 * sample
+
+	def failed(self, others):
+		# others: the enabled servers besides this one. The last one is
+		# never dropped, its pages keep their retries and backoff instead
+		self.failures += 1
+		self.consecutivefailures += 1
+		if (self.consecutivefailures >= sourcemaxfailures and others > 0):
+			self.disabled = True
+
+
+# pages that must finish before --hedge-percentile applies
+hedgeminsamples = 10
+
+
+def percentile(values, percent):
+	# nearest rank percentile of a non-empty list
+	values = sorted(values)
+	index = int(round(percent / 100.0 * (len(values) - 1)))
+	return values[min(max(index, 0), len(values) - 1)]
+
+
+class PageAttempt(object):
+	# A request for a page that PageDownloader.hedger() may duplicate.
+	# winner records which request finished first: 'primary' or 'hedge'.
+
+	def __init__(self, page, source, started):
+		self.page = page
+		self.source = source
+		self.started = started
+		self.transfer = PageTransfer()
+		self.hedge = None
+		self.hedgedone = threading.Event()
+		self.winner = None
+		self.winnersource = None
+		self.size = 0
+
+
+class PageDownloader(object):
+	# In-process replacement for the wget/curl/aria2c shell pipelines.
+	# A fixed pool of threads pulls page numbers from a queue and fetches
+	# them over keep-alive connections; every page reports a PageResult
+	# and its progress is recorded in the BookManifest.
+	# With several sources, each page goes to the server with the best
+	# throughput per in-flight request, and a server that keeps failing
+	# is dropped so its pages move to the others.
+	# Each server takes at most its adaptive concurrency limit of requests
+	# (see PageSource); the other threads wait for a free slot.
+	# A page that takes longer than --hedge-percentile of the pages so far
+	# gets a duplicate request, preferably to another server that hosts the
+	# book (hedgesources). The first to finish wins, the other is cancelled.
+	# hedgesources are the other servers in book.goodsources, which the
+	# lookup keeps adding to in the background while the download runs
+	# (see hedgedlookup()). A duplicate may take one slot above the
+	# concurrency limit of its server, which the page requests fill.
+
+	def __init__(self, book, sources, pages):
+		self.book = book
+		self.sources = [PageSource(server, url, book.threads) for server, url in sources]
+		self.hedgesources = list(self.sources)
+		self.addhedgesources()
+		self.pages = pages
+		self.directory = self.book.directory
+		self.pool = ConnectionPool(book.timeout)
+		self.manifest = BookManifest(book.directory, book.manifestname)
+		self.archive = book.archive
+		self.queue = Queue.Queue()
+		self.lock = threading.Lock()
+		self.available = threading.Condition(self.lock)
+		self.results = {}
+
+		# seconds taken by each page, and the requests that hedger() watches
+		self.latencies = []
+		self.attempts = {}
+		self.finished = threading.Event()
+		self.hedged = 0
+		self.hedgeswon = 0
+
+		# called with (page, ok) as each page finishes, see PageStreamer
+		self.onpage = None
+
+	def pagefilename(self, page):
+		return os.path.join(self.directory, "{0:08d}.tif".format(page))
+
+	def needsdownload(self, page):
+		filename = self.pagefilename(page)
+		partname = filename + '.part'
+		entry = self.manifest.get(page)
+
+		if (self.book.overwrite == True):
+			for name in [filename, partname]:
+				if (os.path.exists(name)):
+					os.remove(name)
+			return True
+
+		# pages in the archive were checked before they were added
+		if (self.archive != None and not os.path.exists(filename) and self.archive.contains(page)):
+			return False
+
+		if (self.manifest.iscomplete(page, filename)):
+			return (self.isusable(page) == False)
+
+		if (os.path.exists(filename)):
+			if (entry == None):
+				# downloaded by another tool, or before manifests existed
+				if (self.isusable(page) == False):
+					return True
+				self.manifest.update(page, expected=None, received=os.path.getsize(filename), status='complete')
+				return False
+
+			# truncated page, continue it from where it stopped
+			logging.debug("Page {} is incomplete ({} of {} bytes)".format(page, os.path.getsize(filename), entry['expected']))
+			if (os.path.exists(partname)):
+				os.remove(partname)
+			os.rename(filename, partname)
+
+		# a .part file that already has every byte only needs the rename
+		if (entry != None and entry['expected'] != None and os.path.exists(partname)
+			and os.path.getsize(partname) == entry['expected']):
+			os.rename(partname, filename)
+			self.manifest.update(page, received=entry['expected'], status='complete')
+			return False
+
+		return True
+
+	def pagesize(self, page):
+		filename = self.pagefilename(page)
+		if (self.archive != None and not os.path.exists(filename)):
+			return self.archive.size(page)
+		return os.path.getsize(filename)
+
+	def archivepage(self, page):
+		# move a downloaded page into the --page-archive as it arrives; one
+		# that cannot be added stays in the directory for archivepages()
+		filename = self.pagefilename(page)
+		try:
+			self.archive.append(page, filename)
+			os.remove(filename)
+		except (IOError, OSError) as exception:
+			logging.warning("Unable to add page {} to the page archive {}".format(page, self.archive.filename))
+			printexception(exception)
 
+	def isusable(self, page):
+		# a page already on disk that is not a usable tiff is downloaded again
+		filename = self.pagefilename(page)
+		problem, directories = checktiff(filename)
+		if (problem == None):
+			return True
+		logging.warning("    page {} is not a usable tiff ({}), downloading it again".format(page, problem))
+		os.remove(filename)
+		self.manifest.update(page, expected=None, received=0, status='failed')
+		return False
+
+	def choosesource(self, exclude):
+		# pick the best enabled server, preferring ones that have not
+		# already failed this page, and wait while they are all at their
+		# concurrency limit
+		with self.lock:
+			while True:
+				candidates = [source for source in self.sources if not source.disabled]
+				preferred = [source for source in candidates if not source in exclude]
+				if (len(preferred) > 0):
+					candidates = preferred
+				if (len(candidates) == 0):
+					return None
+
+				candidates = [source for source in candidates if source.hascapacity()]
+				if (len(candidates) > 0):
+					break
+				# wait() with a timeout so that Ctrl-C is not blocked
+				self.available.wait(1)
+
+			source = max(candidates, key=lambda source: source.score())
+			source.inflight += 1
+			return source
+
+	def downloadpage(self, page):
+		filename = self.pagefilename(page)
+
+		# time of the first progress() call of the current attempt,
+		# which follows the response headers
+		firstprogress = [None]
+
+		def progress(expected, received):
+			if (firstprogress[0] == None):
+				firstprogress[0] = time.time()
+			self.manifest.update(page, expected=expected, received=received, status='partial')
+
+		start = time.time()
+		error = None
+		server = None
+		failedsources = []
+		for attempt in range(1, pageattempts + len(self.sources)):
+			source = self.choosesource(failedsources)
+			if (source == None):
+				error = "no usable server left"
+				break
 
-def createpdf():
+			server = source.server
+			pageurl = "{0}/PTIFF/{1:08d}.tif".format(source.url, page)
+			attemptstart = time.time()
+			firstprogress[0] = None
+			congestion = None
+			current = PageAttempt(page, source, attemptstart)
+			with self.lock:
+				self.attempts[page] = current
+			try:
+				with serverlimits.hold(urlparse(pageurl).netloc):
+					size = fetchpage(self.pool, pageurl, filename, progress, current.transfer)
+				end = time.time()
+				with self.lock:
+					del self.attempts[page]
+					if (current.winner == None):
+						current.winner = 'primary'
+						if (current.hedge != None):
+							current.hedge.cancel()
+					self.latencies.append(end - attemptstart)
+					source.inflight -= 1
+					source.succeeded(size, end - attemptstart)
+					if (firstprogress[0] != None):
+						source.increase(firstprogress[0] - attemptstart)
+					else:
+						source.increase(None)
+					self.available.notify_all()
+				self.manifest.update(page, status='complete')
+				logging.debug("page {} downloaded from {} ({} bytes in {} seconds, attempt {})".format(page, server, size, end-start, attempt))
+				metrics.recordpage(self.book.barcode, page, server, size, end-start, attempt, 'downloaded')
+				return PageResult(page, True, size, end-start, None, server)
+			except urllib2.HTTPError, e:
+				error = "HTTPError {}".format(e.code)
+				if (e.code >= 500 or e.code == 429):
+					congestion = error
+			except (httplib.HTTPException, socket.error, IOError) as exception:
+				error = "{}: {}".format(exception.__class__.__name__, exception)
+				# timeouts, resets and truncated responses, not local file errors
+				if (isinstance(exception, (httplib.HTTPException, socket.error))):
+					congestion = exception.__class__.__name__
+			except TiffError as exception:
+				error = "not a usable tiff: {}".format(exception)
+
+			# no new hedge once the attempt is removed, wait for a running one
+			with self.lock:
+				del self.attempts[page]
+				hedge = current.hedge
+			if (hedge != None):
+				while (not current.hedgedone.wait(1)):
+					pass
+
+			if (current.winner == 'hedge'):
+				# the primary request was cancelled, it did not fail
+				with self.lock:
+					source.inflight -= 1
+					self.available.notify_all()
+				if (os.path.exists(filename + '.part')):
+					os.remove(filename + '.part')
+				self.manifest.update(page, expected=current.size, received=current.size, status='complete')
+				end = time.time()
+				logging.debug("page {} downloaded from {} by a hedged request ({} bytes in {} seconds)".format(page, current.winnersource.server, current.size, end-start))
+				metrics.recordpage(self.book.barcode, page, current.winnersource.server, current.size, end-start, attempt, 'hedged')
+				return PageResult(page, True, current.size, end-start, None, current.winnersource.server)
+
+			with self.lock:
+				source.inflight -= 1
+				wasdisabled = source.disabled
+				source.failed(len([other for other in self.sources if not other.disabled and other != source]))
+				if (congestion != None):
+					source.decrease(attemptstart, congestion)
+				self.available.notify_all()
+				if (source.disabled == True and wasdisabled == False):
+					logging.warning("    server [{}] keeps failing, moving its pages to other servers".format(server))
+			failedsources.append(source)
+			logging.debug("page {} attempt {} on {} failed: {}".format(page, attempt, server, error))
+
+			# a missing page will not appear on a retry of the only server
+			if (error == "HTTPError 404" and len(self.sources) == 1):
+				break
+
+		if (not os.path.exists(filename + '.part')):
+			self.manifest.update(page, received=0, status='failed')
+
+		metrics.recordpage(self.book.barcode, page, server, 0, time.time()-start, attempt, 'failed')
+		return PageResult(page, False, 0, time.time()-start, error, server)
+
+	def addhedgesources(self):
+		# the servers that the lookup found since the last call
+		known = [(source.server, source.url) for source in self.hedgesources]
+		for i, source in enumerate(list(self.book.goodsources)):
+			if (not (source[0], source[1]) in known):
+				logging.debug("server [{}] takes hedged requests".format(source[0]))
+				self.hedgesources.append(PageSource(source[0], source[1], self.book.threads))
+				known.append((source[0], source[1]))
+
+	def choosehedgesource(self, primary):
+		# another enabled server with a free slot, else the same server on a
+		# new connection; a duplicate takes at most one slot above the
+		# concurrency limit, so that hedging never undoes the backoff of a
+		# struggling server
+		candidates = [source for source in self.hedgesources if not source.disabled and source != primary]
+		available = [source for source in candidates if source.hascapacity(1)]
+		if (len(available) > 0):
+			return max(available, key=lambda source: source.score())
+		if (primary.disabled == False and primary.hascapacity(1)):
+			return primary
+		return None
+
+	def hedger(self):
+		# duplicate the requests that have taken longer than
+		# --hedge-percentile of the pages downloaded so far
+		while (not self.finished.wait(0.1)):
+			with self.lock:
+				self.addhedgesources()
+				if (len(self.latencies) < hedgeminsamples):
+					continue
+				threshold = percentile(self.latencies, self.book.hedge_percentile)
+				now = time.time()
+				for page, current in self.attempts.items():
+					if (current.hedge != None or current.winner != None or now - current.started < threshold):
+						continue
+					source = self.choosehedgesource(current.source)
+					if (source == None):
+						continue
+					logging.debug("page {} on {} is slower than {} seconds, hedging on {}".format(page, current.source.server, threshold, source.server))
+					current.hedge = PageTransfer()
+					source.inflight += 1
+					self.hedged += 1
+					thread = threading.Thread(target=self.hedgepage, args=(current, source))
+					thread.daemon = True
+					thread.start()
+
+	def hedgepage(self, current, source):
+		# the duplicate request of current, into a file of its own
+		filename = self.pagefilename(current.page)
+		hedgename = filename + '.hedge'
+		pageurl = "{0}/PTIFF/{1:08d}.tif".format(source.url, current.page)
+		try:
+			if (os.path.exists(hedgename + '.part')):
+				os.remove(hedgename + '.part')
+			start = time.time()
+			with serverlimits.hold(urlparse(pageurl).netloc):
+				size = fetchpage(self.pool, pageurl, hedgename, lambda expected, received: None, current.hedge)
+			end = time.time()
+
+			with self.lock:
+				source.inflight -= 1
+				source.succeeded(size, end - start)
+				self.available.notify_all()
+				if (current.winner == None):
+					if (sys.platform == 'win32' and os.path.exists(filename)):
+						os.remove(filename)
+					os.rename(hedgename, filename)
+					current.winner = 'hedge'
+					current.winnersource = source
+					current.size = size
+					self.hedgeswon += 1
+					current.transfer.cancel()
+		except (urllib2.HTTPError, httplib.HTTPException, socket.error, IOError, OSError, TiffError) as exception:
+			logging.debug("hedged request for page {} on {} ended: {}".format(current.page, source.server, exception))
+			with self.lock:
+				source.inflight -= 1
+				self.available.notify_all()
+		finally:
+			for name in [hedgename, hedgename + '.part']:
+				if (os.path.exists(name)):
+					os.remove(name)
+			current.hedgedone.set()
+
+	def worker(self):
+		while True:
+			try:
+				page = self.queue.get_nowait()
+			except Queue.Empty:
+				return
+
+			try:
+				result = self.downloadpage(page)
+				if (result.ok and self.archive != None):
+					self.archivepage(page)
+			except Exception as exception:
+				printexception(exception)
+				result = PageResult(page, False, 0, 0, exception.__class__.__name__, None)
+				metrics.recordpage(self.book.barcode, page, None, 0, None, None, 'failed')
+
+			with self.lock:
+				self.results[page] = result
+
+			if (self.onpage != None):
+				self.onpage(page, result.ok)
+
+	def run(self):
+		for i, page in enumerate(self.pages):
+			if (self.needsdownload(page) == False):
+				self.results[page] = PageResult(page, True, 0, 0, 'present', None)
+				metrics.recordpage(self.book.barcode, page, None, self.pagesize(page), None, 0, 'present')
+				if (self.onpage != None):
+					self.onpage(page, True)
+				continue
+			self.queue.put(page)
+
+		# --download-parallel applies to each server
+		workers = []
+		for i in range(min(self.book.threads * len(self.sources), self.queue.qsize())):
+			thread = threading.Thread(target=self.worker)
+			thread.daemon = True
+			thread.start()
+			workers.append(thread)
+
+		hedger = None
+		if (self.book.hedge_percentile > 0 and len(workers) > 0):
+			hedger = threading.Thread(target=self.hedger)
+			hedger.daemon = True
+			hedger.start()
+
+		# join() with a timeout so that Ctrl-C is not blocked
+		try:
+			for i, thread in enumerate(workers):
+				while thread.is_alive():
+					thread.join(1)
+		finally:
+			self.finished.set()
+			if (hedger != None):
+				while hedger.is_alive():
+					hedger.join(1)
+			self.manifest.save()
+			self.pool.closeall()
 
-	pdfdirectory = "{0}-temp-pdf".format(args.directory)
+		return self.results
 
-	if (not os.path.exists(pdfdirectory)) and (args.pdf_tool != 'tiff2pdf'):
+
+def downloadnative(book, sources, pages):
+	logging.debug("downloading {} pages natively from {} with {} threads".format(len(pages), [server for server, url in sources], book.threads))
+
+	start = time.time()
+	# the other servers found by the lookup take hedged requests
+	downloader = PageDownloader(book, sources, pages)
+	if (book.streamer != None):
+		downloader.onpage = book.streamer.arrived
+	results = downloader.run()
+	end = time.time()
+
+	for i, source in enumerate(downloader.sources):
+		scoreboard.recorddownload(source.server, source.pages, source.failures, source.throughput)
+
+	downloaded = [result for page, result in results.items() if result.ok and result.error == None]
+	failed = sorted([result for page, result in results.items() if not result.ok])
+	size = sum([result.size for result in downloaded])
+
+	for i, result in enumerate(failed):
+		logging.warning("    page {} failed: {}".format(result.page, result.error))
+
+	for i, source in enumerate(downloader.sources):
+		logging.info ("    server [{}]: {} pages, {} bytes, {} failures, concurrency {} (peak {} of {}, {} backoffs){}".format(source.server, source.pages, source.bytes, source.failures, int(source.limit), source.peak, source.ceiling, source.decreases, " (dropped)" if source.disabled else ""))
+
+	if (downloader.hedged > 0):
+		logging.info ("    {} slow pages were hedged, {} finished first on the duplicate request".format(downloader.hedged, downloader.hedgeswon))
+
+	logging.info ("Downloaded {} pages ({} bytes) in {} seconds, {} already present, {} failed".format(len(downloaded), size, end-start, len(results) - len(downloaded) - len(failed), len(failed)))
+
+	return results
+
+
+def createpdf(book):
+
+	pdfdirectory = "{0}-temp-pdf".format(book.directory)
+
+	if (not os.path.exists(pdfdirectory)) and (book.pdf_tool in ['gs', 'sips']):
 		logging.debug("Creating temporary directory {}".format(pdfdirectory))
 		os.makedirs(pdfdirectory)
 
-	logging.info("Processing images with {} toolchain".format(args.pdf_tool))
-
-	if (args.pdf_tool == 'tiff2pdf'):
+	logging.info("Processing images with {} toolchain".format(book.pdf_tool))
+
+	# --page-archive: every page from the archive (of the shard) holding it
+	archives = []
+	archived = {}
+	if (book.page_archive == True):
+		archives = [PageArchive(name) for name in archivenames(book)]
+		for i, archive in enumerate(archives):
+			for page in archive.pages:
+				archived[page] = archive
+
+	# native: copy the compressed image data of every page straight into the pdf
+	if (book.pdf_tool == 'native'):
+		writer = PdfWriter(book.pdf_name, book)
+		if (len(archives) > 0):
+			for i, page in enumerate(sorted(archived)):
+				writer.adddata("{0:08d}.tif".format(page), archived[page].data(page))
+		else:
+			for i, filename in enumerate(pagefiles(book.directory)):
+				writer.addpage(filename)
+		writer.close()
+		for i, archive in enumerate(archives):
+			archive.close()
+		finishpdf(book, pdfdirectory)
+		return
+
+	if (len(archives) > 0):
+		if (not os.path.exists(book.directory)):
+			os.makedirs(book.directory)
+		extractpages(book, archived)
+		for i, archive in enumerate(archives):
+			archive.close()
+
+	# cmd_stage0 converts a single page and runs in the download directory
+	# for every page, on --pdf-parallel processes
+	logfile = pipes.quote(os.path.abspath(book.log_file))
+	cmd_stage0 = None
+	cmd_stage1 = None
+	if (book.pdf_tool == 'tiff2pdf'):
 		# stage0: extract the first page of multipage tif files with tiffcrop
 		# stage1: combine all extracted tifs into one multi-page tiff
 		# stage2: convert multi-page tiff to pdf
 
-		cmd_stage0 = "ls *.tif | xargs -I % -n 1 -P 1 sh -c 'tiffcrop -N1 % crop_% >> ../{0} 2>> ../{0}'".format(args.log_file)
-		cmd_stage1 = "tiffcp {0}/crop_*.tif {0}/combined.tif >> {1} 2>> {1}".format(args.directory, args.log_file)
-		cmd_stage2 = "tiff2pdf -o {0} {1}/combined.tif >> {2} 2>> {2}".format(pipes.quote(args.pdf_name), args.directory, args.log_file)
-	elif (args.pdf_tool == 'gs'):
-		# grep stderr for "Load" to output a single line per file being processed
-		# stage1: convert each page to pdf
+		cmd_stage0 = "tiffcrop -N1 {{0}} crop_{{0}} >> {0} 2>> {0}".format(logfile)
+		cmd_stage1 = "tiffcp {0}/crop_*.tif {0}/combined.tif >> {1} 2>> {1}".format(book.directory, book.log_file)
+		cmd_stage2 = "tiff2pdf -o {0} {1}/combined.tif >> {2} 2>> {2}".format(pipes.quote(book.pdf_name), book.directory, book.log_file)
+	elif (book.pdf_tool == 'gs'):
+		# stage0: convert each page to pdf
 		# stage2: combine pdf to multi-page pdf
-		cmd_stage1 = "mogrify -monitor -format pdf -path {0}/ {1}/*.tif >> {2} 2>> {2}".format(pdfdirectory, args.directory, args.log_file)
-		cmd_stage2 = "gs -dBATCH -dNOPAUSE -q -sDEVICE=pdfwrite -sOutputFile={0} {1}/*.pdf >> {2} 2>> {2}".format(pipes.quote(args.pdf_name), pdfdirectory, args.log_file)
-	elif (args.pdf_tool == 'sips'):
-		# stage1: convert each page to pdf
+		cmd_stage0 = "mogrify -monitor -format pdf -path {0}/ {{0}} >> {1} 2>> {1}".format(pipes.quote(os.path.abspath(pdfdirectory)), logfile)
+		cmd_stage2 = "gs -dBATCH -dNOPAUSE -q -sDEVICE=pdfwrite -sOutputFile={0} {1}/*.pdf >> {2} 2>> {2}".format(pipes.quote(book.pdf_name), pdfdirectory, book.log_file)
+	elif (book.pdf_tool == 'sips'):
+		# stage0: convert each page to pdf
 		# stage2: combine pdf to multi-page pdf
-		cmd_stage1 = "sips -s format pdf {0}/*.tif --out {1} >> {2} 2>> {2}".format(args.directory, pdfdirectory, args.log_file)
-		cmd_stage2 = "/System/Library/Automator/Combine\ PDF\ Pages.action/Contents/Resources/join.py -o {0} {1}/*.pdf".format(pipes.quote(args.pdf_name), pdfdirectory)
+		cmd_stage0 = "sips -s format pdf {{0}} --out {0} >> {1} 2>> {1}".format(pipes.quote(os.path.abspath(pdfdirectory)), logfile)
+		cmd_stage2 = "/System/Library/Automator/Combine\ PDF\ Pages.action/Contents/Resources/join.py -o {0} {1}/*.pdf".format(pipes.quote(book.pdf_name), pdfdirectory)
 	else:
-		logging.error("Internal Error: Unknown value {} in args.pdf_tool".process(args.pdf_tool))
+		logging.error("Internal Error: Unknown value {} in book.pdf_tool".format(book.pdf_tool))
 		sys.exit(-1)
 
 
 	if (cmd_stage0 != None):
 		logging.debug("Stage 0: {}".format(cmd_stage0))
-		subprocess.call(cmd_stage0, shell=True, cwd=args.directory)
+		convertpages(book, cmd_stage0)
 
-	logging.debug("Stage 1: {}".format(cmd_stage1))
-	subprocess.call(cmd_stage1, shell=True)
+	if (cmd_stage1 != None):
+		logging.debug("Stage 1: {}".format(cmd_stage1))
+		subprocess.call(cmd_stage1, shell=True)
 
 	logging.debug("Stage 2: {}".format(cmd_stage2))
 	subprocess.call(cmd_stage2, shell=True)
 
-	pdfSize = os.path.getsize(args.pdf_name)
+	finishpdf(book, pdfdirectory)
+
+
+def convertpage(job):
+	# runs on a --pdf-parallel worker, returns the exit code of the command
+	cmd, directory = job
+	return subprocess.call(cmd, shell=True, cwd=directory)
+
+
+def convertpages(book, cmd):
+	# Run cmd (with {0} replaced by the file name) for every page in the
+	# download directory, --pdf-parallel pages at a time. Every page is
+	# converted by its own tool process, so the workers only need to be threads.
+	# Errors are reported in page order.
+	names = [os.path.basename(filename) for filename in pagefiles(book.directory)]
+	jobs = [(cmd.format(pipes.quote(name)), book.directory) for name in names]
+
+	import multiprocessing
+	from multiprocessing.pool import ThreadPool
+	parallel = book.pdf_parallel
+	if (parallel == None):
+		parallel = multiprocessing.cpu_count()
+	logging.debug("Converting {} pages on {} processes".format(len(names), parallel))
+
+	start = time.time()
+	pool = ThreadPool(parallel)
+	try:
+		# get() with a timeout so that Ctrl-C is not blocked
+		codes = pool.map_async(convertpage, jobs).get(365 * 24 * 3600)
+	finally:
+		pool.terminate()
+		pool.join()
+
+	failed = [name for name, code in zip(names, codes) if code != 0]
+	for i, name in enumerate(failed):
+		logging.warning("    converting page {} failed".format(name))
+
+	logging.info("Converted {} pages in {} seconds ({} failed)".format(len(names), time.time() - start, len(failed)))
+	return failed
 
-	logging.info("Created PDF file {} ({} bytes)".format(args.pdf_name, pdfSize))
+
+def finishpdf(book, pdfdirectory):
+	pdfSize = os.path.getsize(book.pdf_name)
+
+	logging.info("Created PDF file {} ({} bytes)".format(book.pdf_name, pdfSize))
 
 	logging.info("")
-	logging.info("Temporary TIFF download directory: '{}'".format(args.directory))
+	logging.info("Temporary TIFF download directory: '{}'".format(book.directory))
 	if (os.path.exists(pdfdirectory)):
 		logging.info("Temporary pdf directory: '{}'".format(pdfdirectory))
 
-	if (args.no_delete_temp == False):
+	if (book.no_delete_temp == False):
 		logging.info("Deleting temporary files")
 
-		shutil.rmtree(args.directory)
+		shutil.rmtree(book.directory)
 		if (os.path.exists(pdfdirectory)):
 			shutil.rmtree(pdfdirectory)
 
+	if (book.page_archive == True):
+		logging.info("The pages are kept in '{}'".format("', '".join(archivenames(book))))
+
+
+def pagefiles(directory):
+	# the downloaded pages in page order, without crop_*.tif and combined.tif
+	names = [name for name in os.listdir(directory) if re.match('^\\d{8}\\.tif$', name)]
+	return [os.path.join(directory, name) for name in sorted(names)]
+
+
+class TiffError(Exception):
+	pass
+
+
+# struct format and size of each TIFF field type
+tifftypes = {
+	1: ('B', 1),   # BYTE
+	2: ('s', 1),   # ASCII
+	3: ('H', 2),   # SHORT
+	4: ('I', 4),   # LONG
+	5: ('I', 8),   # RATIONAL (two LONGs)
+	6: ('b', 1),   # SBYTE
+	7: ('s', 1),   # UNDEFINED
+	8: ('h', 2),   # SSHORT
+	9: ('i', 4),   # SLONG
+	10: ('i', 8),  # SRATIONAL (two SLONGs)
+	11: ('f', 4),  # FLOAT
+	12: ('d', 8),  # DOUBLE
+}
+
+
+def readtiffdirectory(data, offset=None):
+	# Parse one image file directory (the first one by default) of the TIFF
+	# file in data (a string, buffer or mmap). Returns the tags as a dict of
+	# tag -> list of values (a string for ASCII and UNDEFINED fields), the
+	# byte order and the offset of the next directory (0 if there is none).
+
+	if (len(data) < 8):
+		raise TiffError("file is too short for a tiff header")
+
+	if (data[0:2] == 'II'):
+		endian = '<'
+	elif (data[0:2] == 'MM'):
+		endian = '>'
+	else:
+		raise TiffError("not a tiff file")
+
+	magic = struct.unpack(endian + 'H', data[2:4])[0]
+	if (magic != 42):
+		raise TiffError("unsupported tiff version {}".format(magic))
+
+	if (offset == None):
+		offset = struct.unpack(endian + 'I', data[4:8])[0]
+	if (offset < 8 or offset + 2 > len(data)):
+		raise TiffError("directory offset {} is outside the file".format(offset))
+
+	count = struct.unpack(endian + 'H', data[offset:offset + 2])[0]
+	end = offset + 2 + count * 12
+	if (end + 4 > len(data)):
+		raise TiffError("directory at {} is truncated".format(offset))
+
+	tags = {}
+	for i in range(count):
+		entry = data[offset + 2 + i * 12:offset + 14 + i * 12]
+		tag, fieldtype, n = struct.unpack(endian + 'HHI', entry[0:8])
+		if (not fieldtype in tifftypes):
+			continue
+
+		fmt, size = tifftypes[fieldtype]
+		total = size * n
+		if (total <= 4):
+			value = entry[8:8 + total]
+		else:
+			valueoffset = struct.unpack(endian + 'I', entry[8:12])[0]
+			if (valueoffset + total > len(data)):
+				raise TiffError("tag {} points past the end of the file".format(tag))
+			value = data[valueoffset:valueoffset + total]
+
+		if (fmt == 's'):
+			tags[tag] = str(value)
+		elif (fieldtype in [5, 10]):
+			values = struct.unpack(endian + fmt * (2 * n), value)
+			tags[tag] = [(values[j], values[j + 1]) for j in range(0, len(values), 2)]
+		else:
+			tags[tag] = list(struct.unpack(endian + fmt * n, value))
+
+	nextoffset = struct.unpack(endian + 'I', data[end:end + 4])[0]
+	return (tags, endian, nextoffset)
+
+
+class TiffPage(object):
+	# The first image of a TIFF file: its geometry, encoding and the location
+	# of its strips, read from the directory without decoding any pixels
+
+	def __init__(self, data):
+		tags, self.endian, self.nextdirectory = readtiffdirectory(data)
+		self.tags = tags
+
+		def value(tag, default):
+			if (not tag in tags):
+				return default
+			return tags[tag][0]
+
+		if (not 256 in tags or not 257 in tags):
+			raise TiffError("image width or length is missing")
+		if (324 in tags):
+			raise TiffError("tiled images are not supported")
+		if (not 273 in tags or not 279 in tags):
+			raise TiffError("strip offsets or byte counts are missing")
+
+		self.width = value(256, 0)
+		self.height = value(257, 0)
+		self.bitspersample = value(258, 1)
+		self.samplesperpixel = value(277, 1)
+		self.compression = value(259, 1)
+		self.photometric = value(262, 0)
+		self.fillorder = value(266, 1)
+		self.rowsperstrip = min(value(278, self.height), self.height)
+		self.planar = value(284, 1)
+		self.predictor = value(317, 1)
+		self.t4options = value(292, 0)
+		self.resolutionunit = value(296, 2)
+		self.xresolution = self.resolution(value(282, None))
+		self.yresolution = self.resolution(value(283, None))
+		self.colormap = tags.get(320)
+		self.jpegtables = tags.get(347)
+		self.stripoffsets = tags[273]
+		self.stripbytecounts = tags[279]
+
+		if (self.width == 0 or self.height == 0 or self.rowsperstrip == 0):
+			raise TiffError("image has no pixels")
+		if (len(self.stripoffsets) != len(self.stripbytecounts)):
+			raise TiffError("strip offsets and byte counts do not match")
+		if (len(self.stripoffsets) < (self.height + self.rowsperstrip - 1) // self.rowsperstrip):
+			raise TiffError("image has fewer strips than rows")
+		for i, offset in enumerate(self.stripoffsets):
+			if (offset + self.stripbytecounts[i] > len(data)):
+				raise TiffError("strip {} extends past the end of the file".format(i))
+
+	def resolution(self, rational):
+		# pixels per inch
+		if (rational == None or rational[1] == 0 or rational[0] == 0):
+			return None
+		dpi = float(rational[0]) / rational[1]
+		if (self.resolutionunit == 3):
+			dpi = dpi * 2.54
+		return dpi
+
+	def strips(self):
+		# (rows, offset, bytecount) of every strip, top to bottom
+		strips = []
+		for i in range(len(self.stripoffsets)):
+			rows = min(self.rowsperstrip, self.height - i * self.rowsperstrip)
+			if (rows <= 0):
+				break
+			strips.append((rows, self.stripoffsets[i], self.stripbytecounts[i]))
+		return strips
+
+
+# image directories followed by checktiff() before it gives up on a file
+maxdirectories = 1000
 
-def resizepdf():
-	logging.debug ("Setting pdf page size to {}".format(args.pdf_size))
 
-	resizedfilename = "{}_{}".format(args.pdf_size, args.pdf_name)
+def checktiff(filename):
+	# Check a downloaded page without decoding any pixels: the header and
+	# first image directory must parse and the strips or tiles of the first
+	# image must lie within the file. The file is mapped rather than read,
+	# so only the pages holding the header and directories are touched.
+	# Returns (problem, directories): problem is None for a usable page,
+	# directories the number of images (only the first one is converted,
+	# so a damaged later directory is counted but not a problem).
+	size = os.path.getsize(filename)
+	if (size == 0):
+		return ("empty file", 0)
 
-	cmd = "gs -o {0} -sDEVICE=pdfwrite -sPAPERSIZE={1} -dFIXEDMEDIA -dPDFFitPage {2} >> {3} 2>> {3}".format(pipes.quote(resizedfilename), args.pdf_size, pipes.quote(args.pdf_name), args.log_file)
+	with open(filename, 'rb') as filestream:
+		data = mmap.mmap(filestream.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		if (not data[0:2] in ['II', 'MM'] and data[0:512].lstrip().startswith('<')):
+			return ("html page instead of an image", 0)
+
+		try:
+			tags, endian, offset = readtiffdirectory(data)
+			if (324 in tags and 325 in tags):
+				offsets, bytecounts = tags[324], tags[325]
+			elif (273 in tags and 279 in tags):
+				offsets, bytecounts = tags[273], tags[279]
+			else:
+				return ("no strip or tile offsets", 0)
+			if (len(offsets) != len(bytecounts)):
+				return ("image data offsets and byte counts do not match", 0)
+			for i, start in enumerate(offsets):
+				if (start + bytecounts[i] > size):
+					return ("truncated at {} of {} bytes".format(size, start + bytecounts[i]), 0)
+		except (TiffError, struct.error) as exception:
+			return (str(exception) or exception.__class__.__name__, 0)
+
+		directories = 1
+		seen = set()
+		while (offset != 0 and not offset in seen and directories < maxdirectories):
+			seen.add(offset)
+			try:
+				tags, endian, offset = readtiffdirectory(data, offset)
+			except (TiffError, struct.error) as exception:
+				logging.debug("{}: directory {} is unreadable: {}".format(filename, directories + 1, exception))
+				directories += 1
+				break
+			directories += 1
+		return (None, directories)
+	finally:
+		data.close()
+
+
+def checkpagefiles(book, pages):
+	# checktiff() every downloaded page of the book before the pdf is made,
+	# so that a broken page is not found by a failing tiff2pdf; returns the
+	# pages that were removed to be downloaded again
+	start = time.time()
+	manifest = BookManifest(book.directory, book.manifestname)
+	broken = []
+	multiple = 0
+	for i, page in enumerate(pages):
+		filename = os.path.join(book.directory, "{0:08d}.tif".format(page))
+		if (not os.path.exists(filename)):
+			continue
+		problem, directories = checktiff(filename)
+		if (problem != None):
+			logging.warning("    page {} is not a usable tiff: {}".format(page, problem))
+			os.remove(filename)
+			if (manifest.get(page) != None):
+				manifest.update(page, expected=None, received=0, status='failed')
+			broken.append(page)
+		elif (directories > 1):
+			logging.debug("page {} has {} images, only the first is used".format(page, directories))
+			multiple += 1
+	manifest.save()
+
+	if (multiple > 0):
+		logging.info ("{} pages have more than one image, only the first of each is used".format(multiple))
+	logging.debug("Checked {} pages in {} seconds, {} broken".format(len(pages), time.time() - start, len(broken)))
+	return broken
+
+
+# reverses the bits of every byte, for TIFF FillOrder 2
+reversedbits = ''.join([chr(int('{:08b}'.format(i)[::-1], 2)) for i in range(256)])
+
+
+def pdfstring(text):
+	# a pdf text string, UTF-16 when it is not plain ascii
+	if (isinstance(text, str)):
+		text = text.decode('utf-8', 'replace')
+	try:
+		text = text.encode('ascii')
+		return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+	except UnicodeError:
+		return '<FEFF' + text.encode('utf-16-be').encode('hex').upper() + '>'
+
+
+# --pdf-size values in points that the pages can be fitted to without gs
+papersizes = {
+	'a3': (842.0, 1191.0),
+	'a4': (595.0, 842.0),
+	'a5': (420.0, 595.0),
+	'legal': (612.0, 1008.0),
+	'letter': (612.0, 792.0),
+}
+
+
+def fitpage(width, height, papersize):
+	# (scale, x, y) that fit a width x height page onto papersize, centered
+	# and keeping its aspect ratio, like gs -dPDFFitPage
+	paperwidth, paperheight = papersize
+	scale = min(paperwidth / width, paperheight / height)
+	return (scale, (paperwidth - width * scale) / 2, (paperheight - height * scale) / 2)
+
+
+class PdfWriter(object):
+	# Writes a pdf with one page per TIFF file, embedding the compressed data
+	# of each strip unchanged: CCITT G3/G4 as CCITTFaxDecode, JPEG as DCTDecode,
+	# LZW, Deflate and PackBits as LZWDecode, FlateDecode and RunLengthDecode.
+	# Objects are written as pages are added, so a pdf can be built page by
+	# page while a book downloads; the page tree and xref are written by close().
+	# With --resize-pdf every page is laid out on the --pdf-size paper as it
+	# is written, so resizepdf() has nothing left to do.
+
+	def __init__(self, filename, book):
+		self.filename = filename
+		self.book = book
+		self.stream = open(filename, 'wb')
+		self.offsets = {}
+		self.pageids = []
+		self.skipped = []
+		self.papersize = None
+		if (book.resize_pdf == True and book.pdf_size in papersizes):
+			self.papersize = papersizes[book.pdf_size]
+		# 1 is the catalog and 2 the page tree
+		self.nextid = 3
+		self.stream.write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+	def allocate(self):
+		objectid = self.nextid
+		self.nextid += 1
+		return objectid
+
+	def writeobject(self, objectid, dictionary, chunks=None):
+		self.offsets[objectid] = self.stream.tell()
+		if (chunks == None):
+			self.stream.write("{} 0 obj\n{}\nendobj\n".format(objectid, dictionary))
+			return
+
+		length = sum([len(chunk) for chunk in chunks])
+		self.stream.write("{} 0 obj\n<< {} /Length {} >>\nstream\n".format(objectid, dictionary, length))
+		for i, chunk in enumerate(chunks):
+			self.stream.write(chunk)
+		self.stream.write("\nendstream\nendobj\n")
+
+	def imagedictionary(self, page, rows):
+		# everything but /Length for one strip of page
+		entries = ["/Type /XObject /Subtype /Image /Width {} /Height {}".format(page.width, rows)]
+
+		if (page.planar != 1 and page.samplesperpixel > 1):
+			raise TiffError("planar configuration {} is not supported".format(page.planar))
+
+		if (page.compression in [2, 3, 4]):
+			# CCITT: the filter decodes to 1 bit gray, white runs as 1 unless BlackIs1
+			if (page.compression == 4):
+				k = -1
+			elif (page.compression == 3 and page.t4options & 1):
+				k = 1
+			else:
+				k = 0
+			parms = "/K {} /Columns {} /Rows {}".format(k, page.width, rows)
+			if (page.photometric == 1):
+				parms += " /BlackIs1 true"
+			if (page.compression == 2 or (page.compression == 3 and page.t4options & 4)):
+				parms += " /EncodedByteAlign true"
+			entries.append("/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /CCITTFaxDecode /DecodeParms << {} >>".format(parms))
+			return ' '.join(entries)
+
+		if (page.compression == 7):
+			# JPEG: DCTDecode takes care of YCbCr
+			colorspaces = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+			if (not page.samplesperpixel in colorspaces):
+				raise TiffError("jpeg with {} samples per pixel is not supported".format(page.samplesperpixel))
+			entries.append("/ColorSpace {} /BitsPerComponent 8 /Filter /DCTDecode".format(colorspaces[page.samplesperpixel]))
+			return ' '.join(entries)
+
+		filters = {1: None, 5: '/LZWDecode', 8: '/FlateDecode', 32946: '/FlateDecode', 32773: '/RunLengthDecode'}
+		if (not page.compression in filters):
+			raise TiffError("compression {} is not supported".format(page.compression))
+
+		if (page.photometric in [0, 1] and page.samplesperpixel == 1):
+			colorspace = '/DeviceGray'
+			if (page.photometric == 0):
+				colorspace += " /Decode [1 0]"
+		elif (page.photometric == 2 and page.samplesperpixel == 3):
+			colorspace = '/DeviceRGB'
+		elif (page.photometric == 5 and page.samplesperpixel == 4):
+			colorspace = '/DeviceCMYK'
+		elif (page.photometric == 3 and page.samplesperpixel == 1 and page.colormap != None):
+			# the colormap holds all reds, then all greens, then all blues
+			colors = len(page.colormap) // 3
+			palette = ''
+			for i in range(colors):
+				for j in range(3):
+					palette += chr(page.colormap[j * colors + i] >> 8)
+			colorspace = "[/Indexed /DeviceRGB {} <{}>]".format(colors - 1, palette.encode('hex'))
+		else:
+			raise TiffError("photometric {} with {} samples per pixel is not supported".format(page.photometric, page.samplesperpixel))
+
+		entries.append("/ColorSpace {} /BitsPerComponent {}".format(colorspace, page.bitspersample))
+		if (filters[page.compression] != None):
+			entries.append("/Filter {}".format(filters[page.compression]))
+		if (page.predictor == 2 and page.compression in [5, 8, 32946]):
+			entries.append("/DecodeParms << /Predictor 2 /Colors {} /BitsPerComponent {} /Columns {} >>".format(page.samplesperpixel, page.bitspersample, page.width))
+		return ' '.join(entries)
+
+	def stripchunks(self, page, data, offset, bytecount):
+		# a buffer, so that the strip is written without a copy
+		strip = buffer(data, offset, bytecount)
+		if (page.compression in [2, 3, 4] and page.fillorder == 2):
+			strip = str(strip).translate(reversedbits)
+		if (page.compression == 7 and page.jpegtables != None):
+			# abbreviated strip: the tables (without their EOI) go before
+			# the strip data (without its SOI)
+			return [page.jpegtables[:-2], strip[2:]]
+		if (page.compression == 32773):
+			# PackBits is RunLengthDecode without the end of data marker
+			return [strip, '\x80']
+		return [strip]
+
+	def pagesize(self, page):
+		# page size in points, 72 pixels per inch when the resolution is unknown
+		xresolution = page.xresolution or page.yresolution or 72.0
+		yresolution = page.yresolution or xresolution
+		return (page.width * 72.0 / xresolution, page.height * 72.0 / yresolution)
+
+	def addpage(self, filename):
+		# the file is mapped rather than read, see adddata()
+		try:
+			with open(filename, 'rb') as filestream:
+				data = mmap.mmap(filestream.fileno(), 0, access=mmap.ACCESS_READ)
+		except (EnvironmentError, ValueError) as exception:
+			logging.error("Skipping page {}: {}".format(filename, exception))
+			self.skipped.append(filename)
+			return False
+		try:
+			return self.adddata(filename, data)
+		finally:
+			data.close()
+
+	def adddata(self, name, data):
+		# the tiff in data (a string, buffer or mmap) as the next page; its
+		# strips are written from data without being copied
+		try:
+			page = TiffPage(data)
+			if (page.nextdirectory != 0):
+				logging.debug("{} has more than one image, using the first".format(name))
+			images = [(rows, self.imagedictionary(page, rows), offset, bytecount) for rows, offset, bytecount in page.strips()]
+		except (TiffError, struct.error) as exception:
+			logging.error("Skipping page {}: {}".format(name, exception))
+			self.skipped.append(name)
+			return False
+
+		width, height = self.pagesize(page)
+
+		# one image per strip, stacked from the top of the page
+		content = []
+		mediabox = (width, height)
+		if (self.papersize != None):
+			content.append("q {0:.4f} 0 0 {0:.4f} {1:.4f} {2:.4f} cm".format(*fitpage(width, height, self.papersize)))
+			mediabox = self.papersize
+		xobjects = []
+		top = 0
+		for i, image in enumerate(images):
+			rows, dictionary, offset, bytecount = image
+			imageid = self.allocate()
+			self.writeobject(imageid, dictionary, self.stripchunks(page, data, offset, bytecount))
+			xobjects.append("/Im{} {} 0 R".format(i, imageid))
+
+			stripheight = height * rows / page.height
+			top += stripheight
+			content.append("q {:.4f} 0 0 {:.4f} 0 {:.4f} cm /Im{} Do Q".format(width, stripheight, height - top, i))
+		if (self.papersize != None):
+			content.append("Q")
+
+		contentid = self.allocate()
+		self.writeobject(contentid, "", ['\n'.join(content)])
+
+		pageid = self.allocate()
+		self.writeobject(pageid, "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {:.4f} {:.4f}] /Resources << /XObject << {} >> >> /Contents {} 0 R >>".format(
+			mediabox[0], mediabox[1], ' '.join(xobjects), contentid))
+		self.pageids.append(pageid)
+		return True
+
+	def close(self):
+		self.writeobject(2, "<< /Type /Pages /Kids [{}] /Count {} >>".format(' '.join(["{} 0 R".format(pageid) for pageid in self.pageids]), len(self.pageids)))
+		self.writeobject(1, "<< /Type /Catalog /Pages 2 0 R >>")
+
+		info = ["/Producer (dli.py)"]
+		properties = dict(self.book.properties or [])
+		if ("Title" in properties):
+			info.append("/Title " + pdfstring(properties["Title"]))
+		if ("Author1" in properties):
+			info.append("/Author " + pdfstring(properties["Author1"]))
+		if (self.book.barcode != None):
+			info.append("/Subject " + pdfstring("DLI barcode {}".format(self.book.barcode)))
+		infoid = self.allocate()
+		self.writeobject(infoid, "<< {} >>".format(' '.join(info)))
+
+		xref = self.stream.tell()
+		self.stream.write("xref\n0 {}\n".format(self.nextid))
+		self.stream.write("0000000000 65535 f \n")
+		for objectid in range(1, self.nextid):
+			self.stream.write("{:010d} 00000 n \n".format(self.offsets[objectid]))
+		self.stream.write("trailer\n<< /Size {} /Root 1 0 R /Info {} 0 R >>\nstartxref\n{}\n%%EOF\n".format(self.nextid, infoid, xref))
+		self.stream.close()
+
+		logging.debug("Wrote {} pages to {}".format(len(self.pageids), self.filename))
+		if (len(self.skipped) > 0):
+			logging.error("{} pages could not be embedded, try another --pdf-tool: {}".format(len(self.skipped), self.skipped))
+
+
+# --pdf-tool values that --stream-pdf can build page by page
+streamingpdftools = ['tiff2pdf', 'native']
+
+
+class PageStreamer(object):
+	# --stream-pdf: normalizes each page and appends it to the output as soon
+	# as it and every earlier page have arrived, so that only a short final
+	# step is left when the download completes. Pages that fail to download
+	# are skipped, the same way createpdf() skips missing files.
+	#
+	# tiff2pdf: each page is cropped to its first image (tiffcrop -N1) and
+	# appended to combined.tif (tiffcp -a); finish() runs tiff2pdf on it.
+	# native: each page is written to the pdf by PdfWriter; finish() only
+	# writes the page tree and xref.
+
+	def __init__(self, book, first, last):
+		self.book = book
+		self.first = first
+		self.last = last
+		self.next = first
+		self.arrivedpages = {}
+		self.appended = 0
+		self.error = None
+		self.condition = threading.Condition()
+		self.combined = os.path.join(book.directory, 'combined.tif')
+
+		logging.info("Streaming pages into the pdf with the {} toolchain".format(book.pdf_tool))
+		if (os.path.exists(self.combined)):
+			os.remove(self.combined)
+
+		self.writer = None
+		if (book.pdf_tool == 'native'):
+			self.writer = PdfWriter(book.pdf_name, book)
+
+		# the pages that the download moves into the --page-archive
+		self.archive = None
+		if (book.page_archive == True):
+			self.archive = PageArchive(archivename(book))
+
+		self.thread = threading.Thread(target=self.worker)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def arrived(self, page, ok):
+		with self.condition:
+			self.arrivedpages[page] = ok
+			self.condition.notify()
+
+	def worker(self):
+		while True:
+			with self.condition:
+				while (self.next <= self.last and not self.next in self.arrivedpages):
+					self.condition.wait(1)
+				if (self.next > self.last):
+					return
+				page = self.next
+				ok = self.arrivedpages.pop(page)
+				self.next += 1
+
+			if (ok == False or self.error != None):
+				logging.debug("Streaming pdf: skipping page {}".format(page))
+				continue
+
+			try:
+				self.appendpage(page)
+				self.appended += 1
+			except Exception as exception:
+				# keep consuming pages so that finish() does not wait forever
+				self.error = exception
+				printexception(exception)
+
+	def appendpage(self, page):
+		book = self.book
+		name = "{0:08d}.tif".format(page)
+		cropname = "crop_" + name
+		logging.debug("Streaming pdf: appending page {}".format(page))
+
+		filename = os.path.join(book.directory, name)
+		archived = (self.archive != None and not os.path.exists(filename))
+		if (self.writer != None and archived):
+			self.writer.adddata(name, self.archive.data(page))
+			return
+		if (self.writer != None):
+			self.writer.addpage(filename)
+			return
+		if (archived):
+			self.archive.extract(page, filename)
+
+		# a page that tiffcrop fails on is appended uncropped; if tiffcp
+		# cannot read it either, the stream fails and createpdf() runs
+		cmd = "tiffcrop -N1 {0} {1} >> ../{2} 2>> ../{2}".format(name, cropname, book.log_file)
+		if (subprocess.call(cmd, shell=True, cwd=book.directory) != 0):
+			logging.warning("    tiffcrop failed on page {}, appending it uncropped".format(page))
+			if (os.path.exists(os.path.join(book.directory, cropname))):
+				os.remove(os.path.join(book.directory, cropname))
+			cropname = name
+		cmd = "tiffcp -a {0} combined.tif >> ../{1} 2>> ../{1}".format(cropname, book.log_file)
+		if (subprocess.call(cmd, shell=True, cwd=book.directory) != 0):
+			raise IOError("tiffcp failed to append page {}".format(page))
+
+	def finish(self):
+		book = self.book
+		start = time.time()
+
+		# the download is over, pages that never arrived will not
+		with self.condition:
+			for page in range(self.next, self.last + 1):
+				self.arrivedpages.setdefault(page, False)
+			self.condition.notify()
+		while self.thread.is_alive():
+			self.thread.join(1)
+		if (self.archive != None):
+			self.archive.close()
+
+		if (self.error != None):
+			logging.warning("Streaming the pdf failed, creating it from the downloaded files instead")
+			if (self.writer != None):
+				self.writer.stream.close()
+			createpdf(book)
+			return
+
+		logging.debug("Streaming pdf: {} pages appended".format(self.appended))
+
+		if (self.writer != None):
+			self.writer.close()
+			logging.info("Final pdf stage completed in {} seconds".format(time.time() - start))
+			finishpdf(book, "{0}-temp-pdf".format(book.directory))
+			return
+
+		cmd = "tiff2pdf -o {0} {1} >> {2} 2>> {2}".format(pipes.quote(book.pdf_name), self.combined, book.log_file)
+		logging.debug("Final stage: {}".format(cmd))
+		subprocess.call(cmd, shell=True)
+
+		logging.info("Final pdf stage completed in {} seconds".format(time.time() - start))
+		finishpdf(book, "{0}-temp-pdf".format(book.directory))
+
+
+class PdfError(Exception):
+	pass
+
+
+# a reference to an indirect pdf object
+PdfReference = collections.namedtuple('PdfReference', ['objectid', 'generation'])
+
+# pdf delimiters and white space, which end names, numbers and keywords
+pdfdelimiters = '()<>[]{}/% \t\r\n\f\x00'
+pdftokenpattern = re.compile(r'<<|>>|\[|\]|\{|\}|/[^()<>\[\]{}/%\s\x00]*|<[0-9A-Fa-f\s]*>|\(|[^()<>\[\]{}/%\s\x00]+')
+pdfreferencepattern = re.compile(r'\s+(\d+)\s+R(?=[()<>\[\]{}/%\s\x00]|$)')
+pdfobjectpattern = re.compile(r'\s*(\d+)\s+(\d+)\s+obj')
+pdfarrayendpattern = re.compile(r'\s*\]')
+
+
+class PdfTruncated(PdfError):
+	# the data ended inside an object, more has to be read
+	pass
+
+
+class PdfResizer(object):
+	# Sets the paper size of an existing pdf with an incremental update: a
+	# new version of every page dictionary is appended with the paper as its
+	# MediaBox and its contents wrapped in a cm that scales and centers the
+	# page on it, followed by an xref section for just those objects. Only
+	# the xref, the page tree and the page dictionaries are read and nothing
+	# of the original file is rewritten, so the time taken depends on the
+	# number of pages and not on the size of their images.
+	#
+	# Parsed objects are dictionaries (OrderedDict with /Name keys), lists,
+	# PdfReference and, for everything else, the pdf text of the token.
+	# Files with cross reference streams or encryption raise PdfError.
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.stream = open(filename, 'r+b')
+		self.stream.seek(0, os.SEEK_END)
+		self.size = self.stream.tell()
+		self.xref = {}
+		self.trailer = None
+		self.startxref = self.findstartxref()
+		self.readxref(self.startxref)
+
+	def close(self):
+		self.stream.close()
+
+	def read(self, offset, length):
+		self.stream.seek(offset)
+		return self.stream.read(length)
+
+	def findstartxref(self):
+		tail = self.read(max(0, self.size - 1024), 1024)
+		match = re.search(r'startxref\s+(\d+)\s*%%EOF\s*$', tail) or re.search(r'startxref\s+(\d+)', tail)
+		if (match == None):
+			raise PdfError("startxref not found")
+		return int(match.group(1))
+
+	def readxref(self, offset):
+		# newest section first, so the first offset seen for an object wins
+		seen = set()
+		while (offset != None):
+			if (offset in seen or offset >= self.size):
+				raise PdfError("broken xref chain at {}".format(offset))
+			seen.add(offset)
+
+			data, pos = self.readvalue(offset, self.parsexref)
+			trailer = data
+			if (self.trailer == None):
+				self.trailer = trailer
+			if ('/Encrypt' in trailer):
+				raise PdfError("encrypted pdf")
+			if ('/XRefStm' in trailer):
+				raise PdfError("hybrid cross reference streams are not supported")
+
+			offset = None
+			if ('/Prev' in trailer):
+				offset = int(trailer['/Prev'])
+
+	def parsexref(self, data, pos):
+		# a classic xref table and its trailer starting at pos
+		token, pos = self.token(data, pos)
+		if (token != 'xref'):
+			raise PdfError("cross reference streams are not supported")
+		while True:
+			token, pos = self.token(data, pos)
+			if (token == 'trailer'):
+				return self.parse(data, pos)
+			start = int(token)
+			token, pos = self.token(data, pos)
+			count = int(token)
+			for objectid in range(start, start + count):
+				offset, pos = self.token(data, pos)
+				generation, pos = self.token(data, pos)
+				kind, pos = self.token(data, pos)
+				if (kind == 'n' and not objectid in self.xref):
+					self.xref[objectid] = (int(offset), int(generation))
+				elif (kind == 'f'):
+					self.xref.setdefault(objectid, None)
+
+	def readvalue(self, offset, parse):
+		# parse(data, pos) on the file from offset, reading more until it fits
+		length = 4096
+		while True:
+			data = self.read(offset, length)
+			try:
+				return parse(data, 0)
+			except (PdfTruncated, IndexError):
+				if (offset + len(data) >= self.size or length >= 16 * 1024 * 1024):
+					raise PdfError("truncated object at {}".format(offset))
+				length = length * 4
+
+	def token(self, data, pos):
+		match = pdftokenpattern.search(data, pos)
+		# skip comments
+		while (match != None and data.find('%', pos, match.start()) != -1):
+			pos = data.find('\n', data.find('%', pos, match.start()))
+			if (pos == -1):
+				raise PdfTruncated()
+			match = pdftokenpattern.search(data, pos)
+		if (match == None or match.end() == len(data)):
+			raise PdfTruncated()
+		return (match.group(0), match.end())
+
+	def parse(self, data, pos):
+		token, pos = self.token(data, pos)
+
+		if (token == '<<'):
+			dictionary = collections.OrderedDict()
+			while True:
+				key, pos = self.token(data, pos)
+				if (key == '>>'):
+					return (dictionary, pos)
+				if (not key.startswith('/')):
+					raise PdfError("dictionary key {} is not a name".format(key))
+				dictionary[key], pos = self.parse(data, pos)
+
+		if (token == '['):
+			array = []
+			while True:
+				match = pdfarrayendpattern.match(data, pos)
+				if (match != None):
+					return (array, match.end())
+				value, pos = self.parse(data, pos)
+				array.append(value)
+
+		if (token == '('):
+			# a literal string, with balanced or escaped parentheses
+			start = pos - 1
+			depth = 1
+			while (depth > 0):
+				if (pos >= len(data)):
+					raise PdfTruncated()
+				character = data[pos]
+				if (character == '\\'):
+					pos += 1
+				elif (character == '('):
+					depth += 1
+				elif (character == ')'):
+					depth -= 1
+				pos += 1
+			return (data[start:pos], pos)
+
+		if (token.isdigit()):
+			match = pdfreferencepattern.match(data, pos)
+			if (match != None):
+				return (PdfReference(int(token), int(match.group(1))), match.end())
+
+		return (token, pos)
+
+	def getobject(self, reference):
+		if (not isinstance(reference, PdfReference)):
+			return reference
+		entry = self.xref.get(reference.objectid)
+		if (entry == None):
+			raise PdfError("object {} is not in the xref".format(reference.objectid))
+
+		def parseobject(data, pos):
+			match = pdfobjectpattern.match(data, pos)
+			if (match == None or int(match.group(1)) != reference.objectid):
+				raise PdfError("object {} is not at offset {}".format(reference.objectid, entry[0]))
+			return self.parse(data, match.end())
+
+		return self.readvalue(entry[0], parseobject)[0]
+
+	def isarray(self, reference):
+		# whether an indirect object is an array, without reading streams
+		data = self.read(self.xref.get(reference.objectid, (0, 0))[0], 64)
+		match = pdfobjectpattern.match(data)
+		return (match != None and data[match.end():].lstrip().startswith('['))
+
+	def pages(self):
+		# (reference, dictionary, mediabox, rotate) of every page in order
+		root = self.getobject(self.trailer.get('/Root'))
+		if (not isinstance(root, dict) or not '/Pages' in root):
+			raise PdfError("no page tree")
+
+		pages = []
+		visited = set()
+		stack = [(root['/Pages'], None, 0)]
+		while (len(stack) > 0):
+			reference, mediabox, rotate = stack.pop()
+			if (reference in visited):
+				raise PdfError("loop in the page tree")
+			visited.add(reference)
+
+			node = self.getobject(reference)
+			if (not isinstance(node, dict)):
+				raise PdfError("page tree node {} is not a dictionary".format(reference))
+			if ('/MediaBox' in node):
+				mediabox = [float(self.getobject(value)) for value in self.getobject(node['/MediaBox'])]
+			if ('/Rotate' in node):
+				rotate = int(self.getobject(node['/Rotate']))
+
+			if (node.get('/Type') == '/Pages' or '/Kids' in node):
+				kids = self.getobject(node['/Kids'])
+				stack.extend([(kid, mediabox, rotate) for kid in reversed(kids)])
+			else:
+				if (mediabox == None or len(mediabox) != 4):
+					raise PdfError("page {} has no MediaBox".format(reference))
+				pages.append((reference, node, mediabox, rotate))
+		return pages
+
+	def serialize(self, value):
+		if (isinstance(value, PdfReference)):
+			return "{} {} R".format(value.objectid, value.generation)
+		if (isinstance(value, dict)):
+			return "<< " + ' '.join(["{} {}".format(key, self.serialize(item)) for key, item in value.items()]) + " >>"
+		if (isinstance(value, list)):
+			return "[" + ' '.join([self.serialize(item) for item in value]) + "]"
+		return value
+
+	def resize(self, papersize):
+		# returns the number of pages changed
+		if (not isinstance(self.trailer.get('/Size'), str)):
+			raise PdfError("trailer has no /Size")
+		nextid = int(self.trailer['/Size'])
+
+		objects = []
+		contents = {}
+		for i, page in enumerate(self.pages()):
+			reference, dictionary, mediabox, rotate = page
+			left, bottom, right, top = min(mediabox[0], mediabox[2]), min(mediabox[1], mediabox[3]), max(mediabox[0], mediabox[2]), max(mediabox[1], mediabox[3])
+			width, height = right - left, top - bottom
+			if (width <= 0 or height <= 0):
+				raise PdfError("page {} is empty".format(i + 1))
+
+			# a page shown sideways goes on sideways paper
+			target = papersize
+			if (rotate % 180 == 90):
+				target = (papersize[1], papersize[0])
+			if (abs(left) < 0.5 and abs(bottom) < 0.5 and abs(width - target[0]) < 0.5 and abs(height - target[1]) < 0.5):
+				continue
+
+			scale, x, y = fitpage(width, height, target)
+			matrix = "q {0:.4f} 0 0 {0:.4f} {1:.4f} {2:.4f} cm\n".format(scale, x - left * scale, y - bottom * scale)
+			if (not matrix in contents):
+				contents[matrix] = nextid
+				objects.append((PdfReference(nextid, 0), matrix))
+				nextid += 1
+			if (not "\nQ" in contents):
+				contents["\nQ"] = nextid
+				objects.append((PdfReference(nextid, 0), "\nQ"))
+				nextid += 1
+
+			pagecontents = dictionary.get('/Contents', [])
+			if (isinstance(pagecontents, PdfReference) and self.isarray(pagecontents)):
+				pagecontents = self.getobject(pagecontents)
+			if (not isinstance(pagecontents, list)):
+				pagecontents = [pagecontents]
+
+			for key in ['/CropBox', '/BleedBox', '/TrimBox', '/ArtBox']:
+				dictionary.pop(key, None)
+			dictionary['/MediaBox'] = "[0 0 {:.4f} {:.4f}]".format(target[0], target[1])
+			dictionary['/Contents'] = [PdfReference(contents[matrix], 0)] + pagecontents + [PdfReference(contents["\nQ"], 0)]
+			objects.append((reference, dictionary))
+
+		if (len(objects) == 0):
+			return 0
+
+		# append the update, and remove it again if anything goes wrong
+		try:
+			self.stream.seek(0, os.SEEK_END)
+			self.stream.write("\n")
+			offsets = {}
+			for i, item in enumerate(objects):
+				reference, value = item
+				offsets[reference.objectid] = (self.stream.tell(), reference.generation)
+				if (isinstance(value, dict)):
+					self.stream.write("{} {} obj\n{}\nendobj\n".format(reference.objectid, reference.generation, self.serialize(value)))
+				else:
+					self.stream.write("{} {} obj\n<< /Length {} >>\nstream\n{}\nendstream\nendobj\n".format(reference.objectid, reference.generation, len(value), value))
+
+			xref = self.stream.tell()
+			# readers expect the free list head in every section
+			self.stream.write("xref\n0 1\n0000000000 65535 f \n")
+			objectids = sorted(offsets.keys())
+			start = 0
+			while (start < len(objectids)):
+				end = start
+				while (end + 1 < len(objectids) and objectids[end + 1] == objectids[end] + 1):
+					end += 1
+				self.stream.write("{} {}\n".format(objectids[start], end - start + 1))
+				for objectid in objectids[start:end + 1]:
+					self.stream.write("{:010d} {:05d} n \n".format(*offsets[objectid]))
+				start = end + 1
+
+			trailer = collections.OrderedDict()
+			trailer['/Size'] = str(max(nextid, int(self.trailer['/Size'])))
+			for key in ['/Root', '/Info', '/ID']:
+				if (key in self.trailer):
+					trailer[key] = self.trailer[key]
+			trailer['/Prev'] = str(self.startxref)
+			self.stream.write("trailer\n{}\nstartxref\n{}\n%%EOF\n".format(self.serialize(trailer), xref))
+			self.stream.flush()
+		except:
+			self.stream.truncate(self.size)
+			raise
+
+		return len([item for item in objects if isinstance(item[1], dict)])
+
+
+def resizepdf(book):
+	logging.debug ("Setting pdf page size to {}".format(book.pdf_size))
+
+	# the known paper sizes only need new page dictionaries
+	if (book.pdf_size in papersizes):
+		start = time.time()
+		resizer = None
+		try:
+			resizer = PdfResizer(book.pdf_name)
+			pages = resizer.resize(papersizes[book.pdf_size])
+			logging.info("Fitted {} pages to {} in {} seconds".format(pages, book.pdf_size, time.time() - start))
+			logging.info ("Resize complete")
+			return
+		except (PdfError, ValueError, IOError) as exception:
+			logging.warning("Cannot resize {} in place ({}), rewriting it with gs".format(book.pdf_name, exception))
+		finally:
+			if (resizer != None):
+				resizer.close()
+
+	resizedfilename = "{}_{}".format(book.pdf_size, book.pdf_name)
+
+	cmd = "gs -o {0} -sDEVICE=pdfwrite -sPAPERSIZE={1} -dFIXEDMEDIA -dPDFFitPage {2} >> {3} 2>> {3}".format(pipes.quote(resizedfilename), book.pdf_size, pipes.quote(book.pdf_name), book.log_file)
 
 	logging.debug ("Resizing: {}".format(cmd))
 	logging.info("Resizing pdf")
 	subprocess.call(cmd, shell=True)
 
-	pdfSize = os.path.getsize(args.pdf_name)
-	resizedSize = os.path.getsize(resizedfilename)
-
-	logging.debug ("File {} ({} bytes) resized to {} ({} bytes)".format(pipes.quote(args.pdf_name), pdfSize, resizedfilename, resizedSize))
-
 	if (os.path.exists(resizedfilename)):
-		os.remove(args.pdf_name)
-		os.rename(resizedfilename, args.pdf_name)
+		pdfSize = os.path.getsize(book.pdf_name)
+		resizedSize = os.path.getsize(resizedfilename)
+		logging.debug ("File {} ({} bytes) resized to {} ({} bytes)".format(pipes.quote(book.pdf_name), pdfSize, resizedfilename, resizedSize))
+		os.remove(book.pdf_name)
+		os.rename(resizedfilename, book.pdf_name)
 	else:
 		logging.info ("resizing pdf failed. Please run the command manually to debug")
 
 	logging.info ("Resize complete")
 
 
+def readbatch(filename):
+	# One book per line: BARCODE [PDF NAME], as accepted by dli-multi.sh.
+	# Spaces in the pdf name are replaced by underscores.
+	logging.debug("Reading batch from {}".format(filename))
+
+	if (filename == '-'):
+		lines = sys.stdin.readlines()
+	else:
+		with open(filename, 'rb') as filestream:
+			lines = filestream.readlines()
+
+	books = []
+	barcodes = set()
+	for i, line in enumerate(lines):
+		line = line.strip()
+		if (line == '' or line.startswith('#')):
+			continue
+
+		fields = line.split(None, 1)
+		try:
+			barcode = int(fields[0])
+		except ValueError:
+			logging.error("Ignoring malformed batch line {}: {}".format(i + 1, line))
+			continue
+
+		if (barcode in barcodes):
+			logging.warning("Ignoring duplicate barcode {} on batch line {}".format(barcode, i + 1))
+			continue
+		barcodes.add(barcode)
+
+		pdfname = None
+		if (len(fields) > 1):
+			pdfname = fields[1].strip().replace(' ', '_')
+			if (not pdfname.lower().endswith('.pdf')):
+				pdfname = pdfname + '.pdf'
+
+		books.append(newbook(barcode, pdfname))
+
+	logging.info("Read {} books from {}".format(len(books), filename))
+	return books
+
+
+def newbook(barcode, pdfname):
+	# a copy of the command line arguments describing one --batch book
+	book = copy.copy(args)
+	book.barcode = barcode
+	book.directory = str(barcode)
+	book.pdf_name = pdfname
+	if (pdfname == None):
+		book.pdf_name = "{}.pdf".format(barcode)
+	else:
+		book.no_title_in_pdf_name = True
+	initbook(book)
+	return book
+
+
+class JobStore(object):
+	# The jobs of --serve in sqlite (--jobs-db), one row per submitted book.
+	# state is the stage the book waits for or runs in (queued, lookup,
+	# download, pdf) or its outcome (done, failed, cancelled), stage the
+	# last stage it entered, where a retry starts again. The lookup
+	# result is kept with the job so that the download can resume without
+	# it. Every change is committed, so after a crash or restart each
+	# unfinished book continues from the stage it was in.
+
+	finished = ['done', 'failed', 'cancelled']
+
+	def __init__(self, filename):
+		directory = os.path.dirname(os.path.abspath(filename))
+		if (not os.path.exists(directory)):
+			os.makedirs(directory)
+
+		import sqlite3
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.executescript('''
+			CREATE TABLE IF NOT EXISTS jobs (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				barcode INTEGER,
+				pdfname TEXT,
+				directory TEXT,
+				state TEXT,
+				stage TEXT,
+				lookup TEXT,
+				pages TEXT,
+				error TEXT,
+				created REAL,
+				updated REAL,
+				finished REAL
+			);
+			CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+			CREATE INDEX IF NOT EXISTS jobs_barcode ON jobs (barcode);
+		''')
+
+	def add(self, barcode, pdfname):
+		# returns (job, created): a book already waiting or running is not added twice
+		with self.lock:
+			row = self.connection.execute("SELECT * FROM jobs WHERE barcode = ? AND state NOT IN ('done', 'failed', 'cancelled')", (barcode,)).fetchone()
+			if (row != None):
+				return (dict(row), False)
+
+			now = time.time()
+			cursor = self.connection.execute("INSERT INTO jobs (barcode, pdfname, directory, state, created, updated) VALUES (?, ?, ?, 'queued', ?, ?)",
+				(barcode, pdfname, os.path.abspath(str(barcode)), now, now))
+			self.connection.commit()
+			return (dict(self.connection.execute("SELECT * FROM jobs WHERE id = ?", (cursor.lastrowid,)).fetchone()), True)
+
+	def get(self, jobid):
+		with self.lock:
+			row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (jobid,)).fetchone()
+			if (row == None):
+				return None
+			return dict(row)
+
+	def list(self, state=None, limit=100):
+		with self.lock:
+			if (state == None):
+				rows = self.connection.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+			else:
+				rows = self.connection.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?", (state, limit))
+			return [dict(row) for row in rows]
+
+	def unfinished(self):
+		with self.lock:
+			rows = self.connection.execute("SELECT * FROM jobs WHERE state NOT IN ('done', 'failed', 'cancelled') ORDER BY id")
+			return [dict(row) for row in rows]
+
+	def counts(self):
+		with self.lock:
+			return dict([(row[0], row[1]) for row in self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")])
+
+	def update(self, jobid, **fields):
+		fields['updated'] = time.time()
+		if (fields.get('state') in JobStore.finished):
+			fields['finished'] = fields['updated']
+		names = sorted(fields.keys())
+		with self.lock:
+			self.connection.execute("UPDATE jobs SET {} WHERE id = ?".format(', '.join(["{} = ?".format(name) for name in names])),
+				[fields[name] for name in names] + [jobid])
+			self.connection.commit()
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+
+def jobprogress(job):
+	# pages on disk for a job, from its manifest or the page files, so that
+	# status queries never touch the network
+	progress = {'pages': job['pages'], 'complete': 0}
+	directory = job['directory']
+	if (directory == None or not os.path.exists(directory)):
+		return progress
+
+	manifest = readjson(os.path.join(directory, manifestname), None)
+	if (isinstance(manifest, dict) and isinstance(manifest.get('pages'), dict)):
+		progress['complete'] = len([entry for page, entry in manifest['pages'].items() if entry.get('status') == 'complete'])
+	else:
+		progress['complete'] = len(pagefiles(directory))
+	return progress
+
+
+class JobService(object):
+	# --serve: like BatchScheduler, every stage has a queue and --batch-parallel
+	# worker threads, but books arrive at any time over the api and their
+	# state lives in the JobStore instead of memory
+
+	def __init__(self, store):
+		self.store = store
+		self.started = time.time()
+		self.stages = []
+		if (args.lookup == True or args.download == True):
+			self.stages.append(('lookup', lookupstage))
+		if (args.download == True):
+			self.stages.append(('download', downloadstage))
+		if (args.create_pdf == True or args.resize_pdf == True):
+			self.stages.append(('pdf', pdfstage))
+		self.queues = [Queue.Queue() for stage in self.stages]
+
+		# books between stages, with the state that is not in the store
+		self.lock = threading.Lock()
+		self.books = {}
+
+	def stageindex(self, state):
+		names = [name for name, function in self.stages]
+		if (state in names):
+			return names.index(state)
+		return 0
+
+	def bookfor(self, job):
+		book = newbook(job['barcode'], job['pdfname'])
+		if (job['lookup'] != None):
+			lookup = json.loads(job['lookup'])
+			book.goodserver = tuple([str(value) if isinstance(value, unicode) else value for value in lookup['goodserver']])
+			book.goodsources = [tuple([str(value) if isinstance(value, unicode) else value for value in source]) for source in lookup['goodsources']]
+			book.properties = lookup['properties']
+			book.pdf_name = str(lookup['pdfname'])
+		return book
+
+	def enqueue(self, job):
+		index = self.stageindex(job['stage'])
+		# a download or pdf needs the lookup of a book restored from the store
+		if (index > 0 and job['lookup'] == None and self.stages[0][0] == 'lookup'):
+			index = 0
+		with self.lock:
+			if (not job['id'] in self.books):
+				self.books[job['id']] = self.bookfor(job)
+		self.store.update(job['id'], state=self.stages[index][0], stage=self.stages[index][0])
+		self.queues[index].put(job['id'])
+
+	def submit(self, barcode, pdfname):
+		job, created = self.store.add(barcode, pdfname)
+		if (created == True):
+			logging.info("Job {}: book {} submitted".format(job['id'], barcode))
+			self.enqueue(job)
+		return (self.store.get(job['id']), created)
+
+	def retry(self, jobid):
+		job = self.store.get(jobid)
+		if (job == None or job['state'] != 'failed'):
+			return False
+		logging.info("Job {}: retrying book {}".format(jobid, job['barcode']))
+		self.store.update(jobid, error=None, finished=None)
+		self.enqueue(job)
+		return True
+
+	def cancel(self, jobid):
+		# a running stage finishes, the book then goes no further
+		with self.lock:
+			job = self.store.get(jobid)
+			if (job == None or job['state'] in JobStore.finished):
+				return False
+			self.store.update(jobid, state='cancelled')
+			return True
+
+	def advance(self, jobid, state, **fields):
+		# move a job to its next state unless it was cancelled; the check
+		# and the update hold the lock that cancel() takes, so that a
+		# DELETE in between is not overwritten
+		with self.lock:
+			if (self.store.get(jobid)['state'] == 'cancelled'):
+				return False
+			self.store.update(jobid, state=state, **fields)
+			return True
+
+	def stageworker(self, index):
+		name, function = self.stages[index]
+		while True:
+			jobid = self.queues[index].get()
+			job = self.store.get(jobid)
+			if (job == None or job['state'] == 'cancelled'):
+				self.finish(jobid)
+				continue
+
+			with self.lock:
+				book = self.books[jobid]
+
+			logging.info("Job {}: book {} {} stage".format(jobid, book.barcode, name))
+			try:
+				function(book)
+			except (Exception, SystemExit) as exception:
+				logging.error("Job {}: book {} failed during {}".format(jobid, book.barcode, name))
+				if (not isinstance(exception, SystemExit)):
+					printexception(exception)
+				self.advance(jobid, 'failed', error="failed during {}".format(name))
+				self.finish(jobid)
+				continue
+
+			if (name == 'lookup' and book.goodserver != None):
+				lookup = {
+					'goodserver': list(book.goodserver),
+					'goodsources': [list(source) for source in book.goodsources],
+					'properties': book.properties,
+					'pdfname': book.pdf_name,
+				}
+				self.store.update(jobid, lookup=json.dumps(lookup), pages=book.goodserver[2], pdfname=book.pdf_name)
+
+			if (index + 1 < len(self.stages)):
+				if (self.advance(jobid, self.stages[index + 1][0], stage=self.stages[index + 1][0])):
+					self.queues[index + 1].put(jobid)
+				else:
+					self.finish(jobid)
+			else:
+				if (self.advance(jobid, 'done')):
+					logging.info("Job {}: book {} done".format(jobid, book.barcode))
+				self.finish(jobid)
+
+	def finish(self, jobid):
+		with self.lock:
+			self.books.pop(jobid, None)
+		# a service runs for a long time, keep no measurements in memory
+		metrics.flush()
+
+	def start(self):
+		for index in range(len(self.stages)):
+			for i in range(args.batch_parallel):
+				thread = threading.Thread(target=self.stageworker, args=(index,))
+				thread.daemon = True
+				thread.start()
+
+		unfinished = self.store.unfinished()
+		if (len(unfinished) > 0):
+			logging.info("Resuming {} unfinished jobs".format(len(unfinished)))
+		for i, job in enumerate(unfinished):
+			self.enqueue(job)
+
+	def describe(self, job):
+		job = dict(job)
+		job.pop('lookup', None)
+		job['progress'] = jobprogress(job)
+		return job
+
+	def status(self):
+		return {
+			'uptime': time.time() - self.started,
+			'stages': [name for name, function in self.stages],
+			'jobs': self.store.counts(),
+			'queued': dict([(self.stages[index][0], self.queues[index].qsize()) for index in range(len(self.stages))]),
+		}
+
+
+class JobRequestHandler:
+	# The --serve api, json in and out, mixed into a
+	# BaseHTTPServer.BaseHTTPRequestHandler by serve(). An old-style class
+	# like the request handlers, so that it comes first in their lookup:
+	#   POST   /jobs              {"barcode": N, "pdf_name": "..."} or {"barcodes": [N, ...]}
+	#   GET    /jobs[?state=S]    the latest jobs
+	#   GET    /jobs/ID           one job with the pages on disk
+	#   POST   /jobs/ID/retry     run a failed job again
+	#   DELETE /jobs/ID           cancel a job
+	#   GET    /status            job counts and queue lengths
+
+	def address_string(self):
+		# unix socket clients have no address
+		if (isinstance(self.client_address, tuple)):
+			return self.client_address[0]
+		return 'local'
+
+	def log_message(self, format, *arguments):
+		logging.debug("api {}: {}".format(self.address_string(), format % arguments))
+
+	def reply(self, status, data):
+		body = json.dumps(data, sort_keys=True, indent=1) + '\n'
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def route(self):
+		parsedurl = urlparse(self.path)
+		parts = [part for part in parsedurl.path.split('/') if part != '']
+		return (parts, parse_qs(parsedurl.query))
+
+	def jobid(self, parts):
+		if (len(parts) >= 2 and parts[0] == 'jobs' and parts[1].isdigit()):
+			return int(parts[1])
+		return None
+
+	def do_GET(self):
+		service = self.server.service
+		parts, query = self.route()
+		if (parts == ['status']):
+			self.reply(200, service.status())
+		elif (parts == ['jobs']):
+			state = query.get('state', [None])[0]
+			try:
+				limit = int(query.get('limit', ['100'])[0])
+			except ValueError as exception:
+				self.reply(400, {'error': 'expected ?limit=N: {}'.format(exception)})
+				return
+			self.reply(200, {'jobs': [service.describe(job) for job in service.store.list(state, limit)]})
+		elif (len(parts) == 2 and self.jobid(parts) != None):
+			job = service.store.get(self.jobid(parts))
+			if (job == None):
+				self.reply(404, {'error': 'no such job'})
+			else:
+				self.reply(200, service.describe(job))
+		else:
+			self.reply(404, {'error': 'unknown path'})
+
+	def do_POST(self):
+		service = self.server.service
+		parts, query = self.route()
+		if (len(parts) == 3 and self.jobid(parts) != None and parts[2] == 'retry'):
+			if (service.retry(self.jobid(parts))):
+				self.reply(200, service.describe(service.store.get(self.jobid(parts))))
+			else:
+				self.reply(409, {'error': 'only failed jobs can be retried'})
+			return
+
+		if (parts != ['jobs']):
+			self.reply(404, {'error': 'unknown path'})
+			return
+
+		try:
+			length = int(self.headers.get('Content-Length', '0'))
+			request = json.loads(self.rfile.read(length) or '{}')
+			if ('barcodes' in request):
+				books = [(int(barcode), None) for barcode in request['barcodes']]
+			else:
+				books = [(int(request['barcode']), request.get('pdf_name'))]
+		except (ValueError, KeyError, TypeError) as exception:
+			self.reply(400, {'error': 'expected {{"barcode": N}} or {{"barcodes": [N, ...]}}: {}'.format(exception)})
+			return
+
+		jobs = []
+		for i, (barcode, pdfname) in enumerate(books):
+			if (pdfname != None):
+				pdfname = os.path.basename(str(pdfname)).replace(' ', '_')
+				if (not pdfname.lower().endswith('.pdf')):
+					pdfname = pdfname + '.pdf'
+			job, created = service.submit(barcode, pdfname)
+			job = service.describe(job)
+			job['new'] = created
+			jobs.append(job)
+		self.reply(201 if any([job['new'] for job in jobs]) else 200, {'jobs': jobs})
+
+	def do_DELETE(self):
+		service = self.server.service
+		parts, query = self.route()
+		if (len(parts) == 2 and self.jobid(parts) != None):
+			if (service.cancel(self.jobid(parts))):
+				self.reply(200, service.describe(service.store.get(self.jobid(parts))))
+			else:
+				self.reply(409, {'error': 'no such job, or it has already finished'})
+		else:
+			self.reply(404, {'error': 'unknown path'})
+
+
+def serve(address):
+	# --serve: HOST:PORT or the path of a unix socket
+	import BaseHTTPServer
+	import SocketServer
+
+	class Handler(JobRequestHandler, BaseHTTPServer.BaseHTTPRequestHandler):
+		pass
+
+	class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+
+	if (hasattr(SocketServer, 'UnixStreamServer')):
+		class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+			daemon_threads = True
+
+	store = JobStore(args.jobs_db)
+	service = JobService(store)
+
+	unixsocket = None
+	if ('/' in address or not ':' in address):
+		unixsocket = os.path.abspath(address)
+		if (os.path.exists(unixsocket)):
+			os.remove(unixsocket)
+		server = ThreadingUnixServer(unixsocket, Handler)
+	else:
+		host, port = address.rsplit(':', 1)
+		server = ThreadingHTTPServer((host, int(port)), Handler)
+	server.service = service
+
+	# stop like Ctrl-C; the jobs in progress resume on the next --serve
+	def terminate(signalnumber, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, terminate)
+
+	service.start()
+	logging.info("Serving the job api on {} (jobs in {})".format(address, args.jobs_db))
+	try:
+		server.serve_forever(0.5)
+	except KeyboardInterrupt:
+		logging.info("Stopping, unfinished jobs resume on the next --serve")
+	finally:
+		server.server_close()
+		if (unixsocket != None and os.path.exists(unixsocket)):
+			os.remove(unixsocket)
+
+	# the stage workers may be waiting on the network: exit without them
+	# instead of letting them fail while the interpreter shuts down
+	metrics.finish()
+	logging.shutdown()
+	os._exit(0)
+
+
+class Metrics(object):
+	# Measurements of this run: every page (server, bytes, seconds, attempts
+	# and outcome: downloaded|hedged|present|failed) and every stage of
+	# every book (wall time, cpu time of dli.py and of the tools it ran).
+	# finish() logs a summary with latency percentiles and writes the
+	# --metrics-file (json lines) and --metrics-prom (prometheus textfile).
+	# In --batch mode the stages of several books overlap, so their cpu
+	# times include the work of the other books. --serve calls flush() after
+	# every book, so its records go to the --metrics-file as they finish.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.pages = []
+		self.stages = []
+
+	def recordpage(self, barcode, page, server, size, seconds, attempts, outcome):
+		with self.lock:
+			self.pages.append({
+				'type': 'page',
+				'time': time.time(),
+				'barcode': barcode,
+				'page': page,
+				'server': server,
+				'bytes': size,
+				'seconds': seconds,
+				'attempts': attempts,
+				'outcome': outcome,
+			})
+
+	@contextlib.contextmanager
+	def stage(self, book, name):
+		start = time.time()
+		times = os.times()
+		status = 'failed'
+		try:
+			yield
+			status = 'ok'
+		finally:
+			end = os.times()
+			with self.lock:
+				self.stages.append({
+					'type': 'stage',
+					'time': time.time(),
+					'barcode': book.barcode,
+					'stage': name,
+					'seconds': time.time() - start,
+					'cpu': (end[0] + end[1]) - (times[0] + times[1]),
+					'toolcpu': (end[2] + end[3]) - (times[2] + times[3]),
+					'status': status,
+				})
+
+	def latencies(self, pages):
+		return [page['seconds'] for page in pages if page['seconds'] != None and page['outcome'] in ['downloaded', 'hedged']]
+
+	def describelatencies(self, latencies):
+		if (len(latencies) == 0):
+			return "no timings"
+		return "p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, max {:.3f}s".format(percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), max(latencies))
+
+	def summary(self):
+		if (len(self.pages) == 0 and len(self.stages) == 0):
+			return
+
+		logging.info ("")
+		logging.info ("Run metrics ({} seconds)".format(time.time() - self.started))
+
+		outcomes = collections.Counter([page['outcome'] for page in self.pages])
+		if (len(self.pages) > 0):
+			logging.info ("    pages: {} ({} bytes downloaded), latency {}".format(
+				", ".join(["{} {}".format(count, outcome) for outcome, count in sorted(outcomes.items())]),
+				sum([page['bytes'] for page in self.pages if page['outcome'] in ['downloaded', 'hedged']]),
+				self.describelatencies(self.latencies(self.pages))))
+
+		for i, server in enumerate(sorted(set([page['server'] for page in self.pages if page['server'] != None]))):
+			pages = [page for page in self.pages if page['server'] == server]
+			retries = sum([page['attempts'] - 1 for page in pages if page['attempts'] > 1])
+			logging.info ("    server [{}]: {} pages, {} bytes, {} failed, {} retries, latency {}".format(server,
+				len([page for page in pages if page['outcome'] != 'failed']), sum([page['bytes'] for page in pages]),
+				len([page for page in pages if page['outcome'] == 'failed']), retries, self.describelatencies(self.latencies(pages))))
+
+		for i, name in enumerate(['lookup', 'download', 'pdf', 'resize']):
+			stages = [stage for stage in self.stages if stage['stage'] == name]
+			if (len(stages) == 0):
+				continue
+			logging.info ("    {} stage: {} books, {:.3f}s wall, {:.3f}s cpu, {:.3f}s tool cpu{}".format(name, len(stages),
+				sum([stage['seconds'] for stage in stages]), sum([stage['cpu'] for stage in stages]), sum([stage['toolcpu'] for stage in stages]),
+				", {} failed".format(len([stage for stage in stages if stage['status'] != 'ok'])) if any([stage['status'] != 'ok' for stage in stages]) else ""))
+
+	def writejsonlines(self, filename):
+		run = {
+			'type': 'run',
+			'time': time.time(),
+			'started': self.started,
+			'seconds': time.time() - self.started,
+			'books': len(set([stage['barcode'] for stage in self.stages])),
+			'pages': len(self.pages),
+		}
+		with open(filename, 'ab') as filestream:
+			for i, record in enumerate(self.stages + self.pages + [run]):
+				filestream.write(json.dumps(record, sort_keys=True) + '\n')
+
+	def writeprometheus(self, filename):
+		# the textfile collector reads the whole file, so write it atomically
+		def labels(**values):
+			return '{' + ','.join(['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(values.items())]) + '}'
+
+		lines = []
+		lines.append('# HELP dli_pages_total Pages handled in the last run by server and outcome.')
+		lines.append('# TYPE dli_pages_total counter')
+		counts = collections.Counter([(page['server'] or '', page['outcome']) for page in self.pages])
+		for (server, outcome), count in sorted(counts.items()):
+			lines.append('dli_pages_total{} {}'.format(labels(server=server, outcome=outcome), count))
+
+		lines.append('# HELP dli_page_bytes_total Bytes of the pages downloaded in the last run by server.')
+		lines.append('# TYPE dli_page_bytes_total counter')
+		servers = sorted(set([page['server'] for page in self.pages if page['server'] != None]))
+		for i, server in enumerate(servers):
+			lines.append('dli_page_bytes_total{} {}'.format(labels(server=server), sum([page['bytes'] for page in self.pages if page['server'] == server])))
+
+		lines.append('# HELP dli_page_latency_seconds Page download time in the last run by server.')
+		lines.append('# TYPE dli_page_latency_seconds summary')
+		for i, server in enumerate(servers):
+			latencies = self.latencies([page for page in self.pages if page['server'] == server])
+			if (len(latencies) == 0):
+				continue
+			for j, quantile in enumerate([0.5, 0.9, 0.99]):
+				lines.append('dli_page_latency_seconds{} {}'.format(labels(server=server, quantile=quantile), percentile(latencies, quantile * 100)))
+			lines.append('dli_page_latency_seconds_sum{} {}'.format(labels(server=server), sum(latencies)))
+			lines.append('dli_page_latency_seconds_count{} {}'.format(labels(server=server), len(latencies)))
+
+		lines.append('# HELP dli_stage_seconds Wall time of the stages of the last run.')
+		lines.append('# TYPE dli_stage_seconds gauge')
+		lines.append('# HELP dli_stage_cpu_seconds Cpu time of dli.py (tool="false") and of the tools it ran (tool="true") in the stages of the last run.')
+		lines.append('# TYPE dli_stage_cpu_seconds gauge')
+		for i, name in enumerate(sorted(set([stage['stage'] for stage in self.stages]))):
+			stages = [stage for stage in self.stages if stage['stage'] == name]
+			lines.append('dli_stage_seconds{} {}'.format(labels(stage=name), sum([stage['seconds'] for stage in stages])))
+			lines.append('dli_stage_cpu_seconds{} {}'.format(labels(stage=name, tool='false'), sum([stage['cpu'] for stage in stages])))
+			lines.append('dli_stage_cpu_seconds{} {}'.format(labels(stage=name, tool='true'), sum([stage['toolcpu'] for stage in stages])))
+
+		lines.append('# HELP dli_books_total Books processed in the last run by status.')
+		lines.append('# TYPE dli_books_total counter')
+		failed = set([stage['barcode'] for stage in self.stages if stage['status'] != 'ok'])
+		books = set([stage['barcode'] for stage in self.stages])
+		lines.append('dli_books_total{} {}'.format(labels(status='ok'), len(books - failed)))
+		lines.append('dli_books_total{} {}'.format(labels(status='failed'), len(failed)))
+
+		lines.append('# HELP dli_last_run_timestamp_seconds End of the last run.')
+		lines.append('# TYPE dli_last_run_timestamp_seconds gauge')
+		lines.append('dli_last_run_timestamp_seconds {}'.format(time.time()))
+		lines.append('# HELP dli_last_run_seconds Duration of the last run.')
+		lines.append('# TYPE dli_last_run_seconds gauge')
+		lines.append('dli_last_run_seconds {}'.format(time.time() - self.started))
+
+		tempname = "{}.{}.tmp".format(filename, os.getpid())
+		with open(tempname, 'wb') as filestream:
+			filestream.write('\n'.join(lines) + '\n')
+		if (sys.platform == 'win32' and os.path.exists(filename)):
+			os.remove(filename)
+		os.rename(tempname, filename)
+
+	def flush(self):
+		with self.lock:
+			stages = self.stages
+			pages = self.pages
+			self.stages = []
+			self.pages = []
+		if (args.metrics_file == None):
+			return
+		try:
+			with open(args.metrics_file, 'ab') as filestream:
+				for i, record in enumerate(stages + pages):
+					filestream.write(json.dumps(record, sort_keys=True) + '\n')
+		except (IOError, OSError) as exception:
+			logging.warning("Unable to write the metrics: {}".format(exception))
+			printexception(exception)
+
+	def finish(self):
+		self.summary()
+		try:
+			if (args.metrics_file != None):
+				self.writejsonlines(args.metrics_file)
+			if (args.metrics_prom != None):
+				self.writeprometheus(args.metrics_prom)
+		except (IOError, OSError) as exception:
+			logging.warning("Unable to write the metrics: {}".format(exception))
+			printexception(exception)
+
+
+class BatchScheduler(object):
+	# Runs the books of a --batch through the lookup, download and pdf stages.
+	# Every stage has its own queue and --batch-parallel worker threads, so one
+	# book's pdf is built while the next book downloads and a third is looked up.
+	# At most --batch-parallel books are in flight at once, and ServerLimits
+	# caps the connections to each server across all of them.
+
+	def __init__(self, books):
+		self.books = books
+		self.slots = threading.Semaphore(args.batch_parallel)
+		self.lock = threading.Lock()
+		self.finished = threading.Event()
+		self.remaining = len(books)
+		self.results = {}
+
+		self.stages = []
+		if (args.lookup == True or args.download == True):
+			self.stages.append(('lookup', lookupstage))
+		if (args.download == True):
+			self.stages.append(('download', downloadstage))
+		if (args.create_pdf == True or args.resize_pdf == True):
+			self.stages.append(('pdf', pdfstage))
+		self.queues = [Queue.Queue() for stage in self.stages]
+
+	def complete(self, book, status):
+		with self.lock:
+			self.results[book.barcode] = status
+			self.remaining -= 1
+			if (self.remaining == 0):
+				self.finished.set()
+		self.slots.release()
+
+	def stageworker(self, index):
+		name, function = self.stages[index]
+		while True:
+			book = self.queues[index].get()
+			if (book == None):
+				return
+
+			logging.debug("Book {}: starting {} stage".format(book.barcode, name))
+			start = time.time()
+			try:
+				function(book)
+			except (Exception, SystemExit) as exception:
+				logging.error("Book {}: {} stage failed".format(book.barcode, name))
+				if (not isinstance(exception, SystemExit)):
+					printexception(exception)
+				self.complete(book, "failed during {}".format(name))
+				continue
+			logging.debug("Book {}: {} stage completed in {} seconds".format(book.barcode, name, time.time() - start))
+
+			if (index + 1 < len(self.stages)):
+				self.queues[index + 1].put(book)
+			else:
+				self.complete(book, "done")
+
+	def run(self):
+		if (len(self.books) == 0 or len(self.stages) == 0):
+			return True
+
+		start = time.time()
+		workers = []
+		for index in range(len(self.stages)):
+			for i in range(args.batch_parallel):
+				thread = threading.Thread(target=self.stageworker, args=(index,))
+				thread.daemon = True
+				thread.start()
+				workers.append(thread)
+
+		for i, book in enumerate(self.books):
+			# acquire() has no timeout in python 2, so poll to keep Ctrl-C working
+			while (not self.slots.acquire(False)):
+				time.sleep(0.1)
+			logging.info("Book {} ({} of {})".format(book.barcode, i + 1, len(self.books)))
+			self.queues[0].put(book)
+
+		while (not self.finished.is_set()):
+			self.finished.wait(1)
+
+		for index in range(len(self.stages)):
+			for i in range(args.batch_parallel):
+				self.queues[index].put(None)
+
+		logging.info("")
+		logging.info("Batch completed in {} seconds".format(time.time() - start))
+		failed = 0
+		for i, book in enumerate(self.books):
+			status = self.results[book.barcode]
+			if (status != "done"):
+				failed += 1
+			logging.info("    {} {}: {}".format(book.barcode, book.pdf_name, status))
+
+		return (failed == 0)
+
+
+class Catalog(object):
+	# Local sqlite database of harvested book metadata (--catalog).
+	# books holds the properties of each barcode and when it was harvested,
+	# locations the image url and page count reported by each server, and
+	# books_fts a full text index of title, author, subject and language.
+	# checked and lastresult are the time and outcome of the latest attempt:
+	# a found book keeps its metadata when a later attempt fails.
+
+	def __init__(self, filename):
+		directory = os.path.dirname(os.path.abspath(filename))
+		if (not os.path.exists(directory)):
+			os.makedirs(directory)
+
+		import sqlite3
+		self.connection = sqlite3.connect(filename)
+		self.connection.text_factory = str
+		self.connection.executescript('''
+			CREATE TABLE IF NOT EXISTS books (
+				barcode INTEGER PRIMARY KEY,
+				status TEXT,
+				title TEXT,
+				author TEXT,
+				subject TEXT,
+				language TEXT,
+				year TEXT,
+				pages INTEGER,
+				properties TEXT,
+				harvested REAL,
+				checked REAL,
+				lastresult TEXT
+			);
+			CREATE TABLE IF NOT EXISTS locations (
+				barcode INTEGER,
+				server TEXT,
+				url TEXT,
+				pages TEXT,
+				checked REAL,
+				PRIMARY KEY (barcode, server)
+			);
+			CREATE INDEX IF NOT EXISTS books_harvested ON books (harvested);
+			CREATE INDEX IF NOT EXISTS books_language ON books (language);
+			CREATE INDEX IF NOT EXISTS books_year ON books (year);
+			CREATE INDEX IF NOT EXISTS locations_server ON locations (server);
+		''')
+
+		# catalogs from before checked and lastresult
+		columns = [row[1] for row in self.connection.execute("PRAGMA table_info(books)")]
+		for i, column in enumerate(['checked REAL', 'lastresult TEXT']):
+			if (not column.split()[0] in columns):
+				self.connection.execute("ALTER TABLE books ADD COLUMN {}".format(column))
+
+		# fall back to LIKE when sqlite was built without full text search
+		self.fts = True
+		try:
+			self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts4 (title, author, subject, language)")
+		except sqlite3.OperationalError:
+			logging.debug("sqlite has no fts4, --search will use LIKE")
+			self.fts = False
+		self.connection.commit()
+
+	def freshbarcodes(self, maxage):
+		cursor = self.connection.execute("SELECT barcode FROM books WHERE status != 'error' AND harvested > ?", (time.time() - maxage * 3600,))
+		return set([row[0] for row in cursor])
+
+	def store(self, barcode, status, properties, locations):
+		now = time.time()
+		if (status != 'found'):
+			# an error or a miss on a later harvest leaves a found book as it is
+			cursor = self.connection.execute("UPDATE books SET checked = ?, lastresult = ? WHERE barcode = ? AND status = 'found'", (now, status, barcode))
+			if (cursor.rowcount > 0):
+				return
+
+		propertiesdict = dict(properties or [])
+
+		pages = None
+		for i, (server, url, serverpages) in enumerate(locations):
+			if (serverpages.isdigit()):
+				pages = int(serverpages)
+				break
+		if (propertiesdict.get("TotalPages", '').isdigit()):
+			pages = int(propertiesdict["TotalPages"])
+
+		fields = (
+			propertiesdict.get("Title"),
+			propertiesdict.get("Author1"),
+			propertiesdict.get("Subject"),
+			propertiesdict.get("Language"),
+			propertiesdict.get("Year"),
+		)
+
+		self.connection.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(barcode, status) + fields + (pages, json.dumps(properties), now, now, status))
+		for i, (server, url, serverpages) in enumerate(locations):
+			self.connection.execute("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?)", (barcode, server, url, serverpages, now))
+
+		if (self.fts == True):
+			self.connection.execute("DELETE FROM books_fts WHERE docid = ?", (barcode,))
+			if (status == 'found'):
+				self.connection.execute("INSERT INTO books_fts (docid, title, author, subject, language) VALUES (?, ?, ?, ?, ?)",
+					(barcode,) + fields[0:4])
+
+	def search(self, query):
+		columns = "b.barcode, b.title, b.author, b.language, b.year, b.pages"
+		if (self.fts == True):
+			sql = "SELECT {} FROM books_fts f JOIN books b ON b.barcode = f.docid WHERE books_fts MATCH ? ORDER BY b.title".format(columns)
+			return self.connection.execute(sql, (query,)).fetchall()
+
+		pattern = '%' + query + '%'
+		sql = "SELECT {} FROM books b WHERE status = 'found' AND (title LIKE ? OR author LIKE ? OR subject LIKE ? OR language LIKE ?) ORDER BY b.title".format(columns)
+		return self.connection.execute(sql, (pattern, pattern, pattern, pattern)).fetchall()
+
+	def commit(self):
+		self.connection.commit()
+
+	def close(self):
+		self.connection.commit()
+		self.connection.close()
+
+
+def harvestbarcodes(specs):
+	# barcodes from command line specs: BARCODE, FIRST-LAST or a file
+	# (- for stdin) with one such spec per line
+	barcodes = []
+	for i, spec in enumerate(specs):
+		if (spec == '-' or os.path.isfile(spec)):
+			if (spec == '-'):
+				lines = sys.stdin.readlines()
+			else:
+				with open(spec, 'rb') as filestream:
+					lines = filestream.readlines()
+			fields = [line.split()[0] for line in lines if line.strip() != '' and not line.startswith('#')]
+			barcodes.extend(harvestbarcodes([field for field in fields if field != '-' and not os.path.isfile(field)]))
+			continue
+
+		match = re.match('^(\\d+)(?:-(\\d+))?$', spec)
+		if (match == None):
+			logging.error("Ignoring malformed barcode or range '{}'".format(spec))
+			continue
+		first = int(match.group(1))
+		last = int(match.group(2) or first)
+		barcodes.extend(range(first, last + 1))
+
+	return barcodes
+
+
+# seconds between commits of the --harvest results
+harvestcommitinterval = 10
+
+
+# guards the count of running harvest workers of each server
+harvestlock = threading.Lock()
+
+
+def harvestuntried(live, tried):
+	# whether a server that still has running workers has not tried a barcode
+	with harvestlock:
+		return (len([server for server, workers in live.items() if workers > 0 and not server in tried]) > 0)
+
+
+def harvestworker(server, barcodes, results, live):
+	# live: running workers per server, see harvestuntried()
+	try:
+		harvestbarcodesfrom(server, barcodes, results, live)
+	finally:
+		with harvestlock:
+			live[server] -= 1
+
+
+def harvestbarcodesfrom(server, barcodes, results, live):
+	# Fetch allmetainfo.cgi from server for barcodes off the shared queue.
+	# Every barcode goes to each running server, so that the catalog lists
+	# all the servers that host the book: the queue holds (barcode, tried,
+	# answered, properties, locations), and a barcode is stored once no
+	# running server is left that has not tried it (see harvestpass()).
+	# A worker waits on an empty queue while other servers still hold
+	# barcodes, which may come back for this one; a server that fails
+	# repeatedly stops taking barcodes.
+	failures = 0
+	skipped = 0
+	while (failures < sourcemaxfailures):
+		try:
+			item = barcodes.get_nowait()
+		except Queue.Empty:
+			if (barcodes.unfinished_tasks == 0):
+				return
+			time.sleep(0.1)
+			continue
+		barcode, tried, answered, properties, locations = item
+
+		if (server in tried):
+			if (harvestuntried(live, tried) == False):
+				harvestpass(barcodes, results, live, item)
+				continue
+			# for a server that has not tried it yet; wait only when every
+			# barcode on the queue has been tried here
+			barcodes.put(item)
+			barcodes.task_done()
+			skipped += 1
+			if (skipped > barcodes.qsize()):
+				time.sleep(0.1)
+				skipped = 0
+			continue
+
+		skipped = 0
+		tried = tried + [server]
+		try:
+			with serverlimits.hold(server):
+				start = time.time()
+				rawhtml = urllib2.urlopen(metainfourl(server, barcode), timeout=args.lookup_timeout).read()
+				end = time.time()
+		except (urllib2.URLError, httplib.HTTPException, socket.error) as exception:
+			logging.debug("server [{}]: harvesting {} failed: {}".format(server, barcode, exception))
+			scoreboard.recordfailure(server, 'lookup')
+			failures += 1
+			harvestpass(barcodes, results, live, (barcode, tried, answered, properties, locations))
+			continue
+
+		failures = 0
+		scoreboard.recordlookup(server, end - start)
+
+		# a page this server got wrong only loses its answer for this barcode
+		try:
+			serverproperties, readurl = parsemetainfo(rawhtml)
+			if (len(serverproperties) > 0 and properties == None):
+				properties = serverproperties
+			if (readurl != None):
+				url, pages = bookurl(server, readurl)
+				locations = locations + [(urlparse(url).netloc, url, pages)]
+			answered = True
+		except Exception as exception:
+			logging.warning("server [{}]: unable to read the metadata of {}".format(server, barcode))
+			printexception(exception)
+		harvestpass(barcodes, results, live, (barcode, tried, answered, properties, locations))
+
+
+def harvestpass(barcodes, results, live, item):
+	# pass a barcode on to the next running server that has not tried it,
+	# or store what the servers reported: found if any of them has it,
+	# missing if they answered without it, else an error; the queue's
+	# unfinished count drops to zero once every barcode is stored
+	barcode, tried, answered, properties, locations = item
+	if (harvestuntried(live, tried) == True):
+		barcodes.put(item)
+	elif (properties != None or len(locations) > 0):
+		results.put((barcode, 'found', properties, locations))
+	elif (answered == True):
+		results.put((barcode, 'missing', None, []))
+	else:
+		results.put((barcode, 'error', None, []))
+	barcodes.task_done()
+
+
+def harvest(specs):
+	catalog = Catalog(args.catalog)
+
+	barcodes = harvestbarcodes(specs)
+	fresh = catalog.freshbarcodes(args.harvest_max_age)
+	pending = [barcode for barcode in barcodes if not barcode in fresh]
+	logging.info("Harvesting {} books into {} ({} harvested in the last {} hours)".format(len(pending), args.catalog, len(barcodes) - len(pending), args.harvest_max_age))
+
+	queue = Queue.Queue()
+	for i, barcode in enumerate(pending):
+		queue.put((barcode, [], False, None, []))
+
+	results = Queue.Queue()
+	workers = []
+	live = dict([(server, args.harvest_parallel) for server in args.server])
+	for i, server in enumerate(args.server):
+		for j in range(args.harvest_parallel):
+			thread = threading.Thread(target=harvestworker, args=(server, queue, results, live))
+			thread.daemon = True
+			thread.start()
+			workers.append(thread)
+
+	# results are written by this thread only, and committed every 100
+	# books or harvestcommitinterval seconds so that an interrupted harvest
+	# resumes where it stopped
+	start = time.time()
+	committed = start
+	counts = collections.Counter()
+	try:
+		while (any([thread.is_alive() for thread in workers]) or not results.empty()):
+			due = False
+			try:
+				barcode, status, properties, locations = results.get(True, 1)
+				catalog.store(barcode, status, properties, locations)
+				counts[status] += 1
+				done = sum(counts.values())
+				if (done % 100 == 0):
+					due = True
+					logging.info("    {} of {} books harvested".format(done, len(pending)))
+			except Queue.Empty:
+				pass
+
+			if (due == True or time.time() - committed >= harvestcommitinterval):
+				catalog.commit()
+				committed = time.time()
+	finally:
+		catalog.close()
+
+	unfinished = len(pending) - sum(counts.values())
+	logging.info("Harvest completed in {} seconds: {} found, {} missing, {} errors, {} not attempted".format(
+		time.time() - start, counts['found'], counts['missing'], counts['error'], unfinished))
+
+
+def searchcatalog(query):
+	import sqlite3
+	catalog = Catalog(args.catalog)
+	try:
+		rows = catalog.search(query)
+	except sqlite3.OperationalError as exception:
+		logging.error("Invalid search '{}': {}".format(query, exception))
+		sys.exit(-1)
+	finally:
+		catalog.close()
+
+	for i, (barcode, title, author, language, year, pages) in enumerate(rows):
+		logging.info("{}  {}  ({}; {}; {}; {} pages)".format(barcode, title, author, language, year, pages))
+	logging.info("{} books found".format(len(rows)))
+
+
 def initializelogging():
 	# set up logging to file - see previous section for more details
 	logging.basicConfig(level=logging.DEBUG,